@@ -0,0 +1,21 @@
+import hmac
+import os
+from functools import wraps
+
+from flask import jsonify, request
+
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+
+def require_admin(view):
+    """Reject the request unless it carries 'Authorization: Bearer <ADMIN_TOKEN>'"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        token = header[7:] if header.startswith('Bearer ') else ''
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+
+    return wrapper
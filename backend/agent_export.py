@@ -0,0 +1,165 @@
+import base64
+import json
+import os
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import Response, jsonify, request, stream_with_context
+
+from admin import require_admin
+from clients import get_supabase
+from compression import json_response
+from metrics import timed
+
+AGENT_COLUMNS = (
+    'id', 'user_id', 'state', 'brand_name', 'hero_header', 'hero_subheader', 'hero_color',
+    'hero_text_size', 'subheader_color', 'subheader_text_size', 'products', 'product_pills',
+    'background_image', 'sales_tone', 'agent_type', 'conversation_history', 'version', 'updated_at',
+)
+# The listing leaves out the large JSON columns unless asked for them
+LIST_COLUMNS = ('id', 'user_id', 'brand_name', 'state', 'version', 'updated_at')
+KEY_COLUMNS = ('updated_at', 'id')
+
+ADMIN_LIST_MAX = int(os.getenv('ADMIN_LIST_MAX', 500))
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 200))
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    raw = json.dumps([row.get('updated_at'), row['id']], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[Optional[str], str]]:
+    if not cursor:
+        return None
+    try:
+        updated_at, agent_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        # Both go into a PostgREST filter, so only an ISO timestamp and a uuid get through
+        if updated_at is not None:
+            if not isinstance(updated_at, str):
+                raise ValueError(updated_at)
+            datetime.fromisoformat(updated_at)
+        agent_id = str(uuid.UUID(str(agent_id)))
+    except Exception:
+        raise CursorError('Invalid cursor')
+    return updated_at, agent_id
+
+
+def projection(fields: Optional[str], default) -> List[str]:
+    """Requested columns, always including the keyset columns"""
+    columns = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(default)
+    unknown = [c for c in columns if c not in AGENT_COLUMNS]
+    if unknown:
+        raise CursorError(f"Unknown fields: {', '.join(unknown)}")
+    for column in KEY_COLUMNS:
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+
+def fetch_page(columns: List[str], after, limit: int) -> List[Dict[str, Any]]:
+    """One page of agents ordered by (updated_at desc, id desc), starting after a cursor
+
+    Postgres sorts NULL updated_at first on a descending order, so rows without
+    a timestamp come first (by id) and are followed by the timestamped ones.
+    """
+    query = get_supabase().table('agents').select(','.join(columns))
+    if after is not None:
+        # Values are quoted because timestamps contain PostgREST's '.' and ':' separators
+        updated_at, agent_id = after
+        if updated_at is None:
+            query = query.or_(f'and(updated_at.is.null,id.lt."{agent_id}"),updated_at.not.is.null')
+        else:
+            query = query.or_(f'updated_at.lt."{updated_at}",and(updated_at.eq."{updated_at}",id.lt."{agent_id}")')
+    query = query.order('updated_at', desc=True).order('id', desc=True).limit(limit)
+    with timed('agents_page'):
+        return query.execute().data or []
+
+
+def export_lines(columns: List[str], cursor: Optional[str], page_size: int):
+    """NDJSON agent rows, page by page, with a resumable cursor line after each page"""
+    after = decode_cursor(cursor)
+    exported = 0
+    while True:
+        try:
+            rows = fetch_page(columns, after, page_size)
+        except Exception as e:
+            print(f"Error exporting agents: {e}")
+            yield json.dumps({'_error': 'Export interrupted', '_cursor': cursor, '_exported': exported}) + '\n'
+            return
+        for row in rows:
+            yield json.dumps(row, default=str, separators=(',', ':')) + '\n'
+        exported += len(rows)
+        if len(rows) < page_size:
+            yield json.dumps({'_cursor': None, '_done': True, '_exported': exported}) + '\n'
+            return
+        cursor = encode_cursor(rows[-1])
+        after = decode_cursor(cursor)
+        yield json.dumps({'_cursor': cursor, '_exported': exported}) + '\n'
+
+
+def gzip_stream(lines):
+    # Flush per page so a cut-off download still decompresses up to its last cursor line
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for line in lines:
+        chunk = compressor.compress(line.encode())
+        if line.startswith('{"_'):
+            chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def init_app(app):
+    """Register the admin agents listing and NDJSON export"""
+
+    @app.route('/api/admin/agents', methods=['GET'])
+    @require_admin
+    def list_agents():
+        try:
+            columns = projection(request.args.get('fields'), LIST_COLUMNS)
+            after = decode_cursor(request.args.get('cursor'))
+            limit = max(1, min(int(request.args.get('limit', 50)), ADMIN_LIST_MAX))
+        except (CursorError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        try:
+            rows = fetch_page(columns, after, limit + 1)
+        except Exception as e:
+            print(f"Error listing agents: {e}")
+            return jsonify({'error': 'Could not list agents'}), 502
+
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return json_response({
+            'agents': rows,
+            'next_cursor': encode_cursor(rows[-1]) if more else None
+        })
+
+    @app.route('/api/admin/agents/export', methods=['GET'])
+    @require_admin
+    def export_agents():
+        try:
+            default = AGENT_COLUMNS if request.args.get('turns', '1') != '0' else [
+                c for c in AGENT_COLUMNS if c != 'conversation_history']
+            columns = projection(request.args.get('fields'), default)
+            cursor = request.args.get('cursor')
+            decode_cursor(cursor)
+            page_size = max(1, min(int(request.args.get('page_size', EXPORT_PAGE_SIZE)), ADMIN_LIST_MAX))
+        except (CursorError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        lines = export_lines(columns, cursor, page_size)
+        if request.args.get('gzip') == '1':
+            response = Response(stream_with_context(gzip_stream(lines)), mimetype='application/gzip')
+            response.headers['Content-Disposition'] = 'attachment; filename=agents.ndjson.gz'
+        else:
+            response = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
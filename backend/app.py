@@ -1,17 +1,17 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
-import anthropic
 import os
-from supabase import create_client
+import clients
+from clients import get_claude, get_supabase
+from idempotency import idempotent
 
 load_dotenv()
 app = Flask(__name__)
 CORS(app)
-client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_KEY"))
 
 @app.route('/api/chat', methods=['POST'])
+@idempotent
 def chat():
     data = request.json
     user_message = data.get('message')
@@ -20,17 +20,18 @@ def chat():
     
     if build_context:
         system_prompt = f"Guide user building business agent. {build_context}. Redirect if off-topic."
-        response = client.messages.create(model="claude-sonnet-4-20250514", max_tokens=1024, messages=[{"role": "user", "content": user_message}], system=system_prompt)
+        response = get_claude().messages.create(model="claude-sonnet-4-20250514", max_tokens=1024, messages=[{"role": "user", "content": user_message}], system=system_prompt)
         return jsonify({'response': response.content[0].text})
     else:
         products = ', '.join([p['name'] + ' £' + str(p['price']) for p in agent_data.get('products', [])])
-        response = client.messages.create(model="claude-sonnet-4-20250514", max_tokens=1024, messages=[{"role": "user", "content": user_message}], system=f"Sales assistant for {agent_data.get('brandName', 'store')}. Products: {products}")
+        response = get_claude().messages.create(model="claude-sonnet-4-20250514", max_tokens=1024, messages=[{"role": "user", "content": user_message}], system=f"Sales assistant for {agent_data.get('brandName', 'store')}. Products: {products}")
         return jsonify({'response': response.content[0].text})
 
 @app.route('/api/agents', methods=['POST'])
+@idempotent
 def save_agent():
     data = request.json
-    result = supabase.table('agents').insert({
+    result = get_supabase().table('agents').insert({
         'brand_name': data['brandName'],
         'hero_header': data.get('heroHeader'),
         'hero_subheader': data.get('heroSubheader'),
@@ -41,10 +42,16 @@ def save_agent():
 
 @app.route('/api/agents/<brand_name>', methods=['GET'])
 def get_agent(brand_name):
-    result = supabase.table('agents').select('*').ilike('brand_name', brand_name).execute()
+    result = get_supabase().table('agents').select('*').ilike('brand_name', brand_name).execute()
     if result.data:
         return jsonify(result.data[0])
     return jsonify({'error': 'Not found'}), 404
 
+@app.route('/healthz/warm', methods=['GET', 'POST'])
+def warm():
+    checks = clients.warm()
+    ready = all(check['ok'] for check in checks.values())
+    return jsonify({'ready': ready, 'checks': checks, 'startup': clients.startup_report()}), 200 if ready else 503
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
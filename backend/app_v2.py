@@ -1,106 +1,291 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
-import anthropic
 import os
 import json
+import logging
+import time
+import re
 from datetime import datetime
-from supabase import create_client
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 import uuid
+import copy
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from resilience import ResilientClaude, UpstreamUnavailable
+import metrics
+import profiling
+import usage
+import assets
+import agent_export
+import compression
+import session_store
+import catalog
+import builder_states
+import memdiag
+import catalog_index
+import jobs
+from metrics import timed
+from compression import json_response
+import clients
+from clients import get_supabase
+from idempotency import idempotent
+from singleflight import SingleFlight
+from versioning import context_etag, json_patch
 
 load_dotenv()
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
 app = Flask(__name__)
 CORS(app)
+metrics.init_app(app)
+profiling.init_app(app)
 
-# Initialize clients
-claude_client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-supabase = create_client(
-    os.getenv("SUPABASE_URL"), 
-    os.getenv("SUPABASE_SERVICE_KEY")
+# Clients are built on first use (see clients.py) so cold start skips the SDK imports
+claude = ResilientClaude(clients.get_claude)
+usage_tracker = usage.UsageTracker(usage.make_sink(get_supabase))
+usage.init_app(app, usage_tracker)
+assets.init_app(app)
+agent_export.init_app(app)
+compression.init_app(app)
+memdiag.init_app(app, lambda: builders)
+
+CLAUDE_MODEL = "claude-3-haiku-20240307"
+JSON_BLOCK = re.compile(r'\{.*\}', re.DOTALL)
+CONTEXT_SNAPSHOTS = int(os.getenv('CONTEXT_SNAPSHOTS', 8))
+HISTORY_PAGE_MAX = int(os.getenv('HISTORY_PAGE_MAX', 200))
+PRODUCT_IMPORT_MAX = int(os.getenv('PRODUCT_IMPORT_MAX', 100000))
+PRODUCT_IMPORT_BATCH = int(os.getenv('PRODUCT_IMPORT_BATCH', 1000))
+# Cold loads read the agent_heads view (migrations/003_agents_history.sql): every
+# column but conversation_history, plus its length and last few turns
+HEAD_COLUMNS = ','.join(
+    [c for c in agent_export.AGENT_COLUMNS if c != 'conversation_history'] + ['history_len', 'history_tail']
 )
+# New agent ids derive from the user id, so workers creating one at once create the same row
+AGENT_ID_NAMESPACE = uuid.UUID('6f1c3e52-8d0a-4f5e-9a57-2b9f0c7d4e11')
+# Stored rows fall back to these where a new agent's defaults differ
+ROW_DEFAULTS = {'hero_text_size': 'text-2xl', 'subheader_text_size': 'text-sm'}
+# Local WAL and warm-session snapshots; None when disabled (see session_store.py)
+sessions = session_store.open_store()
+# user_id -> snapshot JSON of sessions restored at startup but not used since
+restored_sessions: Dict[str, str] = {}
+
+def default_context() -> Dict[str, Any]:
+    """Context for a brand new agent"""
+    return {
+        'state': 'idle',
+        'brand_name': '',
+        'hero_header': '',
+        'hero_subheader': '',
+        'hero_color': '#171717',
+        'hero_text_size': 'text-6xl',
+        'subheader_color': '#525252',
+        'subheader_text_size': 'text-xl',
+        'products': [],
+        'product_pills': [],
+        'background_image': '',
+        'sales_tone': 'friendly',
+        'agent_type': 'eCommerce',
+        'conversation_history': [],
+        # Older turns still in Supabase only; conversation_history holds the rest
+        'history_offset': 0,
+        'version': 0
+    }
+
+def context_from_row(agent_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Builder context from a stored agents row, agent_heads row or WAL record"""
+    context = dict(default_context(), **ROW_DEFAULTS)
+    context.update((key, agent_data[key]) for key in context.keys() & agent_data.keys())
+    context['state'] = builder_states.normalize_state(context['state'])
+    context['version'] = context['version'] or 0
+    if 'history_tail' in agent_data:
+        context['conversation_history'] = agent_data['history_tail'] or []
+        context['history_offset'] = max(0, (agent_data.get('history_len') or 0) - len(context['conversation_history']))
+    return context
+
+def write_agent_row(data: Dict[str, Any], base_version: Optional[int]) -> List[Dict[str, Any]]:
+    """Insert a new agents row unless it exists, or update one only if it is still at base_version
+
+    With a history_offset, conversation_history holds only the turns from that
+    index on and the database keeps the older ones in front of them.
+    """
+    row = {key: value for key, value in data.items() if key != 'history_offset'}
+    if base_version is None:
+        result = get_supabase().table('agents').upsert(row, on_conflict='id', ignore_duplicates=True).execute()
+    elif data.get('history_offset'):
+        result = get_supabase().rpc('save_agent_tail', {
+            'p_row': row, 'p_base_version': base_version, 'p_history_from': data['history_offset']
+        }).execute()
+        return [{'id': row['id'], 'version': result.data}] if result.data is not None else []
+    else:
+        result = get_supabase().table('agents').update(row).eq(
+            'id', data['id']
+        ).eq('version', base_version).execute()
+    return result.data
+
+def public_context(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """The camelCase context served by the context GET and used as the delta base"""
+    return assets.proxy_context_images({
+        'brandName': ctx.get('brand_name', ''),
+        'heroHeader': ctx.get('hero_header', ''),
+        'heroSubheader': ctx.get('hero_subheader', ''),
+        'heroColor': ctx.get('hero_color', '#171717'),
+        'heroTextSize': ctx.get('hero_text_size', 'text-6xl'),
+        'heroWeight': ctx.get('hero_weight', 'font-normal'),
+        'subheaderColor': ctx.get('subheader_color', '#525252'),
+        'subheaderTextSize': ctx.get('subheader_text_size', 'text-xl'),
+        'subheaderWeight': ctx.get('subheader_weight', 'font-normal'),
+        'products': ctx.get('products', []),
+        'productPills': ctx.get('product_pills', []),
+        'backgroundImage': ctx.get('background_image', ''),
+        'salesTone': ctx.get('sales_tone', 'friendly')
+    })
+
+def reply_context(ctx: Dict[str, Any], added: List[Dict[str, Any]],
+                  updated: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """The context in a builder reply
+
+    The studio appends products to its list, so they are only the ones just
+    added; products the turn changed come in updatedProducts, which the studio
+    swaps in by name.
+    """
+    return assets.proxy_context_images({
+        'state': ctx['state'],
+        'brandName': ctx.get('brand_name', ''),
+        'heroHeader': ctx.get('hero_header', ''),
+        'heroSubheader': ctx.get('hero_subheader', ''),
+        'heroColor': ctx.get('hero_color', '#171717'),
+        'heroTextSize': ctx.get('hero_text_size', 'text-2xl'),
+        'subheaderColor': ctx.get('subheader_color', '#525252'),
+        'subheaderTextSize': ctx.get('subheader_text_size', 'text-sm'),
+        'products': added or [],
+        'updatedProducts': updated or [],
+        'productPills': ctx.get('product_pills', []) or [],
+        'backgroundImage': ctx.get('background_image', ''),
+        'salesTone': ctx.get('sales_tone', 'friendly'),
+        'agentType': ctx.get('agent_type', 'eCommerce')
+    })
+
+def render_builder_prompt(context: Dict[str, Any]) -> str:
+    """Render the builder prompt for the context's state (see builder_states.py)"""
+    return builder_states.render_prompt(context)
+
+def render_storefront_prompt(agent_data: Dict[str, Any]) -> str:
+    """Render the storefront sales prompt from the published agent data"""
+    products_str = ', '.join([
+        f"{p['name']} ${p['price']}" 
+        for p in agent_data.get('products', [])
+    ])
+    
+    return f"""You are a sales assistant for {agent_data.get('brandName', 'this store')}. 
+Products available: {products_str}
+Tone: {agent_data.get('salesTone', 'friendly')}
+Help customers find products and make purchases."""
+
+class AgentUnavailable(Exception):
+    """Supabase could not be reached to load a user's agent"""
 
 class AgentBuilder:
     """Manages the AI-driven agent building process"""
     
-    def __init__(self, user_id: str):
+    def __init__(self, user_id: str, state: Optional[Dict[str, Any]] = None):
         self.user_id = user_id
         self.agent_id = None
         self.context = {}
-        self.load_or_create_agent()
+        # Version last read from or written to Supabase; None until the row exists
+        self.stored_version = None
+        self.stale = False
+        self.snapshots = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        if state is not None:
+            # Restored from a local session snapshot, no query needed
+            self.agent_id = state['agent_id']
+            self.context = state['context']
+            self.stored_version = state['stored_version']
+            self.remember_snapshot()
+            return
+        with timed('load_or_create_agent'):
+            self.load_or_create_agent()
     
     def load_or_create_agent(self):
         """Load existing agent or create new one"""
         try:
-            result = supabase.table('agents').select('*').eq(
-                'user_id', self.user_id
-            ).order('updated_at.desc').limit(1).single().execute()
-            
-            if result.data and len(result.data) > 0:
-                agent_data = result.data[0]
-                self.agent_id = agent_data['id']
-                self.context = {
-                    'state': agent_data.get('state', 'start'),
-                    'brand_name': agent_data.get('brand_name', ''),
-                    'hero_header': agent_data.get('hero_header', ''),
-                    'hero_subheader': agent_data.get('hero_subheader', ''),
-                    'hero_color': agent_data.get('hero_color', '#171717'),
-                    'hero_text_size': agent_data.get('hero_text_size', 'text-2xl'),
-                    'subheader_color': agent_data.get('subheader_color', '#525252'),
-                    'subheader_text_size': agent_data.get('subheader_text_size', 'text-sm'),
-                    'products': agent_data.get('products', []),
-                    'product_pills': agent_data.get('product_pills', []),
-                    'background_image': agent_data.get('background_image', ''),
-                    'sales_tone': agent_data.get('sales_tone', 'friendly'),
-                    'agent_type': agent_data.get('agent_type', 'eCommerce'),
-                    'conversation_history': agent_data.get('conversation_history', [])
-                }
-            else:
-                self.agent_id = str(uuid.uuid4())
-                self.context = {
-                    'state': 'start',
-                    'brand_name': '',
-                    'hero_header': '',
-                    'hero_subheader': '',
-                    'hero_color': '#171717',
-                    'hero_text_size': 'text-6xl',
-                    'subheader_color': '#525252',
-                    'subheader_text_size': 'text-xl',
-                    'products': [],
-                    'product_pills': [],
-                    'background_image': '',
-                    'sales_tone': 'friendly',
-                    'agent_type': 'eCommerce',
-                    'conversation_history': []
-                }
-                self.save_context()
+            for attempt in range(2):
+                # One (user_id, updated_at desc) index probe, without the full history
+                result = get_supabase().table('agent_heads').select(HEAD_COLUMNS).eq(
+                    'user_id', self.user_id
+                ).order('updated_at', desc=True).limit(1).execute()
+                
+                if result.data and len(result.data) > 0:
+                    agent_data = result.data[0]
+                    self.agent_id = agent_data['id']
+                    self.context = context_from_row(agent_data)
+                    self.stored_version = self.context['version']
+                    self.remember_snapshot()
+                    return
+                self.agent_id = str(uuid.uuid5(AGENT_ID_NAMESPACE, self.user_id))
+                self.context = default_context()
+                if self.save_context() or not self.stale:
+                    return
+                # Another worker created it first; load theirs
+                self.stale = False
         except Exception as e:
             print(f"Error loading/creating agent: {e}")
-            self.agent_id = str(uuid.uuid4())
-            self.context = {
-                'state': 'start',
-                'brand_name': '',
-                'hero_header': '',
-                'hero_subheader': '',
-                'hero_color': '#171717',
-                'hero_text_size': 'text-6xl',
-                'subheader_color': '#525252',
-                'subheader_text_size': 'text-xl',
-                'products': [],
-                'product_pills': [],
-                'background_image': '',
-                'sales_tone': 'friendly',
-                'agent_type': 'eCommerce',
-                'conversation_history': []
-            }
+            metrics.record_error('load_or_create_agent')
+            # A blank stand-in would be saved as a second agent for this user
+            raise AgentUnavailable(f"Could not load the agent for {self.user_id}") from e
+    
+    def remember_snapshot(self):
+        """Keep the public context of recent versions so clients can ask for deltas"""
+        self.snapshots[self.context['version']] = copy.deepcopy(public_context(self.context))
+        while len(self.snapshots) > CONTEXT_SNAPSHOTS:
+            self.snapshots.popitem(last=False)
+    
+    def delta_since(self, base_version: int) -> Optional[List[Dict[str, Any]]]:
+        """JSON-Patch from a recent version to the current one, or None if it has aged out"""
+        base = self.snapshots.get(base_version)
+        if base is None:
+            return None
+        return json_patch(base, public_context(self.context))
+    
+    def history_page(self, before: int, limit: int) -> List[Dict[str, Any]]:
+        """Up to limit turns ending just before index before, fetching older ones on demand"""
+        offset = self.context.get('history_offset', 0)
+        start = max(0, before - limit)
+        turns = []
+        if start < offset:
+            with timed('history_page'):
+                turns = get_supabase().rpc('agent_history_page', {
+                    'p_agent_id': self.agent_id, 'p_before': min(before, offset), 'p_limit': min(before, offset) - start
+                }).execute().data or []
+        loaded = self.context.get('conversation_history', [])
+        return turns + loaded[max(0, start - offset):max(0, before - offset)]
+    
+    def snapshot_state(self) -> Dict[str, Any]:
+        """What a session snapshot needs to bring this builder back without a query"""
+        return {
+            'user_id': self.user_id,
+            'agent_id': self.agent_id,
+            'stored_version': self.stored_version,
+            'context': self.context
+        }
     
     def save_context(self):
-        """Save context to Supabase"""
+        """Save context to Supabase, bumping its version
+
+        Existing rows are written conditionally on the version we last saw, so a
+        write from a stale copy (e.g. another worker) is rejected, not applied.
+        With the session store on, the row is logged locally first and a failed
+        write is replayed once Supabase is reachable again.
+        """
+        new_version = self.context.get('version', 0) + 1
+        seq = None
         try:
             data_to_save = {
                 'id': self.agent_id,
                 'user_id': self.user_id,
-                'state': self.context.get('state', 'start'),
+                'state': self.context.get('state', 'idle'),
                 'brand_name': self.context.get('brand_name', ''),
                 'hero_header': self.context.get('hero_header', ''),
                 'hero_subheader': self.context.get('hero_subheader', ''),
@@ -114,17 +299,36 @@ class AgentBuilder:
                 'sales_tone': self.context.get('sales_tone', 'friendly'),
                 'agent_type': self.context.get('agent_type', 'eCommerce'),
                 'conversation_history': self.context.get('conversation_history', []),
+                'history_offset': self.context.get('history_offset', 0),
+                'version': new_version,
                 'updated_at': datetime.utcnow().isoformat()
             }
             
-            result = supabase.table('agents').upsert(
-                data_to_save,
-                on_conflict='id'
-            ).execute()
+            if sessions:
+                seq = sessions.wal.append(self.agent_id, self.user_id, self.stored_version, data_to_save)
+            
+            with timed('save_context'):
+                rows = write_agent_row(data_to_save, self.stored_version)
+            if seq is not None:
+                sessions.wal.ack(self.agent_id, seq)
             
+            if not rows:
+                print(f"Stale context for agent {self.agent_id}: version {self.stored_version} was superseded")
+                metrics.record_error('stale_version')
+                self.stale = True
+                return False
+            
+            self.stored_version = new_version
+            self.context['version'] = new_version
+            self.remember_snapshot()
             return True
         except Exception as e:
             print(f"Error saving context: {e}")
+            metrics.record_error('save_context')
+            if seq is not None:
+                # Durable in the WAL; the next save or the replay thread sends it
+                self.context['version'] = new_version
+                self.remember_snapshot()
             return False
     
     def process_message(self, user_message: str) -> Dict[str, Any]:
@@ -136,84 +340,59 @@ class AgentBuilder:
             'timestamp': datetime.utcnow().isoformat()
         })
         
-        history_size = len(self.context['conversation_history'])
-        start_index = max(0, int(history_size * 0.2))
-        recent_history = self.context['conversation_history'][start_index:]
-        
-        conv_context = ""
-        for msg in recent_history[-10:]:
-            conv_context += f"{msg['role']}: {msg['content'][:100]}\n"
+        if catalog.looks_like_catalog(user_message):
+            return self.import_catalog(user_message)
         
-        products_summary = ', '.join([f"{p['name']}:${p.get('price', 0)}" for p in self.context.get('products', []) or []])[:200]
+        command = builder_states.match_command(user_message)
+        if command:
+            return self.run_command(command)
         
-        system_prompt = f"""You're building an eCommerce agent. Current state: {self.context['state']}
-
-CRITICAL: "hero text" means hero_color field. "background" means background_image field. NEVER mix these up!
-Current build:
-Brand: {self.context.get('brand_name', 'Not set')}
-Header: {self.context.get('hero_header', 'Not set')}
-Subheader: {self.context.get('hero_subheader', 'Not set')}
-Hero Color: {self.context.get('hero_color', '#171717')}
-Hero Size: {self.context.get('hero_text_size', 'text-2xl')}
-Subheader Color: {self.context.get('subheader_color', '#525252')}
-Subheader Size: {self.context.get('subheader_text_size', 'text-sm')}
-Products: {products_summary if products_summary else 'None'}
-Background: {self.context.get('background_image', 'Not set')}
-Tone: {self.context.get('sales_tone', 'friendly')}
-
-Recent conversation:
-{conv_context}
-
-Parse user's message and extract business details. Guide them naturally through building.
-Return JSON: {{"updated_fields": {{"brand_name": null, "hero_header": null, "hero_subheader": null, "hero_color": null, "hero_text_size": null, "subheader_color": null, "subheader_text_size": null, "products": null, "sales_tone": null}}, "next_state": "{self.context['state']}", "ai_response": "your response"}}
-
-CRITICAL: "publish" or "publish agent" commands should NOT create products. Just respond ready to publish.
-
-Examples:
-- "I want to sell tea" → Ask about brand name
-- "Call it TeaTime" → Set brand_name: "TeaTime"
-- "Add Green Tea $25" → Add {{"name": "Green Tea", "price": 25, "image": "default"}} to products
-- "Make hero blue" → Set hero_color: "#3B82F6"
-- "Change header to #FF5436" → Set hero_color: "#FF5436"
-- "Make hero bold" → Set hero_text_size: "text-2xl font-bold"
-- "Make hero bigger" → Set hero_text_size: "text-3xl"
-- "Make subheader red" → Set subheader_color: "#EF4444"
-- "Make subheader medium" → Set subheader_text_size: "text-sm font-medium"
-
-IMPORTANT: Always extract product name and price. Products format: [{{"name": "X", "price": 25, "image": "url"}}]"""
+        previous_state = self.context.get('state')
+        state = builder_states.advance(self.context)
+        self.context['state'] = state
+        with timed('prompt'):
+            system_prompt = render_builder_prompt(self.context)
         
         try:
-            response = claude_client.messages.create(
-                model="claude-3-haiku-20240307",
-                max_tokens=1000,
-                temperature=0.3,
-                messages=[{"role": "user", "content": user_message}],
-                system=system_prompt
+            model = usage_tracker.model_for(self.user_id, CLAUDE_MODEL)
+            started = time.perf_counter()
+            with timed('claude', model=model):
+                response = claude.create(
+                    'builder',
+                    on_discarded=lambda extra: usage_tracker.record(
+                        extra, model, time.perf_counter() - started, 'builder',
+                        user_id=self.user_id, agent_id=self.agent_id, state=state
+                    ),
+                    model=model,
+                    max_tokens=1000,
+                    temperature=0.3,
+                    messages=[{"role": "user", "content": user_message}],
+                    system=system_prompt
+                )
+            usage_tracker.record(
+                response, model, time.perf_counter() - started, 'builder',
+                user_id=self.user_id, agent_id=self.agent_id, state=state
             )
             
             response_text = response.content[0].text
             
-            try:
-                import re
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                else:
-                    result = {
-                        "updated_fields": {},
-                        "next_state": self.context['state'],
-                        "ai_response": response_text,
-                    }
-            except:
-                result = {
-                    "updated_fields": {},
-                    "next_state": self.context["state"],
-                }
-            if result.get("updated_fields"):
-                for key, value in result["updated_fields"].items():
-                    if value is not None:
-                        self.context[key] = value
-                self.context['state'] = result['next_state']
+            with timed('parse'):
+                result = builder_states.parse_reply(response_text, state, JSON_BLOCK)
+            if 'products' in result['updated_fields']:
+                # The prompt only shows part of a large catalog, so the model
+                # returns the products it adds or changes, never the whole list
+                self.context['products'], added, updated = catalog.merge_changes(
+                    self.context.get('products'),
+                    catalog.normalize_products(result['updated_fields'].pop('products')))
+                # updated_fields (returned by /api/builder/chat) carries whole fields
+                result['updated_fields']['products'] = self.context['products']
+            else:
+                added, updated = [], []
+            for key, value in result['updated_fields'].items():
+                self.context[key] = value
+            self.context['state'] = result['next_state']
+            # The fields just set may complete the state the model left it in
+            self.context['state'] = builder_states.advance(self.context)
             
             self.context['conversation_history'].append({
                 'role': 'assistant',
@@ -226,49 +405,311 @@ IMPORTANT: Always extract product name and price. Products format: [{{"name": "X
             return {
                 'success': True,
                 'response': result.get('ai_response', ''),
-                'context': {
-                    'state': self.context['state'],
-                    'brandName': self.context.get('brand_name', ''),
-                    'heroHeader': self.context.get('hero_header', ''),
-                    'heroSubheader': self.context.get('hero_subheader', ''),
-                    'heroColor': self.context.get('hero_color', '#171717'),
-                    'heroTextSize': self.context.get('hero_text_size', 'text-2xl'),
-                    'subheaderColor': self.context.get('subheader_color', '#525252'),
-                    'subheaderTextSize': self.context.get('subheader_text_size', 'text-sm'),
-                    'products': result.get('updated_fields', {}).get('products', []) or [],
-                    'productPills': self.context.get('product_pills', []) or [],
-                    'backgroundImage': self.context.get('background_image', ''),
-                    'salesTone': self.context.get('sales_tone', 'friendly'),
-                    'agentType': self.context.get('agent_type', 'eCommerce')
-                },
-                'updated_fields': result.get('updated_fields', {})
+                'context': reply_context(self.context, added, updated),
+                'updated_fields': result.get('updated_fields', {}),
+                'version': self.context['version']
             }
             
         except Exception as e:
             print(f"Error processing message: {e}")
+            # Nothing was saved, so the turn doesn't move the machine either
+            self.context['state'] = previous_state
             return {
                 'success': False,
                 'error': str(e),
                 'response': "I had trouble understanding that. Could you try rephrasing?",
-                'context': {
-                    'brandName': self.context.get('brand_name', ''),
-                    'heroHeader': self.context.get('hero_header', ''),
-                    'heroSubheader': self.context.get('hero_subheader', ''),
-                    'heroColor': self.context.get('hero_color', '#171717'),
-                    'heroTextSize': self.context.get('hero_text_size', 'text-2xl'),
-                    'subheaderColor': self.context.get('subheader_color', '#525252'),
-                    'subheaderTextSize': self.context.get('subheader_text_size', 'text-sm'),
-                    'products': self.context.get('products', []) or [],
-                    'productPills': self.context.get('product_pills', []) or [],
-                    'backgroundImage': self.context.get('background_image', ''),
-                    'salesTone': self.context.get('sales_tone', 'friendly'),
-                    'agentType': self.context.get('agent_type', 'eCommerce')
-                }
+                'context': reply_context(self.context, [])
             }
 
+    def run_command(self, event: str) -> Dict[str, Any]:
+        """Apply a pure transition such as publish without calling the model"""
+        with timed('command'):
+            moved, ai_response = builder_states.apply_command(self.context, event)
+        
+        self.context['conversation_history'].append({
+            'role': 'assistant',
+            'content': ai_response,
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        self.save_context()
+        return {
+            'success': True,
+            'response': ai_response,
+            'context': reply_context(self.context, []),
+            'updated_fields': {},
+            'transition': event if moved else None,
+            'version': self.context['version']
+        }
+
+    def import_catalog(self, user_message: str) -> Dict[str, Any]:
+        """Extract a pasted catalog in parallel chunks and apply the products in one update"""
+        products, stats = self.extract_catalog(user_message)
+        return self.apply_catalog(products, stats)
+    
+    def extract_catalog(self, text: str, on_progress=None):
+        """Products in a pasted catalog and the extraction stats; reads nothing the lock guards"""
+        model = usage_tracker.model_for(self.user_id, CLAUDE_MODEL)
+        
+        def complete(system: str, text: str, max_tokens: int) -> str:
+            started = time.perf_counter()
+            response = claude.create(
+                'catalog',
+                on_discarded=lambda extra: usage_tracker.record(
+                    extra, model, time.perf_counter() - started, 'catalog',
+                    user_id=self.user_id, agent_id=self.agent_id, state=self.context.get('state')
+                ),
+                model=model,
+                max_tokens=max_tokens,
+                temperature=0,
+                messages=[{"role": "user", "content": text}],
+                system=system
+            )
+            usage_tracker.record(
+                response, model, time.perf_counter() - started, 'catalog',
+                user_id=self.user_id, agent_id=self.agent_id, state=self.context.get('state')
+            )
+            return response.content[0].text
+        
+        with timed('catalog', model=model):
+            return catalog.extract_products(text, complete, user_id=self.user_id, on_progress=on_progress)
+    
+    def apply_catalog(self, products: List[Dict[str, Any]], stats: Dict[str, Any]) -> Dict[str, Any]:
+        """Merge extracted products into the agent and save, with a reply saying what changed"""
+        added, updated = [], []
+        if products:
+            self.context['products'], added, updated = catalog.merge_changes(self.context.get('products'), products)
+            ai_response = f"Added {len(products)} products from your catalog."
+            if stats['failed_chunks']:
+                ai_response += " Some lines couldn't be read; paste them again to retry."
+        else:
+            ai_response = "I couldn't find any products with prices in that. Try one per line, like 'Green Tea $25'."
+        
+        self.context['conversation_history'].append({
+            'role': 'assistant',
+            'content': ai_response,
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        self.save_context()
+        return {
+            'success': True,
+            'response': ai_response,
+            'context': reply_context(self.context, added, updated),
+            'updated_fields': {'products': self.context['products']} if products else {},
+            'catalog': stats,
+            'version': self.context['version']
+        }
+
 builders = {}
+# agent_id -> the cached builder editing it, kept in step with builders
+agent_builders = {}
+builder_loads = SingleFlight()
+prefetch_pool = ThreadPoolExecutor(max_workers=int(os.getenv('PREFETCH_WORKERS', 4)))
+
+def _load_builder(user_id: str) -> AgentBuilder:
+    builder = builders.get(user_id)
+    if builder is None:
+        restored = restored_sessions.pop(user_id, None)
+        state = json.loads(restored) if restored else None
+        builder = cache_builder(AgentBuilder(user_id, state=state))
+    return builder
+
+def cache_builder(builder: AgentBuilder) -> AgentBuilder:
+    builders[builder.user_id] = builder
+    agent_builders[builder.agent_id] = builder
+    return builder
+
+def drop_builder(user_id: str):
+    builder = builders.pop(user_id, None)
+    if builder is not None and agent_builders.get(builder.agent_id) is builder:
+        agent_builders.pop(builder.agent_id, None)
+
+def get_builder(user_id: str) -> AgentBuilder:
+    """Return the cached builder for a user, loading it on first use
+
+    Concurrent misses for the same user share a single load, so the studio's
+    simultaneous context GET and first chat don't query or create twice.
+    """
+    builder = builders.get(user_id)
+    if builder is not None and builder.stale:
+        # Another writer moved the stored version on; reload rather than keep diverging
+        drop_builder(user_id)
+        builder = None
+    metrics.record_cache('builders', builder is not None)
+    if builder is None:
+        builder, shared = builder_loads.do(user_id, lambda: _load_builder(user_id))
+        if shared:
+            metrics.record_cache('builder_loads', True)
+    builder.last_used = time.monotonic()
+    return builder
+
+def prefetch_builder(user_id: str):
+    """Warm a user's session, the Claude client and the prompt before the first message"""
+    try:
+        builder = get_builder(user_id)
+        clients.get_claude()
+        render_builder_prompt(builder.context)
+    except Exception as e:
+        print(f"Error prefetching builder: {e}")
+
+def snapshot_sessions():
+    """State of the most recently used builders, for the session snapshot"""
+    hot = sorted(list(builders.values()), key=lambda b: b.last_used, reverse=True)
+    budget = session_store.SNAPSHOT_MAX_SESSIONS
+    for builder in hot[:budget]:
+        # Skip a builder stuck in a long turn rather than stall the snapshot;
+        # its last save is in the WAL anyway
+        if not builder.lock.acquire(timeout=1):
+            continue
+        try:
+            # Serialized by the caller while the lock is still held
+            yield builder.user_id, builder.snapshot_state()
+        finally:
+            builder.lock.release()
+    # Restored sessions nobody has touched yet are carried over as they are
+    for user_id, state in list(restored_sessions.items())[:max(0, budget - len(hot))]:
+        yield user_id, state
+
+def replay_write(record: Dict[str, Any]) -> bool:
+    """Send one pending WAL write to Supabase; raises while it is still unreachable
+
+    A write whose base version was superseded is dropped (and counted), losing
+    that acknowledged turn rather than overwriting the newer row.
+    """
+    builder = builders.get(record['user_id'])
+    if builder is not None and builder.agent_id == record['agent_id']:
+        # A live session writes its current state, which includes the record
+        with builder.lock:
+            if builder.save_context():
+                return True
+            if builder.stale:
+                session_store.wal_dropped_total.inc()
+            return builder.stale
+    
+    rows = write_agent_row(record['data'], record['base_version'])
+    if not rows:
+        print(f"Dropping WAL write for agent {record['agent_id']}: version {record['base_version']} was superseded")
+        metrics.record_error('stale_version')
+        session_store.wal_dropped_total.inc()
+    sessions.wal.ack(record['agent_id'], record['seq'])
+    return True
+
+def restore_sessions() -> int:
+    """Load the last snapshot and apply unacknowledged WAL writes so the process starts warm"""
+    started = time.perf_counter()
+    # Parsed on first use in _load_builder, which still skips the Supabase query
+    restored_sessions.update(sessions.load_snapshot())
+    for record in sessions.wal.pending_records():
+        restored_sessions.pop(record['user_id'], None)
+        cache_builder(AgentBuilder(record['user_id'], state={
+            'agent_id': record['agent_id'],
+            'stored_version': record['base_version'],
+            'context': context_from_row(record['data'])
+        }))
+    clients.record_startup('restore_sessions_ms', started)
+    return len(restored_sessions) + len(builders)
+
+def live_products(agent_id: str):
+    """(version, products) from the cached session editing an agent, if one is"""
+    builder = agent_builders.get(agent_id)
+    if builder is None:
+        return None
+    # Version first: a save landing in between re-syncs on the next query
+    # instead of leaving new products filed under the old version
+    version = builder.context.get('version', 0)
+    return version, builder.context.get('products') or []
+
+def stored_products(agent_id: str):
+    """(version, products) from an agent's stored row, for agents without a session here"""
+    result = get_supabase().table('agents').select('products,version').eq('id', agent_id).limit(1).execute()
+    if not result.data:
+        return None
+    return result.data[0].get('version') or 0, result.data[0].get('products') or []
+
+catalog_index.init_app(app, live_products, stored_products)
+
+# agent_id -> (owner user_id or None, expiry), so storefront chat bills the agent's owner
+agent_owners = OrderedDict()
+agent_owners_lock = threading.Lock()
+AGENT_OWNER_TTL = float(os.getenv('AGENT_OWNER_TTL', 300))
+AGENT_OWNER_MAX = int(os.getenv('AGENT_OWNER_MAX', 10000))
+
+def agent_owner(agent_id: Any) -> Optional[str]:
+    """The user owning a stored agent, the tenant its storefront usage counts against"""
+    try:
+        agent_id = str(uuid.UUID(str(agent_id)))
+    except ValueError:
+        return None
+    now = time.monotonic()
+    with agent_owners_lock:
+        cached = agent_owners.get(agent_id)
+        if cached and cached[1] > now:
+            return cached[0]
+    try:
+        result = get_supabase().table('agents').select('user_id').eq('id', agent_id).limit(1).execute()
+    except Exception as e:
+        print(f"Error loading agent owner: {e}")
+        metrics.record_error('agent_owner')
+        return None
+    owner = result.data[0].get('user_id') if result.data else None
+    with agent_owners_lock:
+        agent_owners[agent_id] = (owner, now + AGENT_OWNER_TTL)
+        agent_owners.move_to_end(agent_id)
+        while len(agent_owners) > AGENT_OWNER_MAX:
+            agent_owners.popitem(last=False)
+    return owner
+
+def version_conflict(builder: AgentBuilder, data: Dict[str, Any]):
+    """409 response if the client asked to write over a version that is no longer current"""
+    expected = data.get('expected_version')
+    if expected is None and request.if_match and not request.if_match.star_tag:
+        etags = list(request.if_match.as_set())
+        if etags and ':' in etags[0]:
+            expected = etags[0].rsplit(':', 1)[1]
+    if expected is None:
+        return None
+    current = builder.context.get('version', 0)
+    if str(expected) == str(current):
+        return None
+    return jsonify({'error': 'Stale version', 'version': current}), 409
+
+def stale_response():
+    """409 for a turn whose save lost to a write from elsewhere; the next request reloads"""
+    return jsonify({'error': 'Agent was updated elsewhere, please retry'}), 409
+
+def parse_base_version(data: Dict[str, Any]):
+    """The client's base_version as an int, None if absent; raises ValueError if it isn't one"""
+    base_version = data.get('base_version')
+    if base_version is None:
+        return None
+    if isinstance(base_version, bool) or not str(base_version).isdigit():
+        raise ValueError(base_version)
+    return int(base_version)
+
+def with_delta(builder: AgentBuilder, result: Dict[str, Any], base_version: Optional[int]) -> Dict[str, Any]:
+    """Swap the full context for a JSON-Patch when the client sent a base version we still hold
+
+    Patches are between public_context documents, as served by the context GET,
+    not between chat replies (whose context lists only the products just
+    changed). A client keeps the GET document, applies each patch to it, and
+    sends its version as the next base.
+    """
+    if base_version is None or not result.get('success'):
+        return result
+    patch = builder.delta_since(base_version)
+    if patch is None:
+        return result
+    result = dict(result)
+    del result['context']
+    result['base_version'] = base_version
+    result['patch'] = patch
+    return result
+
+@app.errorhandler(AgentUnavailable)
+def agent_unavailable(error):
+    return jsonify({'error': 'Could not load your agent, please try again'}), 503
 
 @app.route('/api/builder/chat', methods=['POST'])
+@idempotent
 def builder_chat():
     data = request.json
     user_id = data.get('user_id')
@@ -276,16 +717,27 @@ def builder_chat():
     
     if not user_id or not message:
         return jsonify({'error': 'Missing user_id or message'}), 400
+    try:
+        base_version = parse_base_version(data)
+    except ValueError:
+        return jsonify({'error': 'base_version must be a version number'}), 400
+    if usage_tracker.over_budget(user_id):
+        return jsonify({'error': 'Usage budget exceeded'}), 429
     
-    if user_id not in builders:
-        builders[user_id] = AgentBuilder(user_id)
-    
-    builder = builders[user_id]
-    result = builder.process_message(message)
+    builder = get_builder(user_id)
+    with builder.lock:
+        conflict = version_conflict(builder, data)
+        if conflict:
+            return conflict
+        result = builder.process_message(message)
+        if builder.stale:
+            return stale_response()
+        result = with_delta(builder, result, base_version)
     
-    return jsonify(result)
+    return json_response(result)
 
 @app.route('/api/builder/reset', methods=['POST'])
+@idempotent
 def reset_builder():
     data = request.json
     user_id = data.get('user_id')
@@ -293,113 +745,290 @@ def reset_builder():
     if not user_id:
         return jsonify({'error': 'Missing user_id'}), 400
     
-    builders[user_id] = AgentBuilder(user_id)
-    builders[user_id].context = {
-        'state': 'start',
-        'brand_name': '',
-        'hero_header': '',
-        'hero_subheader': '',
-        'hero_color': '#171717',
-        'hero_text_size': 'text-6xl',
-        'subheader_color': '#525252',
-        'subheader_text_size': 'text-xl',
-        'products': [],
-        'product_pills': [],
-        'background_image': '',
-        'sales_tone': 'friendly',
-        'agent_type': 'eCommerce',
-        'conversation_history': []
-
-    }
-    builders[user_id].save_context()
+    builder = get_builder(user_id)
+    with builder.lock:
+        conflict = version_conflict(builder, data)
+        if conflict:
+            return conflict
+        builder.context = dict(default_context(), version=builder.context.get('version', 0))
+        builder.save_context()
+        if builder.stale:
+            return stale_response()
     
-    return jsonify({'success': True, 'message': 'Builder reset successfully'})
+    return jsonify({
+        'success': True,
+        'message': 'Builder reset successfully',
+        'version': builder.context['version']
+    })
     
 
 @app.route('/api/builder/context/<user_id>', methods=['GET'])
 def get_context(user_id):
-    if user_id not in builders:
-        builders[user_id] = AgentBuilder(user_id)
+    builder = get_builder(user_id)
+    # The first chat message usually follows right away
+    prefetch_pool.submit(prefetch_builder, user_id)
     
-    ctx = builders[user_id].context
-    return jsonify({
-        'context': {
-            'brandName': ctx.get('brand_name', ''),
-            'heroHeader': ctx.get('hero_header', ''),
-            'heroSubheader': ctx.get('hero_subheader', ''),
-            'heroColor': ctx.get('hero_color', '#171717'),
-            'heroTextSize': ctx.get('hero_text_size', 'text-6xl'),
-            'heroWeight': ctx.get('hero_weight', 'font-normal'),
-            'subheaderColor': ctx.get('subheader_color', '#525252'),
-            'subheaderTextSize': ctx.get('subheader_text_size', 'text-xl'),
-            'subheaderWeight': ctx.get('subheader_weight', 'font-normal'),
-            'products': ctx.get('products', []),
-            'productPills': ctx.get('product_pills', []),
-            'backgroundImage': ctx.get('background_image', ''),
-            'salesTone': ctx.get('sales_tone', 'friendly')
+    etag = context_etag(builder.agent_id, builder.context.get('version', 0))
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    response = json_response({
+        'context': public_context(builder.context),
+        'version': builder.context.get('version', 0)
+    })
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/builder/history/<user_id>', methods=['GET'])
+def builder_history(user_id):
+    builder = get_builder(user_id)
+    with builder.lock:
+        total = builder.context.get('history_offset', 0) + len(builder.context.get('conversation_history', []))
+        try:
+            before = min(int(request.args.get('before', total)), total)
+            limit = max(1, min(int(request.args.get('limit', 50)), HISTORY_PAGE_MAX))
+        except ValueError:
+            return jsonify({'error': 'before and limit must be integers'}), 400
+        try:
+            turns = builder.history_page(before, limit)
+        except Exception as e:
+            print(f"Error loading history page: {e}")
+            return jsonify({'error': 'Could not load history'}), 502
+    
+    start = max(0, before - limit)
+    return json_response({
+        'turns': turns,
+        'start': start,
+        'total': total,
+        'next_before': start or None
+    })
+
+@app.route('/api/builder/catalog/progress/<user_id>', methods=['GET'])
+def catalog_progress(user_id):
+    state = catalog.get_progress(user_id)
+    if state is None:
+        return jsonify({'error': 'No catalog import for this user'}), 404
+    return jsonify(state)
+
+def save_products(user_id: str, apply) -> Dict[str, Any]:
+    """Run apply(builder) under the lock and save, reloading once if the save loses to another writer"""
+    for _ in range(2):
+        builder = get_builder(user_id)
+        with builder.lock:
+            result = apply(builder)
+            if not builder.stale:
+                return result
+    raise RuntimeError('Agent kept changing elsewhere; products not saved')
+
+def run_catalog_import(job: jobs.JobContext) -> Dict[str, Any]:
+    """Extract a pasted catalog outside any request and merge it into the agent"""
+    user_id = job.payload['user_id']
+    # Checked again on every attempt: the budget may have run out while the job waited
+    if usage_tracker.over_budget(user_id):
+        raise jobs.JobFailed('Usage budget exceeded')
+    products, stats = get_builder(user_id).extract_catalog(job.payload['text'], on_progress=job.progress)
+    job.check()
+    
+    def apply(builder: AgentBuilder):
+        result = builder.apply_catalog(products, stats)
+        return {'response': result['response'], 'catalog': stats, 'version': result['version']}
+    return save_products(user_id, apply)
+
+def run_products_import(job: jobs.JobContext) -> Dict[str, Any]:
+    """Normalize a product list in batches, then merge it into the agent in one save"""
+    raw = job.payload['products']
+    products = []
+    for start in range(0, len(raw), PRODUCT_IMPORT_BATCH):
+        products.extend(catalog.normalize_products(raw[start:start + PRODUCT_IMPORT_BATCH]))
+        job.progress(done=min(start + PRODUCT_IMPORT_BATCH, len(raw)), total=len(raw), products=len(products))
+    if not products:
+        raise jobs.JobFailed('No products with a name in the import')
+    
+    def apply(builder: AgentBuilder):
+        builder.context['products'] = catalog.merge_products(builder.context.get('products'), products)
+        builder.save_context()
+        return {
+            'imported': len(products),
+            'skipped': len(raw) - len(products),
+            'total_products': len(builder.context['products']),
+            'version': builder.context['version']
         }
+    return save_products(job.payload['user_id'], apply)
+
+job_queue = jobs.JobQueue()
+# Both go through the cached sessions, so they run on the worker threads rather
+# than in a process pool. That doesn't pin a job to the worker that enqueued it:
+# every process sharing JOBS_DB registers these kinds and may claim it, loading
+# the agent into its own cache. save_products reloads if that copy was stale.
+job_queue.register('catalog_import', run_catalog_import, threads_only=True)
+job_queue.register('products_import', run_products_import, threads_only=True)
+jobs.init_app(app, job_queue)
+
+def job_accepted(job: Dict[str, Any]):
+    """202 pointing at the job's status and events routes"""
+    status_url = f"/api/jobs/{job['id']}"
+    response = jsonify({
+        'job': jobs.public_job(job),
+        'status_url': status_url,
+        'events_url': f"{status_url}/events"
     })
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+@app.route('/api/builder/catalog/import', methods=['POST'])
+@idempotent
+def import_catalog_job():
+    data = request.json or {}
+    user_id = data.get('user_id')
+    text = data.get('text')
+    if not user_id or not isinstance(text, str) or not text.strip():
+        return jsonify({'error': 'user_id and text required'}), 400
+    if usage_tracker.over_budget(user_id):
+        return jsonify({'error': 'Usage budget exceeded'}), 429
+    return job_accepted(job_queue.enqueue('catalog_import', {'user_id': user_id, 'text': text}, user_id=user_id))
+
+@app.route('/api/builder/products/import', methods=['POST'])
+@idempotent
+def import_products_job():
+    data = request.json or {}
+    user_id = data.get('user_id')
+    products = data.get('products')
+    if not user_id or not isinstance(products, list) or not products:
+        return jsonify({'error': 'user_id and a non-empty products list required'}), 400
+    if len(products) > PRODUCT_IMPORT_MAX:
+        return jsonify({'error': f"At most {PRODUCT_IMPORT_MAX} products per import"}), 413
+    return job_accepted(job_queue.enqueue('products_import', {'user_id': user_id, 'products': products},
+                                          user_id=user_id))
+
+@app.route('/api/builder/prefetch', methods=['POST'])
+def prefetch():
+    data = request.json or {}
+    user_id = data.get('user_id')
+    
+    if not user_id:
+        return jsonify({'error': 'Missing user_id'}), 400
+    
+    prefetch_pool.submit(prefetch_builder, user_id)
+    return jsonify({'success': True}), 202
 
 @app.route('/api/builder/process', methods=['POST'])
+@idempotent
 def process_builder():
     data = request.json
     state = data.get('state', 'idle')
     message = data.get('message')
     user_id = data.get('user_id')
     
-    if user_id not in builders:
-        builders[user_id] = AgentBuilder(user_id)
-    
-    result = builders[user_id].process_message(message)
-    
-    # Update cached context from frontend
-    if data.get("context"):
-        builders[user_id].context["products"] = data["context"].get("products", [])
-        builders[user_id].context["product_pills"] = data["context"].get("productPills", [])
+    if usage_tracker.over_budget(user_id):
+        return jsonify({'error': 'Usage budget exceeded'}), 429
     
+    builder = get_builder(user_id)
+    with builder.lock:
+        conflict = version_conflict(builder, data)
+        if conflict:
+            return conflict
+        # Update cached context from frontend, before the turn so its save
+        # carries them under a new version
+        changed = False
+        if data.get("context"):
+            products = data["context"].get("products", [])
+            pills = data["context"].get("productPills", [])
+            changed = products != builder.context.get("products") or pills != builder.context.get("product_pills")
+            builder.context["products"] = products
+            builder.context["product_pills"] = pills
+        result = builder.process_message(message)
+        if changed and not result.get('success'):
+            # A failed turn saves nothing; the frontend's products still need a version
+            builder.save_context()
+        if builder.stale:
+            return stale_response()
     
-    state_map = {
-        'idle': 'START',
-        'intake': 'SUBMIT', 
-        'clarify': 'ANSWER',
-        'generate': 'DONE',
-        'preview': 'SAVE'
-    }
     
-    return jsonify({
+    return json_response({
         'response': result['response'],
-        'transition': state_map.get(state, 'START'),
+        # The studio event that moves its machine to the server's state, if any
+        'transition': builder_states.event_between(state, builder.context['state']),
         'updates': result.get('context', {}),
-        'context': result.get('context', {})
+        'context': result.get('context', {}),
+        'version': builder.context.get('version', 0)
     })
 
 @app.route('/api/chat', methods=['POST'])
+@idempotent
 def chat():
     data = request.json
     user_message = data.get('message')
     agent_data = data.get('agentData', {})
     
-    products_str = ', '.join([
-        f"{p['name']} ${p['price']}" 
-        for p in agent_data.get('products', [])
-    ])
+    with timed('prompt'):
+        system_prompt = render_storefront_prompt(agent_data)
     
-    system_prompt = f"""You are a sales assistant for {agent_data.get('brandName', 'this store')}. 
-Products available: {products_str}
-Tone: {agent_data.get('salesTone', 'friendly')}
-Help customers find products and make purchases."""
+    # From the stored agent, not the request, so a client can't pick whose budget it spends
+    tenant_id = agent_owner(agent_data.get('id'))
+    if usage_tracker.over_budget(tenant_id):
+        return jsonify({'response': "I'm having trouble right now. Please try again."}), 429
     
     try:
-        response = claude_client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=1000,
-            messages=[{"role": "user", "content": user_message}],
-            system=system_prompt
+        model = usage_tracker.model_for(tenant_id, CLAUDE_MODEL)
+        started = time.perf_counter()
+        with timed('claude', model=model):
+            response = claude.create(
+                'chat',
+                # A hedged copy that lost the race was still billed
+                on_discarded=lambda extra: usage_tracker.record(
+                    extra, model, time.perf_counter() - started, 'chat',
+                    user_id=tenant_id, agent_id=agent_data.get('id')
+                ),
+                model=model,
+                max_tokens=1000,
+                messages=[{"role": "user", "content": user_message}],
+                system=system_prompt
+            )
+        usage_tracker.record(
+            response, model, time.perf_counter() - started, 'chat',
+            user_id=tenant_id, agent_id=agent_data.get('id')
         )
         
         return jsonify({'response': response.content[0].text})
+    except UpstreamUnavailable:
+        return jsonify({'response': "I'm having trouble right now. Please try again."}), 503
     except Exception as e:
         return jsonify({'response': "I'm having trouble right now. Please try again."}), 500
 
+@app.route('/healthz/warm', methods=['GET', 'POST'])
+def warm():
+    """Build clients, open upstream connections and render prompts before traffic arrives"""
+    checks = clients.warm()
+    started = time.perf_counter()
+    render_builder_prompt(default_context())
+    render_storefront_prompt({'brandName': 'warmup', 'products': [{'name': 'warmup', 'price': 0}]})
+    checks['prompts'] = {'ok': True, 'ms': round((time.perf_counter() - started) * 1000, 2)}
+    
+    ready = all(check['ok'] for check in checks.values())
+    return jsonify({
+        'ready': ready,
+        'checks': checks,
+        'startup': clients.startup_report()
+    }), 200 if ready else 503
+
+if sessions:
+    restore_sessions()
+    sessions.start(snapshot_sessions, replay_write)
+
+def start_workers():
+    """Start this process's job workers, once it is serving (e.g. from a gunicorn post_fork hook)
+
+    Importing the app doesn't start them. An enqueue starts them anyway, so a
+    process that was never told to still runs the jobs it accepts.
+    """
+    job_queue.start()
+
+clients.record_startup('import_app_ms', clients.PROCESS_STARTED)
+logging.getLogger('startup').info(json.dumps(clients.startup_report()))
+
 if __name__ == '__main__':
+    start_workers()
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
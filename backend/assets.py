@@ -0,0 +1,400 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import quote, urljoin, urlparse
+
+from flask import jsonify, redirect, request, send_file
+
+from singleflight import SingleFlight
+
+ASSET_DIR = os.getenv('ASSET_DIR', os.path.join(os.path.dirname(__file__), 'asset_cache'))
+ASSET_CACHE_MAX_BYTES = int(os.getenv('ASSET_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+ASSET_MAX_SOURCE_BYTES = int(os.getenv('ASSET_MAX_SOURCE_BYTES', 15 * 1024 * 1024))
+ASSET_FETCH_TIMEOUT = float(os.getenv('ASSET_FETCH_TIMEOUT', 10))
+# Whole download, redirects included; ASSET_FETCH_TIMEOUT bounds each wait on the socket
+ASSET_FETCH_DEADLINE = float(os.getenv('ASSET_FETCH_DEADLINE', 30))
+# Uploads and uncached URL fetches a client address may start per minute; 0 turns the limit off
+ASSET_RATE_PER_MINUTE = float(os.getenv('ASSET_RATE_PER_MINUTE', 30))
+ASSET_RATE_BURST = int(os.getenv('ASSET_RATE_BURST', 20))
+ASSET_ALLOWED_HOSTS = {h.strip() for h in os.getenv('ASSET_ALLOWED_HOSTS', '').split(',') if h.strip()}
+ASSET_ALLOW_PRIVATE = os.getenv('ASSET_ALLOW_PRIVATE', '') == '1'
+ASSET_MAX_REDIRECTS = int(os.getenv('ASSET_MAX_REDIRECTS', 3))
+# Remote URLs remembered with their digest, so repeat fetches skip the download
+ASSET_URL_INDEX_MAX = int(os.getenv('ASSET_URL_INDEX_MAX', 10000))
+ASSET_FORMAT = os.getenv('ASSET_FORMAT', 'WEBP').upper()
+# Absolute URL the frontend reaches this backend on. Context image rewriting
+# is off until it is set, since the studio runs on a different origin.
+ASSET_PUBLIC_BASE = os.getenv('ASSET_PUBLIC_BASE', '').rstrip('/')
+
+# name -> (width, height, crop to fill)
+VARIANTS = {
+    'thumb': (160, 160, True),
+    'card': (480, 480, False),
+    'hero': (1600, 1600, False),
+}
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class AssetError(Exception):
+    pass
+
+
+class RateLimiter:
+    """Token bucket per client key, keeping the most recently seen keys"""
+
+    def __init__(self, per_minute: float = ASSET_RATE_PER_MINUTE, burst: int = ASSET_RATE_BURST,
+                 max_keys: int = 10000):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, last refill)
+        self.lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return allowed
+
+
+class AssetCache:
+    """Content-addressed image store with on-demand variants and LRU eviction by size"""
+
+    def __init__(self, root: str = ASSET_DIR, max_bytes: int = ASSET_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()  # path -> size, least recently used first
+        self.total = 0
+        self.url_index: OrderedDict = OrderedDict()  # url -> digest, least recently used first
+        self.lock = threading.Lock()
+        self.flights = SingleFlight()
+        os.makedirs(self.root, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                entries.append((stat.st_atime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self.files[path] = size
+            self.total += size
+
+    def _path(self, digest: str, name: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}-{name}")
+
+    def _touch(self, path: str):
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.total += len(data) - self.files.pop(path, 0)
+            self.files[path] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.total > self.max_bytes and len(self.files) > 1:
+            path, size = self.files.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def put(self, data: bytes) -> str:
+        """Store an original image and return its content digest"""
+        if len(data) > ASSET_MAX_SOURCE_BYTES:
+            raise AssetError('Image too large')
+        from PIL import Image
+
+        try:
+            Image.open(io.BytesIO(data)).verify()
+        except Exception:
+            raise AssetError('Not a supported image')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest, 'orig')
+        if os.path.exists(path):
+            self._touch(path)
+        else:
+            self._write(path, data)
+        return digest
+
+    def cached_digest(self, url: str) -> Optional[str]:
+        """Digest of a URL already fetched and still stored, without fetching"""
+        with self.lock:
+            digest = self.url_index.get(url)
+            if digest:
+                self.url_index.move_to_end(url)
+        if digest and os.path.exists(self._path(digest, 'orig')):
+            return digest
+        return None
+
+    def ingest_url(self, url: str) -> str:
+        """Fetch a remote image once and return its digest"""
+        digest = self.cached_digest(url)
+        if digest:
+            return digest
+        digest, _ = self.flights.do(('url', url), lambda: self.put(fetch(url)))
+        with self.lock:
+            self.url_index[url] = digest
+            self.url_index.move_to_end(url)
+            while len(self.url_index) > ASSET_URL_INDEX_MAX:
+                self.url_index.popitem(last=False)
+        return digest
+
+    def read_variant(self, digest: str, name: str) -> bytes:
+        """A variant's bytes, rendering it again if it is evicted before it can be read"""
+        for attempt in range(2):
+            try:
+                with open(self.variant(digest, name), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+    def variant(self, digest: str, name: str) -> str:
+        """Path of a sized variant, rendering it from the original on first request"""
+        if name not in VARIANTS:
+            raise AssetError('Unknown variant')
+        path = self._path(digest, name)
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+        original = self._path(digest, 'orig')
+        if not os.path.exists(original):
+            raise FileNotFoundError(digest)
+        self._touch(original)
+        self.flights.do((digest, name), lambda: self._write(path, render(original, name)))
+        return path
+
+
+def render(original: str, name: str) -> bytes:
+    from PIL import Image, ImageOps
+
+    width, height, crop = VARIANTS[name]
+    with Image.open(original) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') and ASSET_FORMAT != 'JPEG' else 'RGB')
+        if crop:
+            image = ImageOps.fit(image, (width, height))
+        else:
+            image.thumbnail((width, height))
+        out = io.BytesIO()
+        image.save(out, ASSET_FORMAT, quality=80)
+    return out.getvalue()
+
+
+def _public(address: str) -> bool:
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_url(url: str) -> Tuple[Any, str]:
+    """The parsed URL and the address to connect to, once the host passes the allow rules"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise AssetError('Only http(s) image URLs are supported')
+    if ASSET_ALLOWED_HOSTS and parsed.hostname not in ASSET_ALLOWED_HOSTS:
+        raise AssetError('Host not allowed')
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(parsed.hostname, parsed.port, type=socket.SOCK_STREAM)]
+    except (socket.gaierror, ValueError):
+        raise AssetError('Host not found')
+    if not ASSET_ALLOW_PRIVATE and not all(_public(address) for address in addresses):
+        raise AssetError('Host not allowed')
+    return parsed, addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """Connects to the address check_url resolved, so DNS can't change between check and fetch"""
+
+    def __init__(self, host: str, address: str, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(_PinnedHTTPConnection):
+    default_port = http.client.HTTPS_PORT
+
+    def connect(self):
+        super().connect()
+        self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=self.host)
+
+
+def _remaining(deadline: float) -> float:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise AssetError('Image download took too long')
+    return min(ASSET_FETCH_TIMEOUT, remaining)
+
+
+def fetch(url: str) -> bytes:
+    """Download an image within ASSET_FETCH_DEADLINE, checking every redirect hop against the allow rules"""
+    deadline = time.monotonic() + ASSET_FETCH_DEADLINE
+    for _ in range(ASSET_MAX_REDIRECTS + 1):
+        parsed, address = check_url(url)
+        connection_class = _PinnedHTTPSConnection if parsed.scheme == 'https' else _PinnedHTTPConnection
+        conn = connection_class(parsed.hostname, address, port=parsed.port, timeout=_remaining(deadline))
+        try:
+            path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+            conn.request('GET', path, headers={'User-Agent': 'asset-proxy/1.0'})
+            # The response keeps reading from this socket even once conn lets go of it
+            sock = conn.sock
+            response = conn.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                if not location:
+                    raise AssetError('Redirect without a location')
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise ConnectionError(f"Image host returned {response.status}")
+            # read1 returns after one recv, so a server trickling bytes can't outlast the deadline
+            data = b''
+            while len(data) <= ASSET_MAX_SOURCE_BYTES:
+                sock.settimeout(_remaining(deadline))
+                chunk = response.read1(min(65536, ASSET_MAX_SOURCE_BYTES + 1 - len(data)))
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            conn.close()
+        if len(data) > ASSET_MAX_SOURCE_BYTES:
+            raise AssetError('Image too large')
+        return data
+    raise AssetError('Too many redirects')
+
+
+def proxied_url(url: Any, variant: str) -> Any:
+    """Rewrite a remote image URL to its cached variant, leaving anything else alone"""
+    if not ASSET_PUBLIC_BASE or not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        return url
+    if url.startswith(ASSET_PUBLIC_BASE):
+        return url
+    return f"{ASSET_PUBLIC_BASE}/api/assets/fetch?variant={variant}&url={quote(url, safe='')}"
+
+
+def proxy_context_images(context: Dict[str, Any]) -> Dict[str, Any]:
+    """Point product, pill and background images of a camelCase context at sized variants"""
+    if not ASSET_PUBLIC_BASE:
+        return context
+    context = dict(context)
+    context['products'] = [
+        dict(p, image=proxied_url(p.get('image'), 'card')) if isinstance(p, dict) else p
+        for p in context.get('products') or []
+    ]
+    context['productPills'] = [
+        dict(p, image=proxied_url(p.get('image'), 'thumb')) if isinstance(p, dict) else p
+        for p in context.get('productPills') or []
+    ]
+    context['backgroundImage'] = proxied_url(context.get('backgroundImage'), 'hero')
+    return context
+
+
+def variant_urls(digest: str) -> Dict[str, str]:
+    return {name: f"{ASSET_PUBLIC_BASE}/api/assets/{digest}/{name}" for name in VARIANTS}
+
+
+def init_app(app, cache: Optional[AssetCache] = None):
+    """Register /api/assets upload, fetch and serve routes
+
+    Fetch is loaded by <img> tags and upload by the studio, neither with
+    credentials, so both are rate limited per client address instead; cached
+    URLs and the digest route don't count.
+    """
+    cache = cache or AssetCache()
+    limiter = RateLimiter()
+
+    def rate_limited():
+        return jsonify({'error': 'Too many image requests, try again shortly'}), 429
+
+    @app.route('/api/assets', methods=['POST'])
+    def upload_asset():
+        if not limiter.allow(request.remote_addr or ''):
+            return rate_limited()
+        try:
+            if 'file' in request.files:
+                digest = cache.put(request.files['file'].read(ASSET_MAX_SOURCE_BYTES + 1))
+            else:
+                url = (request.get_json(silent=True) or {}).get('url')
+                if not url:
+                    return jsonify({'error': 'Missing file or url'}), 400
+                digest = cache.ingest_url(url)
+        except AssetError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            print(f"Error ingesting asset: {e}")
+            return jsonify({'error': 'Could not fetch image'}), 502
+        return jsonify({'id': digest, 'variants': variant_urls(digest)}), 201
+
+    @app.route('/api/assets/fetch', methods=['GET'])
+    def fetch_asset():
+        url = request.args.get('url')
+        name = request.args.get('variant', 'card')
+        if not url or name not in VARIANTS:
+            return jsonify({'error': 'Missing url or unknown variant'}), 400
+        if not cache.cached_digest(url) and not limiter.allow(request.remote_addr or ''):
+            return rate_limited()
+        try:
+            digest = cache.ingest_url(url)
+        except AssetError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            print(f"Error fetching asset: {e}")
+            return jsonify({'error': 'Could not fetch image'}), 502
+        response = redirect(f"/api/assets/{digest}/{name}", code=302)
+        # The URL's content could change upstream, so only the digest route is immutable
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+        return response
+
+    @app.route('/api/assets/<digest>/<name>', methods=['GET'])
+    def serve_asset(digest, name):
+        if len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+            return jsonify({'error': 'Not found'}), 404
+        try:
+            # Read now: the file could be evicted before send_file opened it
+            data = cache.read_variant(digest, name)
+        except AssetError as e:
+            return jsonify({'error': str(e)}), 400
+        except FileNotFoundError:
+            return jsonify({'error': 'Not found'}), 404
+        response = send_file(io.BytesIO(data), mimetype=f"image/{ASSET_FORMAT.lower()}", etag=f"{digest}-{name}",
+                             conditional=True, max_age=31536000)
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+    return cache
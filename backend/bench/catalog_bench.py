@@ -0,0 +1,82 @@
+"""Benchmark extracting a large pasted catalog: one model call vs parallel chunks.
+
+    cd backend && python -m bench.catalog_bench --items 500 --latency fixed:0.4 --token-latency 0.002
+
+Runs against the fake Anthropic server, whose replies take longer the more
+tokens they generate and stop at max_tokens like the real API.
+"""
+import argparse
+import os
+import random
+import time
+
+from bench.fake_anthropic import start_fake_anthropic
+
+ADJECTIVES = ['Green', 'Black', 'Smoky', 'Jasmine', 'Golden', 'Iced', 'Spiced', 'Wild', 'Royal', 'Mountain']
+NOUNS = ['Tea', 'Oolong', 'Matcha', 'Chai', 'Rooibos', 'Sencha', 'Pu-erh', 'Blend', 'Tisane', 'Herbal']
+
+
+def make_paste(items: int, style: str = 'mixed') -> str:
+    entries = [f"{random.choice(ADJECTIVES)} {random.choice(NOUNS)} No. {i} ${random.randint(5, 80)}"
+               for i in range(items)]
+    if style == 'lines':
+        return '\n'.join(f"- {e}" for e in entries)
+    if style == 'inline':
+        return ', '.join(entries)
+    # Merchants mix both: comma separated runs broken up by newlines
+    return '\n'.join(', '.join(entries[i:i + 7]) for i in range(0, len(entries), 7))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--style', choices=('mixed', 'lines', 'inline'), default='mixed')
+    parser.add_argument('--latency', default='fixed:0.4')
+    parser.add_argument('--token-latency', type=float, default=0.002)
+    args = parser.parse_args()
+
+    _, url, faults = start_fake_anthropic(latency=args.latency, token_latency=args.token_latency)
+    os.environ.update({'ANTHROPIC_BASE_URL': url, 'ANTHROPIC_API_KEY': 'bench'})
+
+    import catalog
+    import clients
+    from resilience import ResilientClaude
+
+    claude = ResilientClaude(clients.get_claude)
+
+    def complete(system, text, max_tokens):
+        response = claude.create('catalog', model='claude-3-haiku-20240307', max_tokens=max_tokens,
+                                 messages=[{'role': 'user', 'content': text}], system=system)
+        return response.content[0].text
+
+    paste = make_paste(args.items, args.style)
+    complete(catalog.EXTRACT_PROMPT, 'Warmup $1', 100)
+
+    rows = []
+    for name, max_tokens in (('single call, max_tokens=1000', 1000),
+                             ('single call, unbounded', 100 + catalog.CATALOG_TOKENS_PER_ITEM * args.items)):
+        started = time.perf_counter()
+        try:
+            count = len(catalog.parse_products(complete(catalog.EXTRACT_PROMPT, paste, max_tokens)))
+        except Exception as e:
+            # A long enough paste outlives the attempt timeout entirely
+            count = f"failed: {type(e).__name__}"
+        rows.append((name, time.perf_counter() - started, count, 1))
+
+    one_chunk = catalog.chunk_items(catalog.split_items(paste))[0]
+    started = time.perf_counter()
+    catalog.parse_products(complete(catalog.EXTRACT_PROMPT, '\n'.join(one_chunk), 100 + 40 * len(one_chunk)))
+    rows.append((f"one chunk ({len(one_chunk)} items)", time.perf_counter() - started, len(one_chunk), 1))
+
+    started = time.perf_counter()
+    products, stats = catalog.extract_products(paste, complete)
+    rows.append((f"parallel, {catalog.CATALOG_WORKERS} workers", time.perf_counter() - started,
+                 len(products), stats['chunks']))
+
+    print(f"{args.items} items, {len(catalog.split_items(paste))} split, style={args.style}")
+    for name, seconds, count, calls in rows:
+        print(f"{name:32} {seconds * 1000:8.0f}ms  products {count!s:>4}  calls {calls}")
+
+
+if __name__ == '__main__':
+    main()
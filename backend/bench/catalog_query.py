@@ -0,0 +1,160 @@
+"""Catalog query latency from the per-agent product index, against filtering the full list.
+
+    cd backend && python -m bench.catalog_query --products 50000
+
+Builds an index over a generated catalog, then runs each query shape both
+through ProductIndex.query and as a linear filter and sort over the list, the
+way the studio does it client-side. Every cursor walk is checked against the
+linear result. Also times incremental syncs against a rebuild from scratch.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+from bench.stats import percentiles
+from catalog_index import ProductIndex, _price, _words
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+ADJECTIVES = ('green', 'black', 'smoked', 'golden', 'wild', 'spiced', 'organic', 'rare', 'house', 'classic',
+              'jasmine', 'mint', 'roasted', 'iced', 'royal', 'mountain', 'honey', 'citrus', 'velvet', 'night')
+NOUNS = ('tea', 'oolong', 'matcha', 'chai', 'blend', 'teapot', 'mug', 'kettle', 'tin', 'sampler',
+         'infuser', 'cup', 'tray', 'whisk', 'scoop', 'candle', 'tote', 'gift set', 'bundle', 'pack')
+CATEGORIES = ('tea', 'teaware', 'gifts', 'accessories', 'subscriptions', 'merch', 'seasonal', 'bulk')
+# name: (query options, linear filter)
+SHAPES = {
+    'first_page': {},
+    'price_range_by_price': {'min_price': 20, 'max_price': 60, 'sort': 'price'},
+    'newest_first': {'sort': '-position'},
+    'by_name_desc': {'sort': '-name'},
+    'prefix_broad': {'q': 'te', 'sort': 'price'},
+    'prefix_narrow': {'q': 'mountain kett', 'sort': 'name'},
+    'category_by_price_desc': {'category': 'gifts', 'sort': '-price'},
+    'category_and_prefix_in_range': {'q': 'hon', 'category': 'tea', 'min_price': 10, 'max_price': 40},
+}
+
+
+def make_catalog(count: int, rng: random.Random):
+    return [{
+        'name': f"{rng.choice(ADJECTIVES).title()} {rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS).title()} {i}",
+        'price': round(rng.uniform(2, 200), 2),
+        'image': 'default',
+        'category': rng.choice(CATEGORIES),
+    } for i in range(count)]
+
+
+def linear(products, q=None, category=None, min_price=None, max_price=None, sort='position'):
+    """Filter and sort the whole list, as the client does today"""
+    terms = _words(q)
+    rows = []
+    for position, product in enumerate(products):
+        price = _price(product.get('price'))
+        words = _words(product.get('name'))
+        if category and str(product.get('category') or '').casefold() != category:
+            continue
+        if min_price is not None and price < min_price or max_price is not None and price > max_price:
+            continue
+        if not all(any(word.startswith(term) for word in words) for term in terms):
+            continue
+        rows.append((position, price, ' '.join(str(product['name']).casefold().split()), product))
+    field = sort.lstrip('-')
+    key = {'position': lambda r: r[0], 'price': lambda r: (r[1], r[0]), 'name': lambda r: (r[2], r[0])}[field]
+    rows.sort(key=key, reverse=sort.startswith('-'))
+    return [row[3] for row in rows]
+
+
+def walk(index, options, limit):
+    products, cursor = index.query(limit=limit, **options)
+    pages = 1
+    while cursor:
+        page, cursor = index.query(limit=limit, cursor=cursor, **options)
+        products.extend(page)
+        pages += 1
+    return products, pages
+
+
+def timed_us(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return {k: round(v, 1) for k, v in percentiles(samples).items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--limit', type=int, default=24)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--linear-repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--out', help='Report path (default: bench/results/catalog-query-<time>.json)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    products = make_catalog(args.products, rng)
+    index = ProductIndex()
+    started = time.perf_counter()
+    index.sync(products, 1)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    shapes = {}
+    for name, options in SHAPES.items():
+        expected = linear(products, **options)
+        walked, pages = walk(index, options, args.limit)
+        shapes[name] = {
+            'matches': len(expected),
+            'index_us': timed_us(lambda: index.query(limit=args.limit, **options), args.repeat),
+            # Without the prefix terms cached, as on a search's first page
+            'index_first_us': timed_us(lambda: (index.terms.clear(), index.query(limit=args.limit, **options)),
+                                       args.repeat),
+            'linear_us': timed_us(lambda: linear(products, **options)[:args.limit], args.linear_repeat),
+            'walk_pages': pages,
+            'walk_matches_linear': walked == expected,
+        }
+
+    # Incremental syncs: one edit, one add and one removal per version, as a builder turn makes
+    syncs = []
+    version = 1
+    for _ in range(args.linear_repeat * 4):
+        products = list(products)
+        target = rng.randrange(len(products))
+        products[target] = dict(products[target], price=round(rng.uniform(2, 200), 2))
+        products.append(make_catalog(1, rng)[0] | {'name': f"New Arrival {version}"})
+        del products[rng.randrange(len(products))]
+        version += 1
+        started = time.perf_counter()
+        index.sync(products, version)
+        syncs.append((time.perf_counter() - started) * 1e6)
+    rebuilt = ProductIndex()
+    started = time.perf_counter()
+    rebuilt.sync(products, version)
+    rebuild_ms = (time.perf_counter() - started) * 1000
+    consistent = all(
+        index.query(limit=args.limit, **options)[0] == rebuilt.query(limit=args.limit, **options)[0]
+        for options in SHAPES.values()
+    )
+
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'build_ms': round(build_ms, 1),
+        'incremental_sync_us': {k: round(v, 1) for k, v in percentiles(syncs).items()},
+        'rebuild_ms': round(rebuild_ms, 1),
+        'incremental_matches_rebuild': consistent,
+        'shapes': shapes,
+    }
+    print(json.dumps(report, indent=2))
+
+    out = args.out or os.path.join(RESULTS_DIR, f"catalog-query-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+
+if __name__ == '__main__':
+    main()
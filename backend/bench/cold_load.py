@@ -0,0 +1,104 @@
+"""Cold session load latency and bytes for agents with long histories, projected vs select('*').
+
+    cd backend && python -m bench.cold_load --agents 200 --turns 400
+
+Seeds the fake Supabase with agents, then loads each one twice on a cold cache:
+once the old way (the full row, history and all) and once through AgentBuilder,
+which reads the agent_heads projection. Reports per-load latency percentiles and
+response bytes, then checks a save and an older history page still round-trip.
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+from bench.fake_supabase import FAKE_SERVICE_KEY, start_fake_supabase
+from bench.session_restore import git_commit, make_session
+from bench.stats import percentiles
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def measure(load, users, faults):
+    latencies = []
+    bytes_before = faults.bytes_sent
+    for user_id in users:
+        started = time.perf_counter()
+        load(user_id)
+        latencies.append(time.perf_counter() - started)
+    summary = {k: round(v * 1000, 3) for k, v in percentiles(latencies).items()}
+    summary['bytes_per_load'] = round((faults.bytes_sent - bytes_before) / len(users))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--agents', type=int, default=200)
+    parser.add_argument('--turns', type=int, default=400, help='User turns per agent (two history entries each)')
+    parser.add_argument('--products', type=int, default=15)
+    parser.add_argument('--latency', default='fixed:0', help='Fake Supabase latency per request')
+    parser.add_argument('--out', help='Report path (default: bench/results/cold-load-<commit>-<time>.json)')
+    args = parser.parse_args()
+
+    _, supabase_url, store, faults = start_fake_supabase(latency=args.latency)
+    os.environ.update({
+        'SUPABASE_URL': supabase_url,
+        'SUPABASE_SERVICE_KEY': FAKE_SERVICE_KEY,
+        'ANTHROPIC_API_KEY': 'bench',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'USAGE_SINK': os.getenv('USAGE_SINK', 'none'),
+        'SESSION_STATE_DIR': '',
+    })
+    import app_v2
+
+    users = []
+    for index in range(args.agents):
+        session = make_session(index, args.turns, args.products)
+        row = dict(session['context'], id=session['agent_id'], user_id=session['user_id'],
+                   updated_at=datetime.utcnow().isoformat())
+        # Older drafts for the same user, which the ordered query has to skip
+        store.write('agents', [row, dict(row, id=str(uuid.uuid4()), updated_at='2023-01-01T00:00:00')])
+        users.append(session['user_id'])
+
+    def load_full(user_id):
+        rows = app_v2.get_supabase().table('agents').select('*').eq(
+            'user_id', user_id
+        ).order('updated_at', desc=True).limit(1).execute().data
+        return app_v2.context_from_row(rows[0])
+
+    app_v2.get_supabase()
+    with app_v2.app.test_request_context():
+        full = measure(load_full, users, faults)
+        projected = measure(lambda user_id: app_v2.AgentBuilder(user_id), users, faults)
+
+        # A save from a session holding only the tail keeps the stored history whole
+        builder = app_v2.AgentBuilder(users[0])
+        builder.context['conversation_history'].append({'role': 'user', 'content': 'one more'})
+        saved = builder.save_context()
+        stored = store.table('agents')[builder.agent_id]['conversation_history']
+        page = builder.history_page(100, 50)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'full_row': full,
+        'projected': projected,
+        'bytes_saved_pct': round(100 * (1 - projected['bytes_per_load'] / full['bytes_per_load']), 1),
+        'tail_save_ok': saved and len(stored) == args.turns * 2 + 1 and stored[-1]['content'] == 'one more',
+        'history_page_ok': page == stored[50:100],
+    }
+    print(json.dumps(report, indent=2))
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"cold-load-{report['commit']}-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+
+if __name__ == '__main__':
+    main()
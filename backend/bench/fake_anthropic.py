@@ -0,0 +1,194 @@
+"""Local stand-in for the Anthropic Messages API with injectable latency and errors.
+
+Point the SDK at it with ANTHROPIC_BASE_URL=http://127.0.0.1:<port>.
+
+    python -m bench.fake_anthropic --port 8900 --latency lognormal:0.3:0.5 --error-rate 0.05
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_latency(spec: str):
+    """Turn 'fixed:0.1', 'uniform:0.05:0.4' or 'lognormal:median:sigma' into a sampler"""
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(':') if v]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        mu, sigma = math.log(values[0]), values[1]
+        return lambda: random.lognormvariate(mu, sigma)
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+CATALOG_ITEM = re.compile(r"([^,;|\n$£€¥₹]+?)\s*[-:]?\s*[$£€¥₹]\s*(\d+(?:\.\d+)?)")
+
+BUILDER_REPLY = {
+    'updated_fields': {'brand_name': 'TeaTime'},
+    'next_state': 'intake',
+    'ai_response': 'Great name! What products would you like to sell?',
+}
+
+
+class FaultConfig:
+    """Mutable fault settings so a running server can be reconfigured between runs"""
+
+    def __init__(self, latency: str = 'fixed:0', error_rate: float = 0.0, error_status: int = 529,
+                 slow_rate: float = 0.0, slow_latency: float = 5.0, token_latency: float = 0.0,
+                 concurrency: int = 0):
+        self.sample_latency = parse_latency(latency)
+        # Requests served at once, like an account's upstream capacity; the rest wait
+        self.capacity = threading.Semaphore(concurrency) if concurrency else None
+        # Seconds per generated token, so long outputs take longer like the real API
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def sent(self, size: int):
+        with self.lock:
+            self.bytes_sent += size
+
+
+def make_handler(faults: FaultConfig):
+    class FakeAnthropicHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out in separate writes; without this, delayed ACKs add ~40ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            # /v1/models, used by /healthz/warm to open a connection
+            self._send(200, {
+                'data': [{'type': 'model', 'id': 'claude-3-haiku-20240307', 'display_name': 'Claude 3 Haiku',
+                          'created_at': '2024-03-07T00:00:00Z'}],
+                'has_more': False, 'first_id': 'claude-3-haiku-20240307', 'last_id': 'claude-3-haiku-20240307',
+            })
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            faults.count()
+            if faults.capacity is None:
+                self._respond(body)
+                return
+            with faults.capacity:
+                self._respond(body)
+
+        def _respond(self, body):
+            delay = faults.sample_latency()
+            if faults.slow_rate and random.random() < faults.slow_rate:
+                delay += faults.slow_latency
+            time.sleep(delay)
+
+            if faults.error_rate and random.random() < faults.error_rate:
+                self._send(faults.error_status, {
+                    'type': 'error',
+                    'error': {'type': 'overloaded_error', 'message': 'Injected failure'},
+                })
+                return
+
+            system = body.get('system') or ''
+            if isinstance(system, list):
+                system = ' '.join(block.get('text', '') for block in system)
+            if 'Extract every product' in system:
+                message = body['messages'][-1]['content']
+                text = json.dumps({'products': [
+                    {'name': name.strip(), 'price': float(price), 'image': 'default'}
+                    for name, price in CATALOG_ITEM.findall(message)
+                ]})
+            elif 'Return JSON' in system:
+                text = json.dumps(BUILDER_REPLY)
+            else:
+                text = 'Happy to help you find something!'
+            # Like the real API, output stops at max_tokens
+            max_chars = body.get('max_tokens', 1024) * 4
+            stop_reason = 'max_tokens' if len(text) > max_chars else 'end_turn'
+            text = text[:max_chars]
+            if faults.token_latency:
+                time.sleep(len(text) / 4 * faults.token_latency)
+            self._send(200, {
+                'id': f"msg_{uuid.uuid4().hex[:24]}",
+                'type': 'message',
+                'role': 'assistant',
+                'model': body.get('model', 'claude-3-haiku-20240307'),
+                'content': [{'type': 'text', 'text': text}],
+                'stop_reason': stop_reason,
+                'stop_sequence': None,
+                'usage': {'input_tokens': len(system) // 4 + 10, 'output_tokens': len(text) // 4},
+            })
+
+        def _send(self, status: int, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return FakeAnthropicHandler
+
+
+class QuietServer(ThreadingHTTPServer):
+    """Clients that time out hang up mid-response; that is expected here"""
+
+    daemon_threads = True
+    # The default backlog of 5 resets connections under a few hundred clients
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+def start_fake_anthropic(port: int = 0, **fault_options):
+    """Start the fake in a daemon thread; returns (server, base_url, faults)"""
+    faults = FaultConfig(**fault_options)
+    server = QuietServer(('127.0.0.1', port), make_handler(faults))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", faults
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', default='lognormal:0.3:0.5')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=529)
+    parser.add_argument('--slow-rate', type=float, default=0.0)
+    parser.add_argument('--slow-latency', type=float, default=5.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=0, help='Requests served at once (0: unlimited)')
+    args = parser.parse_args()
+
+    server, url, _ = start_fake_anthropic(
+        args.port, latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+        slow_rate=args.slow_rate, slow_latency=args.slow_latency, token_latency=args.token_latency,
+        concurrency=args.concurrency,
+    )
+    print(f"Fake Anthropic listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
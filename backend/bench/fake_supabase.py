@@ -0,0 +1,313 @@
+"""Local stand-in for the Supabase PostgREST endpoints the backends use.
+
+Keeps tables in memory and understands the subset of PostgREST that
+supabase-py emits here: select projection, eq/neq/gt/gte/lt/lte/ilike filters,
+not./or=/and= combinations, order, limit/offset, single-object responses and upserts on a conflict column,
+plus the agent_heads view and the RPC functions from migrations/003_agents_history.sql.
+
+    python -m bench.fake_supabase --port 8901 --latency lognormal:0.02:0.4
+"""
+import argparse
+import fnmatch
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qsl, urlparse
+
+from bench.fake_anthropic import FaultConfig, QuietServer
+
+# Any JWT-shaped string passes supabase-py's key check
+FAKE_SERVICE_KEY = 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.fake'
+
+RESERVED_PARAMS = {'select', 'order', 'limit', 'offset', 'on_conflict', 'columns'}
+LOGIC_PARAMS = {'or', 'and'}
+HISTORY_TAIL = 10
+
+
+def agent_head(row):
+    history = row.get('conversation_history') or []
+    head = {k: v for k, v in row.items() if k != 'conversation_history'}
+    head['history_len'] = len(history)
+    head['history_tail'] = history[-HISTORY_TAIL:]
+    return head
+
+
+# View name -> (base table, row mapping)
+VIEWS = {'agent_heads': ('agents', agent_head)}
+
+
+def _coerce(value: str, sample):
+    if isinstance(sample, (int, float)) and not isinstance(sample, bool):
+        try:
+            return type(sample)(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _matches(row, column: str, expression: str) -> bool:
+    op, _, raw = expression.partition('.')
+    if op == 'not':
+        return not _matches(row, column, raw)
+    value = row.get(column)
+    if len(raw) > 1 and raw[0] == raw[-1] == '"':
+        raw = raw[1:-1]
+    if op == 'is':
+        return value is None if raw == 'null' else str(value).lower() == raw
+    if value is None:
+        return False
+    if op == 'ilike':
+        return fnmatch.fnmatch(str(value).lower(), raw.replace('%', '*').lower())
+    if op == 'like':
+        return fnmatch.fnmatchcase(str(value), raw.replace('%', '*'))
+    if op == 'in':
+        return str(value) in raw.strip('()').split(',')
+    target = _coerce(raw, value)
+    return {
+        'eq': value == target, 'neq': value != target,
+        'gt': value > target, 'gte': value >= target,
+        'lt': value < target, 'lte': value <= target,
+    }.get(op, False)
+
+
+def _split_terms(group: str):
+    """Split '(a.eq.1,and(b.lt.2,c.is.null))' into its top-level terms"""
+    terms, depth, current = [], 0, ''
+    for char in group[1:-1]:
+        if char == ',' and depth == 0:
+            terms.append(current)
+            current = ''
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current += char
+    if current:
+        terms.append(current)
+    return terms
+
+
+def _matches_logic(row, operator: str, group: str) -> bool:
+    results = []
+    for term in _split_terms(group):
+        head, _, rest = term.partition('(')
+        if head in LOGIC_PARAMS:
+            results.append(_matches_logic(row, head, '(' + rest))
+        else:
+            column, _, expression = term.partition('.')
+            results.append(_matches(row, column, expression))
+    return any(results) if operator == 'or' else all(results)
+
+
+class Store:
+    """In-memory tables keyed by name, each a dict of id -> row"""
+
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def table(self, name: str):
+        return self.tables.setdefault(name, {})
+
+    def query(self, name: str, params):
+        with self.lock:
+            if name in VIEWS:
+                base, mapping = VIEWS[name]
+                rows = [mapping(row) for row in self.table(base).values()]
+            else:
+                rows = list(self.table(name).values())
+        for column, expression in params:
+            if column in RESERVED_PARAMS:
+                continue
+            if column in LOGIC_PARAMS:
+                rows = [r for r in rows if _matches_logic(r, column, expression)]
+                continue
+            rows = [r for r in rows if _matches(r, column, expression)]
+        order = dict(params).get('order')
+        if order:
+            for clause in reversed(order.split(',')):
+                column, *modifiers = clause.split('.')
+                rows.sort(key=lambda r: (r.get(column) is None, r.get(column) or ''),
+                          reverse='desc' in modifiers)
+        query = dict(params)
+        offset = int(query.get('offset', 0))
+        rows = rows[offset:]
+        if 'limit' in query:
+            rows = rows[:int(query['limit'])]
+        select = query.get('select', '*')
+        if select != '*':
+            columns = [c.strip() for c in select.split(',')]
+            rows = [{c: r.get(c) for c in columns} for r in rows]
+        return rows
+
+    def write(self, name: str, rows, conflict_column: str = 'id', merge: bool = True, ignore: bool = False):
+        written = []
+        with self.lock:
+            table = self.table(name)
+            for row in rows:
+                row = dict(row)
+                key = row.setdefault(conflict_column, str(uuid.uuid4()))
+                if ignore and key in table:
+                    continue
+                if merge and key in table:
+                    table[key] = {**table[key], **row}
+                else:
+                    table[key] = row
+                written.append(dict(table[key]))
+        return written
+
+    def update(self, name: str, params, changes):
+        matched = self.query(name, [p for p in params if p[0] != 'select'])
+        with self.lock:
+            table = self.table(name)
+            for row in matched:
+                table[row['id']].update(changes)
+            return [dict(table[row['id']]) for row in matched]
+
+    def rpc_agent_history_page(self, p_agent_id, p_before, p_limit):
+        with self.lock:
+            row = self.table('agents').get(p_agent_id) or {}
+            history = row.get('conversation_history') or []
+        return history[max(p_before - p_limit, 0):max(p_before, 0)]
+
+    def rpc_save_agent_tail(self, p_row, p_base_version, p_history_from):
+        with self.lock:
+            row = self.table('agents').get(p_row['id'])
+            if row is None or row.get('version') != p_base_version:
+                return None
+            history = (row.get('conversation_history') or [])[:p_history_from]
+            row.update(p_row, conversation_history=history + (p_row.get('conversation_history') or []))
+            return row['version']
+
+    def delete(self, name: str, params):
+        matched = self.query(name, [p for p in params if p[0] != 'select'])
+        with self.lock:
+            for row in matched:
+                self.table(name).pop(row['id'], None)
+        return matched
+
+
+def make_handler(store: Store, faults: FaultConfig):
+    class FakeSupabaseHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out in separate writes; without this, delayed ACKs add ~40ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _table_and_params(self):
+            url = urlparse(self.path)
+            name = url.path.rsplit('/', 1)[-1]
+            return name, parse_qsl(url.query, keep_blank_values=True)
+
+        def _inject(self) -> bool:
+            faults.count()
+            delay = faults.sample_latency()
+            if faults.slow_rate and random.random() < faults.slow_rate:
+                delay += faults.slow_latency
+            time.sleep(delay)
+            if faults.error_rate and random.random() < faults.error_rate:
+                self._send(faults.error_status, {'message': 'Injected failure', 'code': 'FAKE'})
+                return True
+            return False
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length) or b'null')
+
+        def _respond_rows(self, rows, status: int = 200):
+            if 'vnd.pgrst.object' in self.headers.get('Accept', ''):
+                if len(rows) != 1:
+                    self._send(406, {'code': 'PGRST116', 'message': f"{len(rows)} rows returned"})
+                    return
+                self._send(status, rows[0])
+                return
+            self._send(status, rows)
+
+        def do_GET(self):
+            # supabase-py sends an empty JSON body even on reads
+            self._body()
+            if self._inject():
+                return
+            name, params = self._table_and_params()
+            self._respond_rows(store.query(name, params))
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_POST(self):
+            body = self._body()
+            if self._inject():
+                return
+            name, params = self._table_and_params()
+            if '/rpc/' in self.path:
+                function = getattr(store, f"rpc_{name}", None)
+                if function is None:
+                    self._send(404, {'code': 'PGRST202', 'message': f"Could not find the function {name}"})
+                    return
+                self._send(200, function(**body))
+                return
+            rows = body if isinstance(body, list) else [body]
+            prefer = self.headers.get('Prefer', '')
+            conflict = dict(params).get('on_conflict', 'id')
+            written = store.write(name, rows, conflict, 'merge-duplicates' in prefer, 'ignore-duplicates' in prefer)
+            self._respond_rows(written, 201)
+
+        def do_PATCH(self):
+            body = self._body()
+            if self._inject():
+                return
+            name, params = self._table_and_params()
+            self._respond_rows(store.update(name, params, body))
+
+        def do_DELETE(self):
+            self._body()
+            if self._inject():
+                return
+            name, params = self._table_and_params()
+            self._respond_rows(store.delete(name, params))
+
+        def _send(self, status: int, payload):
+            data = json.dumps(payload, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(data)
+                faults.sent(len(data))
+
+    return FakeSupabaseHandler
+
+
+def start_fake_supabase(port: int = 0, store: Store = None, **fault_options):
+    """Start the fake in a daemon thread; returns (server, base_url, store, faults)"""
+    store = store or Store()
+    faults = FaultConfig(**fault_options)
+    server = QuietServer(('127.0.0.1', port), make_handler(store, faults))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", store, faults
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--latency', default='lognormal:0.02:0.4')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args()
+
+    server, url, _, _ = start_fake_supabase(
+        args.port, latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+    )
+    print(f"Fake Supabase listening on {url} (service key: {FAKE_SERVICE_KEY})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Background job throughput and queue latency across pool types, worker counts and processes.
+
+    cd backend && python -m bench.jobs_bench --jobs 2000
+
+Each scenario enqueues a batch of jobs into a fresh SQLite job database, starts
+the consumers and waits for the queue to drain; the paced one enqueues at a
+steady rate into running workers, for the latency a caller sees. Handlers record every run in
+the same database, so the report checks each job ran exactly once to success,
+including with several consumer processes claiming from one file and with
+handlers that fail their first attempt.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import zlib
+from datetime import datetime
+
+# Retries in the flaky scenario should come round in milliseconds, not seconds
+os.environ.setdefault('JOBS_BACKOFF_BASE', '0.02')
+os.environ.setdefault('JOBS_POLL_INTERVAL', '0.05')
+
+from bench.stats import percentiles
+from jobs import JobQueue, JobStore
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def _record(job):
+    job.store.connect().execute("INSERT INTO runs (job_id, pid, attempt) VALUES (?, ?, ?)",
+                                (job.id, os.getpid(), job.attempt))
+
+
+def noop(job):
+    _record(job)
+
+
+def io(job):
+    time.sleep(job.payload['ms'] / 1000)
+    _record(job)
+
+
+def cpu(job):
+    deadline = time.thread_time() + job.payload['ms'] / 1000
+    while time.thread_time() < deadline:
+        pass
+    _record(job)
+
+
+def flaky(job):
+    """Fails the first attempt of about fail_pct% of jobs, picked by id"""
+    time.sleep(job.payload['ms'] / 1000)
+    if job.attempt == 1 and zlib.crc32(job.id.encode()) % 100 < job.payload['fail_pct']:
+        raise RuntimeError('transient')
+    _record(job)
+
+
+HANDLERS = {'noop': noop, 'io': io, 'cpu': cpu, 'flaky': flaky}
+
+
+def make_queue(path: str, workers: int, pool: str) -> JobQueue:
+    queue = JobQueue(JobStore(path), workers=workers, pool=pool)
+    for kind, fn in HANDLERS.items():
+        queue.register(kind, fn, max_attempts=3)
+    return queue
+
+
+def drained(store: JobStore) -> bool:
+    counts = store.counts()
+    return counts['queued'] + counts['running'] == 0
+
+
+def consume(path: str, workers: int, pool: str, ready, go):
+    """A consumer process: its own queue on the shared database, until it drains"""
+    queue = make_queue(path, workers, pool)
+    ready.set()
+    go.wait()
+    queue.start()
+    while not drained(queue.store):
+        time.sleep(0.01)
+    queue.stop()
+
+
+def run_scenario(name: str, kind: str, payload, count: int, workers: int, pool: str = 'thread',
+                 consumers: int = 0, rate: float = 0):
+    """A batch enqueued up front, or with rate, arriving at that many per second into a running queue"""
+    path = os.path.join(tempfile.mkdtemp(prefix='jobs-bench-'), 'jobs.db')
+    store = JobStore(path)
+    store.connect().execute("CREATE TABLE runs (job_id TEXT, pid INTEGER, attempt INTEGER)")
+
+    if rate:
+        queue = make_queue(path, workers, pool)
+        queue.start()
+        started = time.perf_counter()
+        for i in range(count):
+            time.sleep(max(0.0, started + i / rate - time.perf_counter()))
+            queue.enqueue(kind, payload)
+        enqueue_s = time.perf_counter() - started
+    else:
+        started = time.perf_counter()
+        for _ in range(count):
+            store.insert(kind, payload, None, 3)
+        enqueue_s = time.perf_counter() - started
+
+    processes = []
+    if consumers:
+        context = multiprocessing.get_context('spawn')
+        go = context.Event()
+        for _ in range(consumers):
+            ready = context.Event()
+            process = context.Process(target=consume, args=(path, workers, pool, ready, go))
+            process.start()
+            ready.wait()
+            processes.append(process)
+        started = time.perf_counter()
+        go.set()
+    elif not rate:
+        queue = make_queue(path, workers, pool)
+        started = time.perf_counter()
+        queue.start()
+    while not drained(store):
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    if consumers:
+        for process in processes:
+            process.join()
+    else:
+        queue.stop()
+
+    conn = store.connect()
+    rows = conn.execute("SELECT created_at, started_at, finished_at, attempts, status FROM jobs").fetchall()
+    runs = conn.execute("SELECT count(*), count(DISTINCT job_id), count(DISTINCT pid) FROM runs").fetchone()
+    return {
+        'scenario': name,
+        'kind': kind,
+        'pool': pool,
+        'workers': workers,
+        'consumer_processes': consumers or 1,
+        'jobs': count,
+        'enqueue_per_s': round(count / enqueue_s),
+        'throughput_per_s': round(count / elapsed, 1),
+        'drain_s': round(elapsed, 3),
+        # From enqueue to the first claim; for a batch this includes waiting for the workers to start
+        'first_claim_ms': {k: round(v * 1000, 1) for k, v in
+                           percentiles([row['started_at'] - row['created_at'] for row in rows]).items()},
+        'succeeded': sum(row['status'] == 'succeeded' for row in rows),
+        'retried': sum(row['attempts'] - 1 for row in rows),
+        'exactly_once': runs[0] == runs[1] == count,
+        'pids': runs[2],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--cpu-jobs', type=int, default=400)
+    parser.add_argument('--io-ms', type=float, default=10, help='Sleep per io job, like an upstream call')
+    parser.add_argument('--cpu-ms', type=float, default=5, help='CPU time per cpu job')
+    parser.add_argument('--paced-jobs', type=int, default=1000)
+    parser.add_argument('--paced-rate', type=float, default=500, help='Arrivals per second in the paced scenario')
+    parser.add_argument('--fail-pct', type=int, default=20)
+    parser.add_argument('--out', help='Report path (default: bench/results/jobs-<time>.json)')
+    args = parser.parse_args()
+
+    io_payload = {'ms': args.io_ms}
+    cpu_payload = {'ms': args.cpu_ms}
+    scenarios = [
+        ('noop_1_thread', 'noop', None, args.jobs, 1),
+        ('noop_4_threads', 'noop', None, args.jobs, 4),
+        ('noop_16_threads', 'noop', None, args.jobs, 16),
+        ('io_4_threads', 'io', io_payload, args.jobs, 4),
+        ('io_16_threads', 'io', io_payload, args.jobs, 16),
+        ('io_32_threads', 'io', io_payload, args.jobs, 32),
+        ('io_2_processes_x_16_threads', 'io', io_payload, args.jobs, 16, 'thread', 2),
+        ('cpu_4_threads', 'cpu', cpu_payload, args.cpu_jobs, 4),
+        ('cpu_4_process_pool', 'cpu', cpu_payload, args.cpu_jobs, 4, 'process'),
+        ('paced_io_16_threads', 'io', io_payload, args.paced_jobs, 16, 'thread', 0, args.paced_rate),
+        ('flaky_io_16_threads', 'flaky', dict(io_payload, fail_pct=args.fail_pct), args.jobs, 16),
+    ]
+    results = []
+    for scenario in scenarios:
+        result = run_scenario(*scenario)
+        results.append(result)
+        print(f"{result['scenario']:30} {result['throughput_per_s']:>9} jobs/s  "
+              f"first claim p50 {result['first_claim_ms'].get('p50')}ms  "
+              f"succeeded {result['succeeded']}/{result['jobs']}  retried {result['retried']}  "
+              f"exactly once {result['exactly_once']}")
+
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'cpus': os.cpu_count(),
+        'scenarios': results,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"jobs-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Offline load test: run the Flask backends against fake Anthropic and Supabase servers.
+
+    cd backend && python -m bench.loadtest --requests 500 --concurrency 32 \\
+        --anthropic-latency lognormal:0.4:0.5 --supabase-latency lognormal:0.02:0.4
+
+Writes a JSON report (throughput and p50/p95/p99 per endpoint) to bench/results/
+and, with --compare, prints the change against an earlier report.
+"""
+import argparse
+import http.client
+import importlib
+import json
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bench.fake_anthropic import start_fake_anthropic
+from bench.fake_supabase import FAKE_SERVICE_KEY, start_fake_supabase
+from bench.stats import percentiles
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+BUILDER_MESSAGES = ['I want to sell tea', 'Call it TeaTime', 'Add Green Tea $25', 'Make hero blue']
+
+
+def _products(count: int = 20):
+    return [{'name': f"Product {i}", 'price': 10 + i, 'image': 'default'} for i in range(count)]
+
+
+# name -> (app module, method, path factory, body factory)
+SCENARIOS = {
+    'builder_chat': ('app_v2', 'POST', lambda user: '/api/builder/chat',
+                     lambda user: {'user_id': user, 'message': random.choice(BUILDER_MESSAGES)}),
+    'builder_process': ('app_v2', 'POST', lambda user: '/api/builder/process',
+                        lambda user: {'user_id': user, 'message': random.choice(BUILDER_MESSAGES),
+                                      'state': 'intake'}),
+    'chat': ('app_v2', 'POST', lambda user: '/api/chat',
+             lambda user: {'message': 'What do you recommend?',
+                           'agentData': {'brandName': 'TeaTime', 'products': _products()}}),
+    'agents_create': ('app', 'POST', lambda user: '/api/agents',
+                      lambda user: {'brandName': f"brand-{user}", 'heroHeader': 'Hi',
+                                    'products': _products(), 'salesTone': 'friendly'}),
+    'agents_get': ('app', 'GET', lambda user: f"/api/agents/brand-{user}", lambda user: None),
+}
+
+
+def serve_app(module_name: str):
+    """Import a backend module and serve its Flask app on a free port"""
+    from werkzeug.serving import make_server
+
+    module = importlib.import_module(module_name)
+    server = make_server('127.0.0.1', 0, module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_port
+
+
+def send(port: int, method: str, path: str, body):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload else {}
+        conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def run_scenario(port: int, scenario, requests: int, concurrency: int, users: int):
+    _, method, path_for, body_for = scenario
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def one(_):
+        user = f"bench-user-{random.randrange(users)}"
+        started = time.perf_counter()
+        try:
+            status = send(port, method, path_for(user), body_for(user))
+        except Exception:
+            status = 'connection_error'
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - wall_started
+
+    # A 404 from agents_get is a valid answer; only server and transport failures count
+    errors = sum(n for s, n in statuses.items() if s.startswith('5') or s == 'connection_error')
+    summary = {k + '_ms': round(v * 1000, 2) for k, v in percentiles(latencies).items()}
+    summary.update({
+        'requests': requests,
+        'throughput_rps': round(requests / wall, 2),
+        'error_rate': round(errors / requests, 4),
+        'statuses': statuses,
+    })
+    return summary
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(current, previous):
+    """Print throughput and p99 changes per endpoint against an earlier report"""
+    for name, now in current['endpoints'].items():
+        before = previous.get('endpoints', {}).get(name)
+        if not before:
+            continue
+        rps = (now['throughput_rps'] / before['throughput_rps'] - 1) * 100 if before['throughput_rps'] else 0
+        p99 = (now['p99_ms'] / before['p99_ms'] - 1) * 100 if before['p99_ms'] else 0
+        print(f"{name:16} throughput {rps:+6.1f}%   p99 {p99:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--endpoints', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--anthropic-latency', default='lognormal:0.4:0.5')
+    parser.add_argument('--anthropic-error-rate', type=float, default=0.0)
+    parser.add_argument('--supabase-latency', default='lognormal:0.02:0.4')
+    parser.add_argument('--supabase-error-rate', type=float, default=0.0)
+    parser.add_argument('--out', help='Report path (default: bench/results/loadtest-<commit>-<time>.json)')
+    parser.add_argument('--compare', help='Earlier report to diff against')
+    args = parser.parse_args()
+
+    anthropic_server, anthropic_url, _ = start_fake_anthropic(
+        latency=args.anthropic_latency, error_rate=args.anthropic_error_rate)
+    supabase_server, supabase_url, _, _ = start_fake_supabase(
+        latency=args.supabase_latency, error_rate=args.supabase_error_rate)
+
+    # The backends read these when they first build their clients
+    os.environ.update({
+        'ANTHROPIC_BASE_URL': anthropic_url,
+        'ANTHROPIC_API_KEY': 'bench',
+        'SUPABASE_URL': supabase_url,
+        'SUPABASE_SERVICE_KEY': FAKE_SERVICE_KEY,
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'USAGE_SINK': os.getenv('USAGE_SINK', 'none'),
+        'SESSION_STATE_DIR': os.getenv('SESSION_STATE_DIR', ''),
+    })
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    names = [n.strip() for n in args.endpoints.split(',') if n.strip()]
+    ports = {}
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'endpoints': {},
+    }
+    for name in names:
+        scenario = SCENARIOS[name]
+        if scenario[0] not in ports:
+            ports[scenario[0]] = serve_app(scenario[0])[1]
+        report['endpoints'][name] = run_scenario(
+            ports[scenario[0]], scenario, args.requests, args.concurrency, args.users)
+        result = report['endpoints'][name]
+        print(f"{name:16} {result['throughput_rps']:8.1f} rps  p50 {result['p50_ms']:8.1f}ms  "
+              f"p95 {result['p95_ms']:8.1f}ms  p99 {result['p99_ms']:8.1f}ms  errors {result['error_rate']:.2%}")
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"loadtest-{report['commit']}-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    anthropic_server.shutdown()
+    supabase_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Storefront chat latency during a builder burst, with and without the priority scheduler.
+
+    cd backend && python -m bench.priority_bench --upstream-concurrency 16 --builder-burst 300 --storefront-rps 20
+
+The fake upstream serves a fixed number of requests at once, like an account's
+capacity. A burst of builder calls is fired all together while storefront calls
+arrive at a steady rate; each mode reports per-class latency percentiles.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import anthropic
+
+from bench.fake_anthropic import start_fake_anthropic
+from bench.stats import percentiles
+from resilience import ResilientClaude
+from scheduler import PriorityScheduler, load_class
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+REQUEST = dict(model='claude-3-haiku-20240307', max_tokens=100,
+               messages=[{'role': 'user', 'content': 'hi'}], system='bench')
+
+
+def run_mode(url: str, capacity: int, args):
+    slots = PriorityScheduler(capacity, {name: load_class(name) for name in ('storefront', 'builder')})
+    claude = ResilientClaude(anthropic.Anthropic(api_key='bench', base_url=url), slots=slots)
+    results = {'storefront': [], 'builder': []}
+    failures = {'storefront': 0, 'builder': 0}
+    lock = threading.Lock()
+
+    def call(endpoint: str, traffic_class: str):
+        started = time.perf_counter()
+        try:
+            claude.create(endpoint, **REQUEST)
+            ok = True
+        except Exception:
+            ok = False
+        with lock:
+            results[traffic_class].append(time.perf_counter() - started)
+            failures[traffic_class] += 0 if ok else 1
+
+    threads = [threading.Thread(target=call, args=('builder', 'builder')) for _ in range(args.builder_burst)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    # Storefront arrives open-loop, so slow responses don't slow the arrival rate
+    interval = 1 / args.storefront_rps
+    for i in range(int(args.duration * args.storefront_rps)):
+        time.sleep(max(0.0, started + i * interval - time.perf_counter()))
+        thread = threading.Thread(target=call, args=('chat', 'storefront'))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    report = {}
+    for traffic_class, samples in results.items():
+        summary = {k: round(v * 1000, 1) for k, v in percentiles(samples).items()}
+        summary['calls'] = len(samples)
+        summary['error_rate'] = round(failures[traffic_class] / max(1, len(samples)), 3)
+        report[traffic_class] = summary
+    report['wall_s'] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--upstream-concurrency', type=int, default=16)
+    parser.add_argument('--latency', default='fixed:0.2')
+    parser.add_argument('--builder-burst', type=int, default=300)
+    parser.add_argument('--storefront-rps', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=4, help='Seconds of storefront arrivals')
+    parser.add_argument('--out', help='Report path (default: bench/results/priority-<time>.json)')
+    args = parser.parse_args()
+
+    server, url, _ = start_fake_anthropic(latency=args.latency, concurrency=args.upstream_concurrency)
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'classes': {name: load_class(name) for name in ('storefront', 'builder')},
+        # Off: every call goes straight upstream and queues there, first come first served
+        'unscheduled': run_mode(url, 0, args),
+        'scheduled': run_mode(url, args.upstream_concurrency, args),
+    }
+    server.shutdown()
+    print(json.dumps(report, indent=2))
+
+    out = args.out or os.path.join(RESULTS_DIR, f"priority-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""Replay recorded builder conversations through AgentBuilder.process_message.
+
+    cd backend && python -m bench.replay histories/*.json --workers 4
+    cd backend && python -m bench.replay export.ndjson --model recorded --cassette bench/cassette.json
+
+Input files hold exported `agents` rows (a list, a single row, {"agents": [...]}
+or NDJSON). Each row's user turns are fed through a fresh builder backed by the
+fake Supabase; the model is one of:
+
+  stub      deterministic rule-based replies, no network (default)
+  recorded  replies from --cassette, keyed by session and turn
+  anthropic the real client; with --cassette the replies are recorded
+
+Reports per-turn timing, tokens, parse failures, fast-path hits (turns that
+finished without a model call) and divergences from the recorded session, and
+writes a JSON report to bench/results/.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+from bench.fake_anthropic import parse_latency
+from bench.fake_supabase import FAKE_SERVICE_KEY, start_fake_supabase
+from bench.stats import percentiles
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# Stored agent columns compared against the replayed context at the end of a session
+CHECK_FIELDS = ('brand_name', 'hero_header', 'hero_subheader', 'hero_color', 'hero_text_size',
+                'subheader_color', 'subheader_text_size', 'products', 'sales_tone', 'state')
+
+COLORS = {'red': '#EF4444', 'blue': '#3B82F6', 'green': '#22C55E', 'black': '#171717',
+          'white': '#FFFFFF', 'purple': '#A855F7', 'orange': '#F97316', 'yellow': '#EAB308'}
+BRAND = re.compile(r"\b(?:call it|called|named|name it|brand is)\s+([\w' &-]+)", re.IGNORECASE)
+PRODUCT = re.compile(r"\badd\s+(.+?)\s+\$?(\d+(?:\.\d+)?)", re.IGNORECASE)
+COLOR = re.compile(r"\b(hero|header|subheader)\b.*?\b(%s|#[0-9a-fA-F]{6})\b" % '|'.join(COLORS), re.IGNORECASE)
+JSON_BLOCK = re.compile(r'\{.*\}', re.DOTALL)
+
+_app = None
+_model = None
+
+
+def load_sessions(paths):
+    """Exported agent rows with a non-empty conversation_history, from files or directories"""
+    sessions = []
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, '*.*json'))) if os.path.isdir(path) else [path]
+        for name in files:
+            with open(name) as f:
+                if name.endswith('.ndjson'):
+                    rows = [json.loads(line) for line in f if line.strip()]
+                else:
+                    rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows.get('agents', [rows])
+            for index, row in enumerate(rows):
+                if row.get('conversation_history'):
+                    row.setdefault('id', f"{os.path.basename(name)}#{index}")
+                    sessions.append(row)
+    return sessions
+
+
+def usage_of(system: str, message: str, text: str):
+    # Roughly four characters per token, enough to compare prompt changes
+    return SimpleNamespace(input_tokens=(len(system) + len(message)) // 4, output_tokens=len(text) // 4)
+
+
+def reply(text: str, usage):
+    return SimpleNamespace(content=[SimpleNamespace(type='text', text=text)], usage=usage)
+
+
+class StubModel:
+    """Rule-based stand-in for the builder model, answering in its JSON contract"""
+
+    def __init__(self, latency: str = 'fixed:0'):
+        self.sample_latency = parse_latency(latency)
+        self.products = []
+
+    def start_session(self, session_id: str):
+        self.products = []
+
+    def create(self, endpoint: str, turn: int = 0, **kwargs):
+        message = kwargs['messages'][-1]['content']
+        state = re.search(r'Current state: (\S+)', kwargs.get('system', ''))
+        fields, answer = {}, 'Tell me more about your store.'
+        if BRAND.search(message):
+            fields['brand_name'] = BRAND.search(message).group(1).strip()
+            answer = f"Love the name {fields['brand_name']}! What would you like to sell?"
+        for name, price in PRODUCT.findall(message):
+            self.products = self.products + [{'name': name.strip(), 'price': float(price), 'image': 'default'}]
+            fields['products'] = self.products
+            answer = f"Added {name.strip()}. Anything else?"
+        color = COLOR.search(message)
+        if color:
+            key = 'subheader_color' if color.group(1).lower() == 'subheader' else 'hero_color'
+            fields[key] = COLORS.get(color.group(2).lower(), color.group(2))
+            answer = 'Updated the colors.'
+        text = json.dumps({
+            'updated_fields': fields,
+            'next_state': 'intake' if fields else (state.group(1) if state else 'start'),
+            'ai_response': answer,
+        })
+        time.sleep(self.sample_latency())
+        return reply(text, usage_of(kwargs.get('system', ''), message, text))
+
+
+class CassetteModel:
+    """Replies recorded per (session, turn); with a live client, records misses instead"""
+
+    def __init__(self, path: str, live=None):
+        self.path = path
+        self.live = live
+        self.session_id = None
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def start_session(self, session_id: str):
+        self.session_id = session_id
+
+    def create(self, endpoint: str, turn: int = 0, **kwargs):
+        key = f"{self.session_id}:{turn}"
+        entry = self.entries.get(key)
+        if entry is None:
+            if self.live is None:
+                raise KeyError(f"No recorded reply for {key}")
+            response = self.live.create(endpoint, **kwargs)
+            entry = self.entries[key] = {
+                'text': response.content[0].text,
+                'input_tokens': response.usage.input_tokens,
+                'output_tokens': response.usage.output_tokens,
+            }
+        return reply(entry['text'], SimpleNamespace(input_tokens=entry['input_tokens'],
+                                                    output_tokens=entry['output_tokens']))
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+
+class CountingModel:
+    """Wraps the replay model in place of app_v2.claude and records every call of a turn"""
+
+    def __init__(self, model):
+        self.model = model
+        self.turn = 0
+        self.calls = []
+
+    def create(self, endpoint: str, **kwargs):
+        started = time.perf_counter()
+        response = self.model.create(endpoint, turn=self.turn, **kwargs)
+        text = response.content[0].text
+        match = JSON_BLOCK.search(text)
+        try:
+            parsed = bool(match) and isinstance(json.loads(match.group()), dict)
+        except ValueError:
+            parsed = False
+        self.calls.append({
+            'model_ms': (time.perf_counter() - started) * 1000,
+            'input_tokens': response.usage.input_tokens or 0,
+            'output_tokens': response.usage.output_tokens or 0,
+            'parsed': parsed,
+        })
+        return response
+
+
+def make_model(args):
+    if args.model == 'stub':
+        return StubModel(args.stub_latency)
+    if args.model == 'recorded':
+        return CassetteModel(args.cassette)
+    from resilience import ResilientClaude
+    import clients
+
+    live = ResilientClaude(clients.get_claude)
+    return CassetteModel(args.cassette, live) if args.cassette else _Live(live)
+
+
+class _Live:
+    def __init__(self, claude):
+        self.claude = claude
+
+    def start_session(self, session_id: str):
+        pass
+
+    def create(self, endpoint: str, turn: int = 0, **kwargs):
+        return self.claude.create(endpoint, **kwargs)
+
+
+def init_worker(args):
+    """Import the backend against a private fake Supabase (one per process)"""
+    global _app, _model
+    _, supabase_url, _, _ = start_fake_supabase(latency=args.supabase_latency)
+    os.environ.update({
+        'SUPABASE_URL': supabase_url,
+        'SUPABASE_SERVICE_KEY': FAKE_SERVICE_KEY,
+        'ANTHROPIC_API_KEY': os.getenv('ANTHROPIC_API_KEY', 'replay'),
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'USAGE_SINK': os.getenv('USAGE_SINK', 'none'),
+        'SESSION_STATE_DIR': os.getenv('SESSION_STATE_DIR', ''),
+    })
+    import app_v2
+
+    _app = app_v2
+    _model = make_model(args)
+
+
+def replay_session(row):
+    """Feed one session's user turns through a fresh builder and measure each turn"""
+    session_id = str(row['id'])
+    history = row.get('conversation_history') or []
+    recorded = {}
+    user_turns = []
+    for index, turn in enumerate(history):
+        if turn.get('role') == 'user':
+            user_turns.append(turn.get('content', ''))
+        elif turn.get('role') == 'assistant' and user_turns:
+            recorded[len(user_turns) - 1] = turn.get('content', '')
+
+    _model.start_session(session_id)
+    counting = CountingModel(_model)
+    _app.claude = counting
+    user_id = f"replay-{os.getpid()}-{hashlib.sha1(session_id.encode()).hexdigest()[:12]}"
+    _app.drop_builder(user_id)
+    builder = _app.get_builder(user_id)
+
+    turns = []
+    for index, message in enumerate(user_turns):
+        counting.turn = index
+        counting.calls = []
+        started = time.perf_counter()
+        with _app.app.test_request_context():
+            result = builder.process_message(message)
+        elapsed = (time.perf_counter() - started) * 1000
+        calls = counting.calls
+        turn = {
+            'turn': index,
+            'ms': round(elapsed, 3),
+            'model_ms': round(sum(c['model_ms'] for c in calls), 3),
+            'model_calls': len(calls),
+            'input_tokens': sum(c['input_tokens'] for c in calls),
+            'output_tokens': sum(c['output_tokens'] for c in calls),
+            'parse_failed': any(not c['parsed'] for c in calls),
+            'success': bool(result.get('success')),
+        }
+        if index in recorded and _model.__class__ is not StubModel and result.get('response') != recorded[index]:
+            turn['response_diverged'] = True
+        turns.append(turn)
+
+    divergences = {}
+    for field in CHECK_FIELDS:
+        if field in row and row[field] != builder.context.get(field):
+            divergences[field] = {'recorded': row[field], 'replayed': builder.context.get(field)}
+    _app.drop_builder(user_id)
+    return {'session': session_id, 'turns': turns, 'divergences': divergences}
+
+
+def summarize(sessions):
+    turns = [t for s in sessions for t in s['turns']]
+    if not turns:
+        return {'sessions': len(sessions), 'turns': 0}
+    summary = {k + '_ms': round(v, 3) for k, v in percentiles([t['ms'] for t in turns]).items()}
+    overhead = [t['ms'] - t['model_ms'] for t in turns]
+    summary.update({k + '_overhead_ms': round(v, 3) for k, v in percentiles(overhead).items()})
+    summary.update({
+        'sessions': len(sessions),
+        'turns': len(turns),
+        'model_calls': sum(t['model_calls'] for t in turns),
+        'input_tokens': sum(t['input_tokens'] for t in turns),
+        'output_tokens': sum(t['output_tokens'] for t in turns),
+        'fast_path_hit_rate': round(sum(1 for t in turns if not t['model_calls']) / len(turns), 4),
+        'parse_failure_rate': round(sum(1 for t in turns if t['parse_failed']) / len(turns), 4),
+        'error_rate': round(sum(1 for t in turns if not t['success']) / len(turns), 4),
+        'response_divergence_rate': round(sum(1 for t in turns if t.get('response_diverged')) / len(turns), 4),
+        'sessions_diverged': sum(1 for s in sessions if s['divergences']),
+    })
+    fields = {}
+    for session in sessions:
+        for field in session['divergences']:
+            fields[field] = fields.get(field, 0) + 1
+    summary['divergent_fields'] = fields
+    return summary
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(current, previous):
+    """Print the change in latency, tokens and failure rates against an earlier report"""
+    for key in ('p50_ms', 'p95_ms', 'p50_overhead_ms', 'input_tokens', 'output_tokens',
+                'fast_path_hit_rate', 'parse_failure_rate', 'sessions_diverged'):
+        before, now = previous.get('summary', {}).get(key), current['summary'].get(key)
+        if before is None or now is None:
+            continue
+        change = f"{(now / before - 1) * 100:+.1f}%" if before else 'n/a'
+        print(f"{key:22} {before:>12} -> {now:<12} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', help='JSON/NDJSON exports of agents rows, or directories of them')
+    parser.add_argument('--model', choices=('stub', 'recorded', 'anthropic'), default='stub')
+    parser.add_argument('--cassette', help='Recorded replies (read by recorded, written by anthropic)')
+    parser.add_argument('--stub-latency', default='fixed:0')
+    parser.add_argument('--supabase-latency', default='fixed:0')
+    parser.add_argument('--workers', type=int, default=1, help='Processes to spread sessions over')
+    parser.add_argument('--limit', type=int, help='Replay at most this many sessions')
+    parser.add_argument('--out', help='Report path (default: bench/results/replay-<commit>-<time>.json)')
+    parser.add_argument('--compare', help='Earlier report to diff against')
+    args = parser.parse_args()
+    if args.model == 'recorded' and not args.cassette:
+        parser.error('--model recorded needs --cassette')
+    if args.model == 'anthropic' and args.cassette and args.workers > 1:
+        parser.error('recording a cassette needs --workers 1')
+
+    sessions = load_sessions(args.paths)[:args.limit]
+    started = time.perf_counter()
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args,)) as pool:
+            results = list(pool.map(replay_session, sessions, chunksize=max(1, len(sessions) // (args.workers * 4))))
+    else:
+        init_worker(args)
+        results = [replay_session(row) for row in sessions]
+        if isinstance(_model, CassetteModel) and _model.live is not None:
+            _model.save()
+    wall = time.perf_counter() - started
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'wall_s': round(wall, 3),
+        'summary': summarize(results),
+        'sessions': results,
+    }
+    summary = report['summary']
+    print(f"{summary['sessions']} sessions, {summary['turns']} turns in {wall:.2f}s")
+    if summary['turns']:
+        print(f"turn p50 {summary['p50_ms']:.2f}ms  p95 {summary['p95_ms']:.2f}ms  "
+              f"overhead p50 {summary['p50_overhead_ms']:.2f}ms  tokens {summary['input_tokens']}/{summary['output_tokens']}")
+        print(f"fast path {summary['fast_path_hit_rate']:.1%}  parse failures {summary['parse_failure_rate']:.1%}  "
+              f"errors {summary['error_rate']:.1%}  diverged sessions {summary['sessions_diverged']} "
+              f"{summary['divergent_fields']}")
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"replay-{report['commit']}-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Saved {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Compare p50/p95/p99 of bare SDK calls vs ResilientClaude under injected faults.
+
+    cd backend && python -m bench.resilience_bench --calls 300 --error-rate 0.1 --slow-rate 0.05
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import anthropic
+
+from resilience import ResilientClaude
+from bench.fake_anthropic import start_fake_anthropic
+from bench.stats import percentiles
+
+
+def run(call, calls: int, concurrency: int):
+    latencies, failures = [], 0
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            call()
+            return time.perf_counter() - started, True
+        except Exception:
+            return time.perf_counter() - started, False
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for elapsed, ok in pool.map(one, range(calls)):
+            latencies.append(elapsed)
+            failures += 0 if ok else 1
+
+    summary = {k: round(v * 1000, 1) for k, v in percentiles(latencies).items()}
+    summary['error_rate'] = round(failures / calls, 3)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', default='lognormal:0.05:0.3')
+    parser.add_argument('--error-rate', type=float, default=0.1)
+    parser.add_argument('--slow-rate', type=float, default=0.05)
+    parser.add_argument('--slow-latency', type=float, default=3.0)
+    args = parser.parse_args()
+
+    server, url, _ = start_fake_anthropic(
+        latency=args.latency, error_rate=args.error_rate,
+        slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+    )
+    request = dict(model='claude-3-haiku-20240307', max_tokens=100,
+                   messages=[{'role': 'user', 'content': 'hi'}], system='bench')
+
+    # The bare client mirrors the old behaviour: SDK defaults, no deadline of our own
+    bare = anthropic.Anthropic(api_key='bench', base_url=url)
+    policies = {'chat': {'deadline': 4.0, 'attempt_timeout': 2.0, 'max_attempts': 3, 'hedge': True}}
+    resilient = ResilientClaude(anthropic.Anthropic(api_key='bench', base_url=url), policies)
+
+    results = {
+        'bare': run(lambda: bare.messages.create(**request), args.calls, args.concurrency),
+        'resilient': run(lambda: resilient.create('chat', **request), args.calls, args.concurrency),
+    }
+    print(json.dumps(results, indent=2))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Benchmark writing and restoring the warm-session snapshot and WAL.
+
+    cd backend && python -m bench.session_restore --sessions 10000 --turns 30 --products 15
+
+Generates sessions into a temporary SESSION_STATE_DIR, then imports app_v2 so
+it restores them on startup (against the fake Supabase, which should see no
+queries), and times the snapshot write, the restore and the WAL replay.
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from bench.fake_supabase import FAKE_SERVICE_KEY, start_fake_supabase
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def make_session(index: int, turns: int, products: int):
+    history = []
+    for turn in range(turns):
+        history.append({'role': 'user', 'content': f"Add Product {turn} ${turn + 5} with a longer description",
+                        'timestamp': '2024-01-01T00:00:00'})
+        history.append({'role': 'assistant', 'content': 'Added it. Anything else you would like to change?',
+                        'timestamp': '2024-01-01T00:00:01'})
+    context = {
+        'state': 'intake', 'brand_name': f"Brand {index}", 'hero_header': 'Fresh tea, delivered',
+        'hero_subheader': 'Small batches from small farms', 'hero_color': '#171717',
+        'hero_text_size': 'text-6xl', 'subheader_color': '#525252', 'subheader_text_size': 'text-xl',
+        'products': [{'name': f"Product {i}", 'price': 10 + i, 'image': f"https://cdn.example.com/{index}/{i}.jpg"}
+                     for i in range(products)],
+        'product_pills': [], 'background_image': '', 'sales_tone': 'friendly', 'agent_type': 'eCommerce',
+        'conversation_history': history, 'version': turns,
+    }
+    return {'user_id': f"user-{index}", 'agent_id': str(uuid.uuid4()), 'stored_version': turns, 'context': context}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--turns', type=int, default=30)
+    parser.add_argument('--products', type=int, default=15)
+    parser.add_argument('--pending', type=int, default=100, help='Unacknowledged WAL writes to replay')
+    parser.add_argument('--out', help='Report path (default: bench/results/session-restore-<commit>-<time>.json)')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='session-state-')
+    _, supabase_url, fake_store, faults = start_fake_supabase()
+    os.environ.update({
+        'SUPABASE_URL': supabase_url,
+        'SUPABASE_SERVICE_KEY': FAKE_SERVICE_KEY,
+        'ANTHROPIC_API_KEY': 'bench',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'USAGE_SINK': os.getenv('USAGE_SINK', 'none'),
+        'SESSION_STATE_DIR': root,
+        # Replay is driven by hand below
+        'WAL_RETRY_INTERVAL': '3600',
+    })
+
+    import session_store
+
+    sessions = [make_session(i, args.turns, args.products) for i in range(args.sessions)]
+    store = session_store.open_store(root)
+    started = time.perf_counter()
+    store.save_snapshot((session['user_id'], session) for session in sessions)
+    generate_write_s = time.perf_counter() - started
+    for session in sessions[:args.pending]:
+        data = dict(session['context'], id=session['agent_id'], user_id=session['user_id'],
+                    version=session['stored_version'] + 1)
+        store.wal.append(session['agent_id'], session['user_id'], session['stored_version'], data)
+        # The row as Supabase last saw it, so the replay's conditional write lands
+        fake_store.write('agents', [dict(data, version=session['stored_version'])])
+    store.lock_file.close()
+    del store, sessions
+
+    started = time.perf_counter()
+    import app_v2
+    import_s = time.perf_counter() - started
+    restore_ms = app_v2.clients.STARTUP_REPORT.get('restore_sessions_ms')
+    restored = len(app_v2.restored_sessions) + len(app_v2.builders)
+
+    # First use of a restored session parses it instead of querying Supabase
+    users = list(app_v2.restored_sessions)[:1000]
+    started = time.perf_counter()
+    with app_v2.app.test_request_context():
+        for user_id in users:
+            app_v2.get_builder(user_id)
+    first_use_ms = (time.perf_counter() - started) * 1000 / max(1, len(users))
+    queries_during_restore = faults.requests
+
+    started = time.perf_counter()
+    written = app_v2.sessions.save_snapshot(app_v2.snapshot_sessions())
+    snapshot_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with app_v2.app.test_request_context():
+        replayed = app_v2.sessions.replay_pending(app_v2.replay_write)
+    replay_s = time.perf_counter() - started
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'snapshot_bytes': os.path.getsize(app_v2.sessions.snapshot_path),
+        'sessions_restored': restored,
+        'restore_ms': restore_ms,
+        'first_use_ms': round(first_use_ms, 3),
+        'import_app_s': round(import_s, 3),
+        'queries_during_restore': queries_during_restore,
+        'snapshot_write_s': round(snapshot_s, 3),
+        'snapshot_sessions_written': written,
+        'initial_write_s': round(generate_write_s, 3),
+        'wal_replayed': replayed,
+        'wal_replay_s': round(replay_s, 3),
+    }
+    for key, value in report.items():
+        if key != 'config':
+            print(f"{key:26} {value}")
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"session-restore-{report['commit']}-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+def percentiles(samples):
+    """p50/p95/p99/max of a list of latencies, in the samples' own unit"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+    return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'max': ordered[-1]}
@@ -0,0 +1,312 @@
+"""Concurrency stress test for the builder endpoints, with invariant checks.
+
+    cd backend && python -m bench.stress --clients 200 --users 60 --ops 20
+    cd backend && python -m bench.stress --workers 4 --sticky          # multi-process server
+    cd backend && python -m bench.stress --gate --min-rps 150           # exit 1 on any violation
+
+Hundreds of client threads send randomized interleavings of builder chat,
+process, context reads, publish/back commands and resets, for a skewed mix of
+shared and private users, against app_v2 served by a threaded server (or by
+several worker processes sharing the fake Supabase). Afterwards the stored rows
+and every acknowledged response are checked for:
+
+  one_agent_per_user   each user has exactly one agents row
+  lost_turns           every acknowledged turn since the user's last reset is stored
+  duplicate_versions   no two acknowledged writes for a user claim the same version
+  version_regressions  a client never sees a user's version go backwards
+  stored_behind        the stored version is at least the highest acknowledged one
+
+Throughput and per-operation latency are reported alongside, and the JSON report
+is written to bench/results/.
+"""
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from bench.fake_anthropic import start_fake_anthropic
+from bench.fake_supabase import FAKE_SERVICE_KEY, start_fake_supabase
+from bench.loadtest import git_commit
+from bench.stats import percentiles
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+MESSAGES = ['Call it TeaTime', 'Add Green Tea $25', 'Make hero blue', 'Write something cozy', 'Make subheader red']
+# op -> weight in the random mix
+OPS = {'chat': 40, 'process': 15, 'context': 30, 'command': 10, 'reset': 5}
+
+
+def serve_worker(env, ports):
+    """Worker process: serve app_v2 on a free port and report the port back"""
+    os.environ.update(env)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    from werkzeug.serving import make_server
+
+    import app_v2
+    server = make_server('127.0.0.1', 0, app_v2.app, threaded=True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def start_workers(env, count: int):
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    processes = [context.Process(target=serve_worker, args=(env, ports), daemon=True) for _ in range(count)]
+    for process in processes:
+        process.start()
+    return processes, [ports.get(timeout=60) for _ in processes]
+
+
+def send(port: int, method: str, path: str, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload else {}
+        conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        try:
+            return response.status, json.loads(data) if data else {}
+        except ValueError:
+            return response.status, {}
+    finally:
+        conn.close()
+
+
+class Ledger:
+    """Everything the clients were told, for checking against what was stored"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user -> [(version, tag)] of acknowledged turns
+        self.turns = defaultdict(list)
+        # user -> [version] of acknowledged resets
+        self.resets = defaultdict(list)
+        # user -> {version: op} of acknowledged writes
+        self.writes = defaultdict(dict)
+        self.duplicate_versions = []
+        self.version_regressions = []
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, op: str, status, elapsed: float):
+        with self.lock:
+            self.latencies[op].append(elapsed)
+            self.statuses[op][str(status)] += 1
+
+    def acknowledge(self, user: str, op: str, version: int, tag=None):
+        with self.lock:
+            if op in ('chat', 'process', 'reset', 'command'):
+                if version in self.writes[user]:
+                    self.duplicate_versions.append({'user': user, 'version': version,
+                                                    'ops': [self.writes[user][version], op]})
+                self.writes[user][version] = op
+            if op == 'reset':
+                self.resets[user].append(version)
+            elif tag is not None:
+                self.turns[user].append((version, tag))
+
+
+def pick_user(rng: random.Random, users: int, client: int) -> str:
+    # Most traffic lands on a small hot set shared by every client
+    if rng.random() < 0.8:
+        return f"stress-user-{rng.randrange(max(1, users // 5))}"
+    return f"stress-user-{rng.randrange(users)}"
+
+
+def run_client(client: int, ports, sticky: bool, args, ledger: Ledger):
+    rng = random.Random(args.seed * 100003 + client)
+    seen = {}
+    for seq in range(args.ops):
+        user = pick_user(rng, args.users, client)
+        port = ports[hash(user) % len(ports)] if sticky else rng.choice(ports)
+        op = rng.choices(list(OPS), weights=list(OPS.values()))[0]
+        tag = None
+        if op == 'chat' or op == 'process':
+            tag = f"[c{client}-{seq}]"
+            body = {'user_id': user, 'message': f"{rng.choice(MESSAGES)} {tag}"}
+            if op == 'process':
+                body['state'] = 'intake'
+            request = ('POST', f"/api/builder/{op}", body)
+        elif op == 'command':
+            request = ('POST', '/api/builder/chat', {'user_id': user, 'message': rng.choice(['publish', 'back'])})
+        elif op == 'reset':
+            request = ('POST', '/api/builder/reset', {'user_id': user})
+        else:
+            request = ('GET', f"/api/builder/context/{user}", None)
+
+        if args.jitter:
+            time.sleep(rng.uniform(0, args.jitter))
+        started = time.perf_counter()
+        try:
+            status, payload = send(port, *request)
+        except Exception:
+            status, payload = 'connection_error', {}
+        ledger.record(op, status, time.perf_counter() - started)
+        if status != 200 or payload.get('success') is False:
+            continue
+
+        version = payload.get('version')
+        if version is None:
+            continue
+        ledger.acknowledge(user, op, version, tag)
+        if version < seen.get(user, 0):
+            with ledger.lock:
+                ledger.version_regressions.append({'client': client, 'user': user,
+                                                   'seen': seen[user], 'got': version, 'op': op})
+        seen[user] = max(seen.get(user, 0), version)
+
+
+def check(store, ledger: Ledger):
+    """Invariant violations, by name"""
+    rows = defaultdict(list)
+    for row in store.table('agents').values():
+        rows[row.get('user_id')].append(row)
+
+    violations = {
+        'one_agent_per_user': [],
+        'lost_turns': [],
+        'duplicate_versions': ledger.duplicate_versions,
+        'version_regressions': ledger.version_regressions,
+        'stored_behind': [],
+    }
+    for user in set(ledger.writes) | set(ledger.turns):
+        user_rows = rows.get(user, [])
+        if len(user_rows) != 1:
+            violations['one_agent_per_user'].append({'user': user, 'agents': len(user_rows)})
+        if not user_rows:
+            continue
+        stored = max(user_rows, key=lambda r: r.get('updated_at') or '')
+        acked = max(ledger.writes[user], default=0)
+        if (stored.get('version') or 0) < acked:
+            violations['stored_behind'].append({'user': user, 'stored': stored.get('version'), 'acked': acked})
+
+        history = ' '.join(str(turn.get('content', '')) for turn in stored.get('conversation_history') or [])
+        last_reset = max(ledger.resets[user], default=-1)
+        for version, tag in ledger.turns[user]:
+            if version > last_reset and tag not in history:
+                violations['lost_turns'].append({'user': user, 'version': version, 'tag': tag})
+    return violations
+
+
+def summarize(ledger: Ledger, wall: float):
+    total = sum(len(samples) for samples in ledger.latencies.values())
+    errors = sum(n for statuses in ledger.statuses.values() for s, n in statuses.items()
+                 if s.startswith('5') or s == 'connection_error')
+    ops = {}
+    for op, samples in sorted(ledger.latencies.items()):
+        summary = {k + '_ms': round(v * 1000, 2) for k, v in percentiles(samples).items()}
+        summary['requests'] = len(samples)
+        summary['statuses'] = dict(ledger.statuses[op])
+        ops[op] = summary
+    return {
+        'requests': total,
+        'wall_s': round(wall, 2),
+        'throughput_rps': round(total / wall, 2) if wall else 0,
+        'error_rate': round(errors / total, 4) if total else 0,
+        'ops': ops,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--users', type=int, default=60)
+    parser.add_argument('--ops', type=int, default=20, help='Requests per client')
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes (0: one threaded server in-process)')
+    parser.add_argument('--sticky', action='store_true', help='Route each user to one worker, like session affinity')
+    parser.add_argument('--jitter', type=float, default=0.005, help='Max random pause before each request (s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--anthropic-latency', default='lognormal:0.02:0.5')
+    parser.add_argument('--supabase-latency', default='lognormal:0.002:0.5')
+    parser.add_argument('--supabase-error-rate', type=float, default=0.0)
+    parser.add_argument('--gate', action='store_true', help='Exit 1 on any violation or a threshold miss')
+    parser.add_argument('--min-rps', type=float, default=0.0)
+    parser.add_argument('--max-error-rate', type=float, default=0.0)
+    parser.add_argument('--out', help='Report path (default: bench/results/stress-<commit>-<time>.json)')
+    args = parser.parse_args()
+
+    anthropic_server, anthropic_url, _ = start_fake_anthropic(latency=args.anthropic_latency)
+    supabase_server, supabase_url, store, _ = start_fake_supabase(
+        latency=args.supabase_latency, error_rate=args.supabase_error_rate)
+    env = {
+        'ANTHROPIC_BASE_URL': anthropic_url,
+        'ANTHROPIC_API_KEY': 'bench',
+        'SUPABASE_URL': supabase_url,
+        'SUPABASE_SERVICE_KEY': FAKE_SERVICE_KEY,
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'USAGE_SINK': os.getenv('USAGE_SINK', 'none'),
+        'SESSION_STATE_DIR': '',
+    }
+    os.environ.update(env)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    processes = []
+    if args.workers:
+        processes, ports = start_workers(env, args.workers)
+    else:
+        from bench.loadtest import serve_app
+        ports = [serve_app('app_v2')[1]]
+
+    ledger = Ledger()
+    threads = [threading.Thread(target=run_client, args=(client, ports, args.sticky, args, ledger))
+               for client in range(args.clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    violations = check(store, ledger)
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'config': vars(args),
+        'summary': summarize(ledger, wall),
+        'violations': {name: len(found) for name, found in violations.items()},
+        'examples': {name: found[:5] for name, found in violations.items() if found},
+    }
+    summary = report['summary']
+    print(f"{summary['requests']} requests from {args.clients} clients in {summary['wall_s']}s: "
+          f"{summary['throughput_rps']} rps, errors {summary['error_rate']:.2%}")
+    for op, stats in summary['ops'].items():
+        print(f"  {op:8} p50 {stats['p50_ms']:8.1f}ms  p95 {stats['p95_ms']:8.1f}ms  p99 {stats['p99_ms']:8.1f}ms  "
+              f"{stats['statuses']}")
+    for name, count in report['violations'].items():
+        print(f"  {name:20} {count}")
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"stress-{report['commit']}-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+    for process in processes:
+        process.terminate()
+    anthropic_server.shutdown()
+    supabase_server.shutdown()
+
+    if args.gate:
+        failed = [name for name, count in report['violations'].items() if count]
+        if summary['throughput_rps'] < args.min_rps:
+            failed.append(f"throughput {summary['throughput_rps']} < {args.min_rps}")
+        if summary['error_rate'] > args.max_error_rate:
+            failed.append(f"error rate {summary['error_rate']} > {args.max_error_rate}")
+        if failed:
+            print(f"FAILED: {', '.join(failed)}")
+            sys.exit(1)
+        print('PASSED')
+
+
+if __name__ == '__main__':
+    main()
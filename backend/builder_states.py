@@ -0,0 +1,235 @@
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Adapted from the studio's builder machine (lib/builderMachine.js): state -> {event: next state}.
+# Its refine state folds into generate and save/test into publish (see LEGACY_STATES).
+# The studio has no publish state or PUBLISH event: publish, PUBLISH and BACK are
+# handled here as commands, without calling the model.
+TRANSITIONS: Dict[str, Dict[str, str]] = {
+    'idle': {'START': 'intake'},
+    'intake': {'SUBMIT': 'clarify', 'COMPLETE': 'generate', 'PUBLISH': 'publish'},
+    'clarify': {'ANSWER': 'generate', 'PUBLISH': 'publish'},
+    'generate': {'DONE': 'preview', 'PUBLISH': 'publish'},
+    'preview': {'REFINE': 'generate', 'SAVE': 'publish', 'PUBLISH': 'publish'},
+    'publish': {'BACK': 'preview'},
+}
+STATES = tuple(TRANSITIONS)
+COMMAND_EVENTS = ('PUBLISH', 'BACK')
+# Rows written before the state machine used 'start' or whatever the model returned
+LEGACY_STATES = {'start': 'idle', 'refine': 'generate', 'save': 'publish', 'test': 'publish', 'done': 'publish'}
+
+# Every field a builder turn may write; anything else the model returns is dropped
+EDITABLE_FIELDS = ('brand_name', 'hero_header', 'hero_subheader', 'hero_color', 'hero_text_size',
+                   'subheader_color', 'subheader_text_size', 'products', 'sales_tone', 'background_image')
+
+PRODUCT_EXAMPLE = '- "Add Green Tea $25" → products: [{"name": "Green Tea", "price": 25, "image": "default"}]'
+STYLE_EXAMPLES = '''- "Make hero blue" → hero_color: "#3B82F6"
+- "Make hero bold" → hero_text_size: "text-2xl font-bold"
+- "Make subheader red" → subheader_color: "#EF4444"
+"hero text" means hero_color and "background" means background_image; never mix them up.'''
+
+
+def _has_brand(ctx: Dict[str, Any]) -> bool:
+    return bool(ctx.get('brand_name'))
+
+
+def _has_products(ctx: Dict[str, Any]) -> bool:
+    return bool(ctx.get('products'))
+
+
+def _has_hero(ctx: Dict[str, Any]) -> bool:
+    return bool(ctx.get('hero_header'))
+
+
+# Per state: what the turn is for, the fields its schema asks for, a few
+# examples, and when the state is done so the server can move on by itself
+STATE_SPECS: Dict[str, Dict[str, Any]] = {
+    'intake': {
+        'goal': 'Learn what they sell and the brand name. Ask one short question at a time.',
+        'fields': ('brand_name', 'sales_tone', 'products'),
+        'examples': '- "I want to sell tea" → ask for the brand name\n- "Call it TeaTime" → brand_name: "TeaTime"\n'
+                    + PRODUCT_EXAMPLE,
+        'done': _has_brand,
+        'event': 'SUBMIT',
+    },
+    'clarify': {
+        'goal': 'Collect their products with prices. Always extract name and price.',
+        'fields': ('products', 'brand_name', 'sales_tone'),
+        'examples': PRODUCT_EXAMPLE + '\n- "Also Oolong for 30" → append {"name": "Oolong", "price": 30, "image": "default"}',
+        'done': _has_products,
+        'event': 'ANSWER',
+    },
+    'generate': {
+        'goal': 'Write the storefront hero: a short header and subheader in their tone, and apply any styling asked for.',
+        'fields': ('hero_header', 'hero_subheader', 'hero_color', 'hero_text_size', 'subheader_color',
+                   'subheader_text_size', 'background_image'),
+        'examples': '- "Write something cozy" → hero_header: "Tea for slow mornings"\n' + STYLE_EXAMPLES,
+        'done': _has_hero,
+        'event': 'DONE',
+    },
+    'preview': {
+        'goal': 'They are reviewing the storefront. Apply the edits they ask for; if they are happy, tell them to say "publish".',
+        'fields': EDITABLE_FIELDS,
+        'examples': STYLE_EXAMPLES + '\n' + PRODUCT_EXAMPLE,
+        'done': None,
+        'event': None,
+    },
+}
+
+# Whole-message commands that are pure transitions
+COMMANDS: List[Tuple[Any, str]] = [
+    (re.compile(r"^\s*(?:please\s+)?(?:publish|go live|launch)(?:\s+(?:my|the|it|this))?"
+                r"(?:\s+(?:agent|store|storefront|site|shop))?(?:\s+now)?[\s.!]*$", re.IGNORECASE), 'PUBLISH'),
+    (re.compile(r"^\s*(?:back|unpublish|keep editing|edit(?:\s+it)?|go back)[\s.!]*$", re.IGNORECASE), 'BACK'),
+]
+# Guards a command must pass besides the machine allowing it
+GUARDS: Dict[str, Callable[[Dict[str, Any]], bool]] = {
+    'PUBLISH': lambda ctx: _has_brand(ctx) and _has_products(ctx),
+}
+COMMAND_REPLIES = {
+    'PUBLISH': 'Your agent is ready to publish! Hit Publish to make it live.',
+    'BACK': 'Back in preview. What would you like to change?',
+}
+REFUSED_REPLIES = {
+    'PUBLISH': 'Before publishing, add a brand name and at least one product.',
+    'BACK': 'Nothing to go back to yet. Tell me more about your store.',
+}
+
+
+def normalize_state(state: Optional[str]) -> str:
+    state = LEGACY_STATES.get(state or 'idle', state or 'idle')
+    return state if state in TRANSITIONS else 'intake'
+
+
+def next_states(state: str) -> List[str]:
+    """States a model turn may move to: stay, or any non-command transition"""
+    state = normalize_state(state)
+    targets = [target for event, target in TRANSITIONS[state].items() if event not in COMMAND_EVENTS]
+    return [state] + [target for target in targets if target != state]
+
+
+def validate_transition(state: str, proposed: Optional[str]) -> str:
+    """The proposed next state if the machine allows it from state, else state unchanged"""
+    state = normalize_state(state)
+    if proposed is None:
+        return state
+    proposed = LEGACY_STATES.get(proposed, proposed)
+    return proposed if proposed in next_states(state) else state
+
+
+def advance(ctx: Dict[str, Any]) -> str:
+    """The state a model turn runs in: past idle, and past states whose goal the context already meets"""
+    state = normalize_state(ctx.get('state'))
+    if state == 'idle':
+        state = TRANSITIONS['idle']['START']
+    elif state == 'publish':
+        # Editing a published agent takes it back to preview until it is published again
+        state = TRANSITIONS['publish']['BACK']
+    while state in STATE_SPECS and STATE_SPECS[state]['done'] and STATE_SPECS[state]['done'](ctx):
+        state = TRANSITIONS[state][STATE_SPECS[state]['event']]
+    return state
+
+
+def match_command(message: str) -> Optional[str]:
+    for pattern, event in COMMANDS:
+        if pattern.match(message):
+            return event
+    return None
+
+
+def apply_command(ctx: Dict[str, Any], event: str) -> Tuple[bool, str]:
+    """Run a command's transition on ctx in place; returns (moved, reply)"""
+    state = normalize_state(ctx.get('state'))
+    target = TRANSITIONS[state].get(event)
+    guard = GUARDS.get(event)
+    if target is None or (guard and not guard(ctx)):
+        return False, REFUSED_REPLIES[event]
+    ctx['state'] = target
+    return True, COMMAND_REPLIES[event]
+
+
+def event_between(state: Optional[str], target: str) -> Optional[str]:
+    """The first studio event on the shortest path from state to target
+
+    A turn can move the server more than one state (idle to generate once the
+    brand is known), so the studio gets the event that starts that path.
+    None when target is where the machine already is, or can't be reached.
+    """
+    start = normalize_state(state)
+    if start == target:
+        return None
+    # Breadth first from each first event, so fewer steps win
+    frontier = [(to, event) for event, to in TRANSITIONS[start].items()]
+    seen = {start}
+    while frontier:
+        following = []
+        for current, first in frontier:
+            if current == target:
+                return first
+            if current in seen:
+                continue
+            seen.add(current)
+            following.extend((to, first) for to in TRANSITIONS.get(current, {}).values())
+        frontier = following
+    return None
+
+
+def schema(state: str) -> str:
+    fields = STATE_SPECS[state]['fields']
+    updated = ', '.join(f'"{field}": null' for field in fields)
+    allowed = '|'.join(next_states(state))
+    return f'{{"updated_fields": {{{updated}}}, "next_state": "{allowed}", "ai_response": "your reply"}}'
+
+
+def _build_summary(ctx: Dict[str, Any], fields) -> str:
+    lines = []
+    for field in fields:
+        if field == 'products':
+            products = ', '.join(f"{p.get('name')}:${p.get('price', 0)}" for p in ctx.get('products') or []
+                                 if isinstance(p, dict))
+            # Cut short on big catalogs; the model only returns products it adds or changes
+            lines.append(f"products: {products[:200] or 'none'}")
+        else:
+            lines.append(f"{field}: {ctx.get(field) or 'not set'}")
+    return '\n'.join(lines)
+
+
+def render_prompt(ctx: Dict[str, Any], turns: int = 6) -> str:
+    """Compact prompt for the context's state: its goal, fields, examples and schema only"""
+    state = advance(ctx)
+    spec = STATE_SPECS[state]
+    recent = '\n'.join(f"{msg['role']}: {msg['content'][:100]}"
+                       for msg in (ctx.get('conversation_history') or [])[-turns:])
+    return f"""You help a merchant build an eCommerce storefront. Current state: {state}
+{spec['goal']}
+
+Build so far:
+{_build_summary(ctx, spec['fields'])}
+
+Recent conversation:
+{recent}
+
+Examples:
+{spec['examples']}
+
+Return JSON only, setting just the fields the message changes and products as only those added or changed:
+{schema(state)}"""
+
+
+def parse_reply(text: str, state: str, json_block) -> Dict[str, Any]:
+    """The model's reply checked against the state's contract"""
+    match = json_block.search(text)
+    try:
+        result = json.loads(match.group()) if match else None
+    except ValueError:
+        result = None
+    if not isinstance(result, dict):
+        return {'updated_fields': {}, 'next_state': state, 'ai_response': text if not match else ''}
+    fields = result.get('updated_fields')
+    result['updated_fields'] = {
+        key: value for key, value in (fields.items() if isinstance(fields, dict) else [])
+        if key in EDITABLE_FIELDS and value is not None
+    }
+    result['next_state'] = validate_transition(state, result.get('next_state'))
+    return result
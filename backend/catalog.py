@@ -0,0 +1,211 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# A message is treated as a pasted catalog when it lists many prices, or is long
+# and lists at least a few; long prose without prices goes to the model as usual
+CATALOG_MIN_CHARS = int(os.getenv('CATALOG_MIN_CHARS', 1500))
+CATALOG_MIN_ITEMS = int(os.getenv('CATALOG_MIN_ITEMS', 12))
+CATALOG_LONG_MIN_ITEMS = int(os.getenv('CATALOG_LONG_MIN_ITEMS', 3))
+CATALOG_CHUNK_ITEMS = int(os.getenv('CATALOG_CHUNK_ITEMS', 25))
+CATALOG_WORKERS = int(os.getenv('CATALOG_WORKERS', 16))
+CATALOG_TOKENS_PER_ITEM = int(os.getenv('CATALOG_TOKENS_PER_ITEM', 40))
+CATALOG_MAX_TOKENS = int(os.getenv('CATALOG_MAX_TOKENS', 4096))
+# How long a finished extraction's progress stays readable
+CATALOG_PROGRESS_TTL = float(os.getenv('CATALOG_PROGRESS_TTL', 600))
+
+# A price is a currency symbol followed by a number: $25, £4.50, € 12, ¥800, ₹99
+CURRENCY_SYMBOLS = '$£€¥₹'
+PRICE = re.compile(rf'[{CURRENCY_SYMBOLS}]\s*\d')
+NOT_NUMERIC = re.compile(rf'[{CURRENCY_SYMBOLS},\s]')
+# Newlines, bullets and ';' or '|' always end an item; a comma only does right
+# after a price, and not inside one such as $1,200
+ITEM_BOUNDARY = re.compile(r'\n+\s*(?:[-*•]\s*)?|\s*[;|]\s*|(?<=\d)\s*,(?!\d{3}\b)\s*')
+JSON_BLOCK = re.compile(r'\{.*\}', re.DOTALL)
+
+EXTRACT_PROMPT = """Extract every product in the merchant's text below. Keep names as written, prices as numbers.
+Return JSON only: {"products": [{"name": "Green Tea", "price": 25, "image": "default"}]}"""
+
+# Shared by all requests so concurrent pastes can't exceed the upstream budget
+pool = ThreadPoolExecutor(max_workers=CATALOG_WORKERS, thread_name_prefix='catalog')
+
+# user_id -> progress of the extraction in flight, for the progress route
+progress: Dict[str, Dict[str, Any]] = {}
+# user_id -> when its extraction finished, oldest first, for expiry
+finished: 'OrderedDict[str, float]' = OrderedDict()
+progress_lock = threading.Lock()
+
+
+def looks_like_catalog(message: str) -> bool:
+    prices = len(PRICE.findall(message))
+    return prices >= CATALOG_MIN_ITEMS or (len(message) >= CATALOG_MIN_CHARS and prices >= CATALOG_LONG_MIN_ITEMS)
+
+
+def split_items(text: str) -> List[str]:
+    return [item.strip() for item in ITEM_BOUNDARY.split(text) if item and item.strip()]
+
+
+def chunk_items(items: List[str]) -> List[List[str]]:
+    """Group items so that one wave of the pool covers the whole paste"""
+    if not items:
+        return []
+    size = max(CATALOG_CHUNK_ITEMS, math.ceil(len(items) / CATALOG_WORKERS))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def parse_products(text: str) -> List[Dict[str, Any]]:
+    match = JSON_BLOCK.search(text)
+    if not match:
+        return []
+    try:
+        products = json.loads(match.group()).get('products') or []
+    except (ValueError, AttributeError):
+        return []
+    return normalize_products(products)
+
+
+def normalize_products(products) -> List[Dict[str, Any]]:
+    """Products with a name, numeric prices and an image; anything else is dropped"""
+    parsed = []
+    for product in products if isinstance(products, list) else []:
+        if not isinstance(product, dict) or not product.get('name'):
+            continue
+        try:
+            price = float(NOT_NUMERIC.sub('', str(product.get('price', 0))))
+        except ValueError:
+            price = 0.0
+        normalized = {
+            'name': str(product['name']).strip(),
+            'price': int(price) if price.is_integer() else price,
+            'image': product.get('image') or 'default'
+        }
+        if product.get('category'):
+            normalized['category'] = str(product['category']).strip()
+        parsed.append(normalized)
+    return parsed
+
+
+def product_key(product: Dict[str, Any]) -> str:
+    return ' '.join(str(product.get('name', '')).casefold().split())
+
+
+def merge_products(existing: List[Dict[str, Any]], extracted: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Existing products updated in place by name, followed by the new ones in paste order"""
+    merged = [dict(p) for p in existing or [] if isinstance(p, dict)]
+    index = {product_key(p): i for i, p in enumerate(merged)}
+    for product in extracted:
+        key = product_key(product)
+        if key in index:
+            current = merged[index[key]]
+            current['price'] = product['price']
+            if current.get('image') in (None, '', 'default'):
+                current['image'] = product['image']
+        else:
+            index[key] = len(merged)
+            merged.append(product)
+    return merged
+
+
+def merge_changes(existing: List[Dict[str, Any]], extracted: List[Dict[str, Any]]):
+    """merge_products, plus the products it appended and the existing ones it updated"""
+    merged = merge_products(existing, extracted)
+    kept = sum(1 for p in existing or [] if isinstance(p, dict))
+    touched = {product_key(p) for p in extracted}
+    updated = [p for p in merged[:kept] if product_key(p) in touched]
+    return merged, merged[kept:], updated
+
+
+def _expire_progress(now: float):
+    # Called with progress_lock held
+    while finished:
+        user_id, at = next(iter(finished.items()))
+        if now - at < CATALOG_PROGRESS_TTL:
+            break
+        del finished[user_id]
+        progress.pop(user_id, None)
+
+
+def _set_progress(user_id: Optional[str], **fields):
+    if not user_id:
+        return
+    now = time.monotonic()
+    with progress_lock:
+        _expire_progress(now)
+        status = fields.get('status')
+        if status is not None:
+            finished.pop(user_id, None)
+            if status == 'running':
+                # A new extraction doesn't inherit the last one's stats
+                progress.pop(user_id, None)
+            else:
+                finished[user_id] = now
+        progress.setdefault(user_id, {}).update(fields)
+
+
+def get_progress(user_id: str) -> Optional[Dict[str, Any]]:
+    with progress_lock:
+        _expire_progress(time.monotonic())
+        state = progress.get(user_id)
+        return dict(state) if state else None
+
+
+def extract_products(text: str, complete: Callable[[str, str, int], str], user_id: Optional[str] = None,
+                     on_progress: Optional[Callable[..., None]] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Extract products from a pasted catalog, one model call per chunk, all chunks at once
+
+    complete(system, chunk_text, max_tokens) returns the model's text. Chunks
+    that fail are counted and skipped so one bad call doesn't lose the paste.
+    on_progress gets the counts after each chunk; if it raises, the chunks not
+    started yet are dropped and the error propagates.
+    """
+    started = time.perf_counter()
+    chunks = chunk_items(split_items(text))
+    _set_progress(user_id, status='running', chunks=len(chunks), done=0, failed=0, products=0,
+                  started_at=time.time())
+
+    results: List[List[Dict[str, Any]]] = [[] for _ in chunks]
+    failed = 0
+    futures = {
+        pool.submit(complete, EXTRACT_PROMPT, '\n'.join(chunk),
+                    min(CATALOG_MAX_TOKENS, 100 + CATALOG_TOKENS_PER_ITEM * len(chunk))): index
+        for index, chunk in enumerate(chunks)
+    }
+    try:
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            try:
+                results[index] = parse_products(future.result())
+                if not results[index] and PRICE.search('\n'.join(chunks[index])):
+                    # Truncated or unparseable JSON: the chunk lists prices, so it had products
+                    raise ValueError('no products in reply')
+            except Exception as e:
+                print(f"Error extracting catalog chunk {index}: {e}")
+                failed += 1
+            counts = {'chunks': len(chunks), 'done': done, 'failed': failed,
+                      'products': sum(len(r) for r in results)}
+            _set_progress(user_id, **counts)
+            if on_progress is not None:
+                on_progress(**counts)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        _set_progress(user_id, status='stopped')
+        raise
+
+    # Dedupe within the paste, keeping chunk order so products stay in paste order
+    products = merge_products([], [p for chunk in results for p in chunk])
+    stats = {
+        'items': sum(len(chunk) for chunk in chunks),
+        'chunks': len(chunks),
+        'failed_chunks': failed,
+        'products': len(products),
+        'ms': round((time.perf_counter() - started) * 1000, 2)
+    }
+    _set_progress(user_id, status='done', **stats)
+    return products, stats
@@ -0,0 +1,401 @@
+import base64
+import json
+import math
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from flask import jsonify, request
+
+from catalog import NOT_NUMERIC, product_key
+from compression import json_response
+from metrics import record_cache, timed
+
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', 24))
+CATALOG_PAGE_MAX = int(os.getenv('CATALOG_PAGE_MAX', 200))
+# Indexes kept in memory, the least recently queried agent's dropped first
+CATALOG_INDEX_MAX_AGENTS = int(os.getenv('CATALOG_INDEX_MAX_AGENTS', 256))
+# Seconds an index for an agent without a live session is served before its row is re-read
+CATALOG_INDEX_TTL = float(os.getenv('CATALOG_INDEX_TTL', 30))
+
+SORTS = ('position', '-position', 'price', '-price', 'name', '-name')
+WORD = re.compile(r'\w+')
+# Rough cost of sorting one match relative to stepping over one product in a
+# sort order, for choosing between the two ways to answer a filtered query
+SORT_COST = 2
+# Prefix terms whose matches are kept per index, so paging through a search reuses them
+CATALOG_TERM_CACHE = int(os.getenv('CATALOG_TERM_CACHE', 64))
+# Changes to more than this share of the catalog rebuild the orders with one sort
+BULK_RATIO = 8
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _price(value: Any) -> float:
+    try:
+        price = float(NOT_NUMERIC.sub('', str(value)))
+    except ValueError:
+        return 0.0
+    return price if math.isfinite(price) else 0.0
+
+
+def _words(text: Any) -> List[str]:
+    return WORD.findall(str(text or '').casefold())
+
+
+def encode_cursor(sort: str, key) -> str:
+    raw = json.dumps([sort, key], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str], sort: str):
+    if not cursor:
+        return None
+    try:
+        cursor_sort, key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise QueryError('Invalid cursor')
+    if cursor_sort != sort:
+        raise QueryError('Cursor is for a different sort')
+    return tuple(key) if isinstance(key, list) else key
+
+
+def _valid_key(field: str, key) -> bool:
+    value_type = int if field == 'position' else str if field == 'name' else (int, float)
+    return isinstance(key, tuple) and len(key) == 2 and isinstance(key[0], value_type) and isinstance(key[1], int)
+
+
+class ProductIndex:
+    """One agent's products in the orders and lookups the catalog route queries
+
+    Each product gets a sequence number when first seen, the tiebreak in every
+    order; its position is its index in the last synced list. A position cursor
+    holds the seq too, so a page resumes after that product even if the list
+    changed in between (or at its old index if it was removed). Sorted
+    (key, seq) arrays hold the price and name orders and every word of every
+    name, so bisect finds a price range or the names with a word starting with
+    a prefix; categories map to sets of seqs.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version: Optional[int] = None
+        self.synced_at = 0.0
+        self.next_seq = 0
+        self.items: Dict[int, Dict[str, Any]] = {}
+        # seq -> (price, name key, words, category), to find a product's entries again
+        self.meta: Dict[int, Tuple[float, str, Tuple[str, ...], str]] = {}
+        # Seqs in the order of the last synced list, and each seq's index in it
+        self.listed: List[int] = []
+        self.rank: Dict[int, int] = {}
+        self.prices: List[Tuple[float, int]] = []
+        self.names: List[Tuple[str, int]] = []
+        self.words: List[Tuple[str, int]] = []
+        self.categories: Dict[str, Set[int]] = {}
+        self.terms: 'OrderedDict[str, Set[int]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _entries(self, seq: int):
+        price, name, words, _ = self.meta[seq]
+        yield self.prices, (price, seq)
+        yield self.names, (name, seq)
+        for word in words:
+            yield self.words, (word, seq)
+
+    def _drop(self, seqs: Set[int]):
+        if len(seqs) * BULK_RATIO > len(self.items):
+            self.prices = [entry for entry in self.prices if entry[1] not in seqs]
+            self.names = [entry for entry in self.names if entry[1] not in seqs]
+            self.words = [entry for entry in self.words if entry[1] not in seqs]
+        else:
+            for seq in seqs:
+                for order, entry in self._entries(seq):
+                    del order[bisect_left(order, entry)]
+        for seq in seqs:
+            category = self.meta.pop(seq)[3]
+            if category:
+                members = self.categories[category]
+                members.discard(seq)
+                if not members:
+                    del self.categories[category]
+            del self.items[seq]
+
+    def _insert(self, products: Dict[int, Dict[str, Any]]):
+        for seq, product in products.items():
+            category = str(product.get('category') or '').strip().casefold()
+            self.items[seq] = product
+            self.meta[seq] = (_price(product.get('price')), product_key(product),
+                              tuple(sorted(set(_words(product.get('name'))))), category)
+            if category:
+                self.categories.setdefault(category, set()).add(seq)
+        if len(products) * BULK_RATIO > len(self.items):
+            for seq in products:
+                for order, entry in self._entries(seq):
+                    order.append(entry)
+            for order in (self.prices, self.names, self.words):
+                order.sort()
+        else:
+            for seq in products:
+                for order, entry in self._entries(seq):
+                    insort(order, entry)
+
+    def sync(self, products: Optional[List[Dict[str, Any]]], version: Optional[int]) -> bool:
+        """Bring the index up to products as of version; False if it already was
+
+        The new list is walked against the old one, stepping over single
+        insertions and removals, so unchanged products cost one comparison. The
+        rest are matched to the old ones by name, and only the products added,
+        removed or edited touch the orders; a product keeps its position while
+        its name stays the same.
+        """
+        with self.lock:
+            self.synced_at = time.monotonic()
+            if version is not None and version == self.version:
+                return False
+            products = [product for product in products or [] if isinstance(product, dict)]
+            listed, items = self.listed, self.items
+            order: List[Optional[int]] = []
+            # (slot in order, index in products) of the products still to match
+            unmatched: List[Tuple[int, int]] = []
+            removed: List[int] = []
+            i = j = 0
+            while i < len(products) and j < len(listed):
+                if products[i] == items[listed[j]]:
+                    order.append(listed[j])
+                    i, j = i + 1, j + 1
+                    continue
+                if j + 1 < len(listed) and products[i] == items[listed[j + 1]]:
+                    removed.append(listed[j])
+                    j += 1
+                    continue
+                if not (i + 1 < len(products) and products[i + 1] == items[listed[j]]):
+                    # Neither an insertion nor a removal, so most likely an edit
+                    removed.append(listed[j])
+                    j += 1
+                unmatched.append((len(order), i))
+                order.append(None)
+                i += 1
+            removed.extend(listed[j:])
+            for i in range(i, len(products)):
+                unmatched.append((len(order), i))
+                order.append(None)
+
+            previous: Dict[str, List[int]] = {}
+            for seq in removed:
+                previous.setdefault(self.meta[seq][1], []).append(seq)
+            changed: Dict[int, Optional[Dict[str, Any]]] = {}
+            for slot, i in unmatched:
+                product = products[i]
+                matches = previous.get(product_key(product))
+                if matches:
+                    seq = matches.pop(0)
+                    if items[seq] != product:
+                        changed[seq] = dict(product)
+                else:
+                    seq = self.next_seq
+                    self.next_seq += 1
+                    changed[seq] = dict(product)
+                order[slot] = seq
+            for seqs in previous.values():
+                changed.update((seq, None) for seq in seqs)
+
+            self._drop({seq for seq in changed if seq in items})
+            self._insert({seq: product for seq, product in changed.items() if product is not None})
+            self.listed = order
+            self.rank = {seq: i for i, seq in enumerate(order)}
+            self.terms.clear()
+            self.version = version
+            return True
+
+    def _matching(self, q: Optional[str], category: Optional[str]) -> Optional[Set[int]]:
+        """Seqs passing the text and category filters, or None if neither is set"""
+        sets = [self._term(term) for term in set(_words(q))]
+        if category:
+            sets.append(self.categories.get(category.strip().casefold(), set()))
+        if not sets:
+            return None
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:]) if len(sets) > 1 else sets[0]
+
+    def _term(self, term: str) -> Set[int]:
+        """Seqs of the products with a name word starting with term"""
+        seqs = self.terms.get(term)
+        if seqs is None:
+            lo, hi = bisect_left(self.words, (term,)), bisect_left(self.words, (term + '\U0010ffff',))
+            seqs = self.terms[term] = {seq for _, seq in self.words[lo:hi]}
+            while len(self.terms) > CATALOG_TERM_CACHE:
+                self.terms.popitem(last=False)
+        else:
+            self.terms.move_to_end(term)
+        return seqs
+
+    def _key(self, field: str, seq: int):
+        if field == 'position':
+            return self.rank[seq]
+        price, name = self.meta[seq][:2]
+        return (price if field == 'price' else name, seq)
+
+    def query(self, q: Optional[str] = None, category: Optional[str] = None,
+              min_price: Optional[float] = None, max_price: Optional[float] = None,
+              sort: str = 'position', limit: int = CATALOG_PAGE_SIZE,
+              cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """A page of matching products and the cursor for the next page, None on the last"""
+        if sort not in SORTS:
+            raise QueryError(f"sort must be one of {', '.join(SORTS)}")
+        after = decode_cursor(cursor, sort)
+        field, descending = sort.lstrip('-'), sort.startswith('-')
+        if after is not None and not _valid_key(field, after):
+            raise QueryError('Invalid cursor')
+        lo = -math.inf if min_price is None else min_price
+        hi = math.inf if max_price is None else max_price
+
+        with self.lock:
+            if after is not None and field == 'position':
+                after = self.rank.get(after[1], after[0])
+            allowed = self._matching(q, category)
+            # Walking the order finds a page after about limit * len / matches steps
+            if allowed is not None and len(allowed) ** 2 * SORT_COST < (limit + 1) * len(self.items):
+                keys = [self._key(field, seq) for seq in allowed if lo <= self.meta[seq][0] <= hi]
+                if after is not None:
+                    keys = [key for key in keys if (key < after if descending else key > after)]
+                keys.sort(reverse=descending)
+                page = [self.listed[key] if field == 'position' else key[1] for key in keys[:limit + 1]]
+            else:
+                order = {'position': self.listed, 'price': self.prices, 'name': self.names}[field]
+                start, end = 0, len(order)
+                if field == 'price':
+                    start, end = bisect_left(order, (lo, -1)), bisect_right(order, (hi, math.inf))
+                if after is not None and field == 'position':
+                    # A position is its index in listed
+                    if descending:
+                        end = min(end, max(0, after))
+                    else:
+                        start = max(start, after + 1)
+                elif after is not None:
+                    if descending:
+                        end = min(end, bisect_left(order, after))
+                    else:
+                        start = max(start, bisect_right(order, after))
+                page = []
+                for i in (range(end - 1, start - 1, -1) if descending else range(start, end)):
+                    seq = order[i] if field == 'position' else order[i][1]
+                    if allowed is not None and seq not in allowed:
+                        continue
+                    if field != 'price' and not lo <= self.meta[seq][0] <= hi:
+                        continue
+                    page.append(seq)
+                    if len(page) > limit:
+                        break
+
+            more = len(page) > limit
+            page = page[:limit]
+            next_cursor = None
+            if more:
+                last = page[-1]
+                key = (self.rank[last], last) if field == 'position' else self._key(field, last)
+                next_cursor = encode_cursor(sort, key)
+            return [self.items[seq] for seq in page], next_cursor
+
+
+class IndexRegistry:
+    """Product indexes by agent id, bounded to the most recently queried agents"""
+
+    def __init__(self, max_agents: int = CATALOG_INDEX_MAX_AGENTS):
+        self.max_agents = max_agents
+        self.indexes: 'OrderedDict[str, ProductIndex]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, agent_id: str) -> Optional[ProductIndex]:
+        with self.lock:
+            index = self.indexes.get(agent_id)
+            if index is not None:
+                self.indexes.move_to_end(agent_id)
+            return index
+
+    def sync(self, agent_id: str, version: Optional[int], products) -> ProductIndex:
+        with self.lock:
+            index = self.indexes.get(agent_id)
+            if index is None:
+                index = self.indexes[agent_id] = ProductIndex()
+                while len(self.indexes) > self.max_agents:
+                    self.indexes.popitem(last=False)
+            self.indexes.move_to_end(agent_id)
+        record_cache('catalog_index', not index.sync(products, version))
+        return index
+
+
+registry = IndexRegistry()
+
+
+def query_options(args) -> Dict[str, Any]:
+    try:
+        min_price = float(args['min_price']) if args.get('min_price') else None
+        max_price = float(args['max_price']) if args.get('max_price') else None
+        limit = max(1, min(int(args.get('limit', CATALOG_PAGE_SIZE)), CATALOG_PAGE_MAX))
+    except ValueError:
+        raise QueryError('min_price and max_price must be numbers and limit an integer')
+    return {
+        'q': args.get('q') or None,
+        'category': args.get('category') or None,
+        'min_price': min_price,
+        'max_price': max_price,
+        'sort': args.get('sort', 'position'),
+        'limit': limit,
+        'cursor': args.get('cursor') or None,
+    }
+
+
+def init_app(app, live_products: Callable[[str], Optional[Tuple[int, List[Dict[str, Any]]]]],
+             load_products: Callable[[str], Optional[Tuple[int, List[Dict[str, Any]]]]]):
+    """Register the catalog query route
+
+    live_products returns (version, products) from an agent's cached session and
+    load_products the same from its stored row; both return None for no agent.
+    """
+
+    def resolve(agent_id: str) -> Optional[ProductIndex]:
+        live = live_products(agent_id)
+        if live is not None:
+            return registry.sync(agent_id, *live)
+        index = registry.get(agent_id)
+        if index is None or time.monotonic() - index.synced_at > CATALOG_INDEX_TTL:
+            stored = load_products(agent_id)
+            if stored is None:
+                return None
+            index = registry.sync(agent_id, *stored)
+        return index
+
+    @app.route('/api/agents/<agent_id>/products', methods=['GET'])
+    def agent_products(agent_id):
+        try:
+            options = query_options(request.args)
+        except QueryError as e:
+            return jsonify({'error': str(e)}), 400
+
+        try:
+            index = resolve(agent_id)
+        except Exception as e:
+            print(f"Error loading catalog for {agent_id}: {e}")
+            return jsonify({'error': 'Could not load products'}), 502
+        if index is None:
+            return jsonify({'error': 'Agent not found'}), 404
+
+        try:
+            with timed('catalog_query'):
+                products, next_cursor = index.query(**options)
+        except QueryError as e:
+            return jsonify({'error': str(e)}), 400
+        return json_response({
+            'products': products,
+            'next_cursor': next_cursor,
+            'catalog_size': len(index),
+            'version': index.version
+        })
@@ -0,0 +1,86 @@
+import importlib
+import os
+import threading
+import time
+from typing import Any, Dict
+
+# Importing anthropic and supabase costs roughly a second of cold start, so
+# neither is imported until the first request (or /healthz/warm) needs it.
+# Every import and client construction is timed into STARTUP_REPORT.
+STARTUP_REPORT: Dict[str, float] = {}
+PROCESS_STARTED = time.perf_counter()
+
+_clients: Dict[str, Any] = {}
+_locks = {'claude': threading.Lock(), 'supabase': threading.Lock()}
+
+
+def record_startup(step: str, started: float):
+    STARTUP_REPORT[step] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def _import(module: str):
+    started = time.perf_counter()
+    imported = importlib.import_module(module)
+    record_startup(f"import_{module.split('.')[0]}_ms", started)
+    return imported
+
+
+def _build_claude():
+    anthropic = _import('anthropic')
+    started = time.perf_counter()
+    client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+    record_startup('init_claude_ms', started)
+    return client
+
+
+def _build_supabase():
+    supabase = _import('supabase')
+    started = time.perf_counter()
+    client = supabase.create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_KEY"))
+    record_startup('init_supabase_ms', started)
+    return client
+
+
+def _get(name: str, build):
+    client = _clients.get(name)
+    if client is None:
+        with _locks[name]:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = build()
+    return client
+
+
+def get_claude():
+    """The shared Anthropic client, built on first use"""
+    return _get('claude', _build_claude)
+
+
+def get_supabase():
+    """The shared Supabase client, built on first use"""
+    return _get('supabase', _build_supabase)
+
+
+def startup_report() -> Dict[str, Any]:
+    return {
+        'steps_ms': dict(STARTUP_REPORT),
+        'uptime_s': round(time.perf_counter() - PROCESS_STARTED, 2),
+        'clients_ready': sorted(_clients),
+    }
+
+
+def warm() -> Dict[str, Any]:
+    """Build both clients and open a pooled connection to each upstream"""
+    checks = {}
+    for name, ping_upstream in (
+        ('supabase', lambda: get_supabase().table('agents').select('id').limit(1).execute()),
+        ('claude', lambda: get_claude().models.list(limit=1)),
+    ):
+        started = time.perf_counter()
+        try:
+            ping_upstream()
+            checks[name] = {'ok': True}
+        except Exception as e:
+            checks[name] = {'ok': False, 'error': str(e)}
+        checks[name]['ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return checks
@@ -0,0 +1,172 @@
+import json
+import os
+import time
+import zlib
+from typing import Any, Iterator
+
+from flask import Response, g, jsonify, request
+
+from metrics import Counter, Histogram
+
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+# Responses with at least this many list items in total are encoded as a stream
+STREAM_JSON_MIN_ITEMS = int(os.getenv('STREAM_JSON_MIN_ITEMS', 500))
+STREAM_CHUNK_BYTES = int(os.getenv('STREAM_CHUNK_BYTES', 64 * 1024))
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/')
+
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+CPU_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+compression_ratio = Histogram('response_compression_ratio', 'Compressed size over original size',
+                              ('endpoint', 'encoding'), buckets=RATIO_BUCKETS)
+compression_cpu_seconds = Histogram('response_compression_cpu_seconds', 'CPU time spent compressing a response',
+                                    ('endpoint', 'encoding'), buckets=CPU_BUCKETS)
+response_bytes = Counter('response_bytes_total', 'Response body bytes before and after compression',
+                         ('endpoint', 'encoding', 'stage'))
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate() -> str:
+    """The best encoding the client accepts, or '' for identity"""
+    return request.accept_encodings.best_match(_encodings()) or ''
+
+
+class Compressor:
+    """Incremental gzip or brotli compressor with one interface"""
+
+    def __init__(self, encoding: str):
+        if encoding == 'br':
+            self.impl = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress, self.finish = self.impl.process, self.impl.finish
+        else:
+            self.impl = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.compress, self.finish = self.impl.compress, self.impl.flush
+
+
+def record(endpoint: str, encoding: str, raw: int, sent: int, cpu: float):
+    compression_ratio.observe(sent / raw if raw else 1.0, endpoint, encoding)
+    compression_cpu_seconds.observe(cpu, endpoint, encoding)
+    response_bytes.inc(endpoint, encoding, 'raw', amount=raw)
+    response_bytes.inc(endpoint, encoding, 'sent', amount=sent)
+
+
+def compress_stream(chunks: Iterator[bytes], encoding: str, endpoint: str):
+    compressor = Compressor(encoding)
+    raw = sent = 0
+    cpu = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            started = time.thread_time()
+            out = compressor.compress(chunk)
+            cpu += time.thread_time() - started
+            raw += len(chunk)
+            if out:
+                sent += len(out)
+                yield out
+        started = time.thread_time()
+        out = compressor.finish()
+        cpu += time.thread_time() - started
+        sent += len(out)
+        yield out
+    finally:
+        record(endpoint, encoding, raw, sent, cpu)
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+def _count_items(value: Any, depth: int = 2) -> int:
+    if isinstance(value, list):
+        return len(value)
+    if isinstance(value, dict) and depth:
+        return sum(_count_items(v, depth - 1) for v in value.values())
+    return 0
+
+
+def iter_json(value: Any) -> Iterator[str]:
+    """Encode value as JSON piece by piece, one list item or dict member at a time"""
+    if isinstance(value, dict):
+        yield '{'
+        for index, (key, member) in enumerate(value.items()):
+            yield ('{}:' if not index else ',{}:').format(json.dumps(str(key)))
+            yield from iter_json(member)
+        yield '}'
+    elif isinstance(value, list) and len(value) > 1:
+        yield '['
+        for index, item in enumerate(value):
+            if index:
+                yield ','
+            yield json.dumps(item, default=str, separators=(',', ':'))
+        yield ']'
+    else:
+        yield json.dumps(value, default=str, separators=(',', ':'))
+
+
+def _batched(pieces: Iterator[str]) -> Iterator[bytes]:
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_BYTES:
+            yield ''.join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def json_response(payload: Any, status: int = 200) -> Response:
+    """jsonify, except that payloads with large lists are streamed instead of built in memory"""
+    if _count_items(payload) < STREAM_JSON_MIN_ITEMS:
+        response = jsonify(payload)
+        response.status_code = status
+        return response
+    return Response(_batched(iter_json(payload)), status=status, mimetype='application/json')
+
+
+def init_app(app):
+    """Compress JSON and text responses for clients that accept gzip or brotli"""
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or not (response.mimetype or '').startswith(COMPRESSIBLE)
+                # Compressing would buffer server-sent events until a block fills
+                or response.mimetype == 'text/event-stream'):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate()
+        if not encoding:
+            return response
+        endpoint = request.endpoint or 'unknown'
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, endpoint)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < COMPRESS_MIN_BYTES:
+                return response
+            started = time.thread_time()
+            compressor = Compressor(encoding)
+            body = compressor.compress(data) + compressor.finish()
+            cpu = time.thread_time() - started
+            record(endpoint, encoding, len(data), len(body), cpu)
+            if 'stage_timings' in g:
+                g.stage_timings['compress'] = g.stage_timings.get('compress', 0) + cpu
+            response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        return response
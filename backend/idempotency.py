@@ -0,0 +1,137 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Optional
+
+from flask import Response, jsonify, make_response, request
+
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 300))
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 60))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 10000))
+# Statuses that ask the client to retry (a lost write race, a throttle), so
+# replaying them would turn the retry into the same error
+RETRY_STATUSES = (409, 429)
+# Not stored with a response: hop-by-hop, or recomputed for the replayed body
+UNSTORED_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                    'transfer-encoding', 'upgrade', 'content-length', 'date', 'set-cookie'}
+
+
+class Entry:
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result = None
+        self.expires_at = time.monotonic() + IDEMPOTENCY_TTL
+
+
+class IdempotencyStore:
+    """Short-lived map of idempotency key -> in-flight or finished response"""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _sweep(self, now: float):
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry.expires_at > now and len(self.entries) <= IDEMPOTENCY_MAX_ENTRIES:
+                break
+            self.entries.popitem(last=False)
+
+    def begin(self, key: str, fingerprint: str):
+        """Claim a key. Returns (entry, True) for the first caller, (entry, False) for duplicates"""
+        with self.lock:
+            now = time.monotonic()
+            self._sweep(now)
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                return entry, False
+            entry = self.entries[key] = Entry(fingerprint)
+            return entry, True
+
+    def finish(self, key: str, entry: Entry, result):
+        """Store the response, or release the key when result is None so a retry can run"""
+        with self.lock:
+            if result is None and self.entries.get(key) is entry:
+                del self.entries[key]
+            entry.result = result
+        entry.done.set()
+
+
+store = IdempotencyStore()
+
+
+def _json_body() -> dict:
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
+def request_key() -> Optional[str]:
+    header = request.headers.get('Idempotency-Key')
+    if header:
+        return header
+    data = _json_body()
+    return data.get('client_message_id') or data.get('clientMessageId')
+
+
+def request_user() -> str:
+    """The user a request acts for, so keys such as per-session counters can't collide across users"""
+    data = _json_body()
+    user_id = (request.view_args or {}).get('user_id') or data.get('user_id') or data.get('userId')
+    if not user_id and isinstance(data.get('agentData'), dict):
+        user_id = data['agentData'].get('userId')
+    return str(user_id or '')
+
+
+def replay(result):
+    body, status, headers = result
+    response = Response(body, status=status, headers=headers)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Run a POST view at most once per Idempotency-Key (or client message id)
+
+    A duplicate that arrives while the first request is running waits for it;
+    later duplicates get the stored response. 5xx, 409 and 429 results and
+    exceptions are not stored, so a client retry after a failure runs again.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request_key()
+        if not key:
+            return view(*args, **kwargs)
+
+        body = request.get_data()
+        fingerprint = hashlib.sha256(body).hexdigest()
+        scoped_key = f"{request.endpoint}:{request_user()}:{key}"
+        entry, owner = store.begin(scoped_key, fingerprint)
+
+        if not owner:
+            if entry.fingerprint != fingerprint:
+                return jsonify({'error': 'Idempotency-Key reused with a different request body'}), 422
+            if not entry.done.wait(IDEMPOTENCY_WAIT):
+                return jsonify({'error': 'Original request is still in progress'}), 409
+            if entry.result is None:
+                # The original failed; run this one ourselves
+                return wrapper(*args, **kwargs)
+            return replay(entry.result)
+
+        result = None
+        try:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code < 500 and response.status_code not in RETRY_STATUSES:
+                # A streamed body is buffered here so it can be replayed
+                headers = [(name, value) for name, value in response.headers.items()
+                           if name.lower() not in UNSTORED_HEADERS]
+                result = (response.get_data(), response.status_code, headers)
+            return response
+        finally:
+            store.finish(scoped_key, entry, result)
+
+    return wrapper
@@ -0,0 +1,556 @@
+import atexit
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional
+
+from flask import Response, jsonify, request, stream_with_context
+
+from admin import require_admin
+from metrics import Counter, Gauge, Histogram
+from resilience import backoff_delay
+
+# Jobs live in one SQLite file, so every process on the machine sharing it
+# shares the queue: any of them with a handler for a kind may claim its jobs.
+# JOBS_WORKERS=0 only enqueues, for processes that leave the work to others.
+# The file is created on first use and workers start with JobQueue.start or
+# the first enqueue, not on import.
+JOBS_DB = os.getenv('JOBS_DB', os.path.join(os.path.dirname(__file__), 'jobs.db'))
+JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', 4))
+# 'thread' runs handlers on the worker threads; 'process' sends them to a pool of
+# as many processes, except handlers registered threads_only
+JOBS_POOL = os.getenv('JOBS_POOL', 'thread')
+JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', 3))
+JOBS_BACKOFF_BASE = float(os.getenv('JOBS_BACKOFF_BASE', 2))
+JOBS_BACKOFF_MAX = float(os.getenv('JOBS_BACKOFF_MAX', 300))
+# Idle workers look for due jobs this often; an enqueue in this process wakes one at once
+JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 1))
+# A running job's lease is renewed while its process lives; once it runs out
+# the job is queued again (or failed, out of attempts)
+JOBS_LEASE = float(os.getenv('JOBS_LEASE', 60))
+JOBS_RETENTION = float(os.getenv('JOBS_RETENTION', 7 * 86400))
+JOBS_SSE_INTERVAL = float(os.getenv('JOBS_SSE_INTERVAL', 0.5))
+JOBS_SSE_KEEPALIVE = float(os.getenv('JOBS_SSE_KEEPALIVE', 15))
+JOBS_LIST_MAX = int(os.getenv('JOBS_LIST_MAX', 200))
+
+STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+TERMINAL = ('succeeded', 'failed', 'cancelled')
+JSON_COLUMNS = ('payload', 'progress', 'result')
+# Internal columns the job routes leave out; payloads can be whole catalogs
+PRIVATE_COLUMNS = ('payload', 'lease_until', 'cancel_requested')
+
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+jobs_total = Counter('jobs_total', 'Finished job attempts by kind and outcome', ('kind', 'outcome'))
+job_run_seconds = Histogram('job_run_seconds', 'Time a job attempt ran', ('kind',), buckets=JOB_BUCKETS)
+job_wait_seconds = Histogram('job_queue_wait_seconds', 'Time from a job being due to a worker claiming it',
+                             ('kind',), buckets=JOB_BUCKETS)
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler once its job has been cancelled"""
+
+
+class JobFailed(Exception):
+    """A handler error that retrying won't fix; the job fails without further attempts"""
+
+
+class JobLost(Exception):
+    """Raised inside a handler whose lease ran out and whose job another worker has claimed since"""
+
+
+class JobStore:
+    """The jobs table, with one connection per thread
+
+    A running job's attempts count fences its writes: progress, retry and
+    finish only apply while the row is still running under the attempt that
+    claimed it, so a worker whose lease ran out can't overwrite the next one.
+    """
+
+    def __init__(self, path: str = JOBS_DB):
+        self.path = path
+        self.local = threading.local()
+        # Notified on every write from this process; SSE streams wait on it
+        self.changed = threading.Condition()
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        with self.schema_lock:
+            if self.schema_ready:
+                return
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id TEXT, payload TEXT, "
+                "status TEXT NOT NULL, progress TEXT, result TEXT, error TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0, run_after REAL NOT NULL, lease_until REAL, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_due_idx ON jobs (status, run_after)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_user_idx ON jobs (user_id, created_at)")
+            self.schema_ready = True
+
+    def connect(self) -> sqlite3.Connection:
+        """This thread's connection, opening the database (and creating the table) on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._create_schema(conn)
+            self.local.conn = conn
+        return conn
+
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    @staticmethod
+    def _decode(row) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        for column in JSON_COLUMNS:
+            job[column] = json.loads(job[column]) if job[column] else None
+        return job
+
+    def insert(self, kind: str, payload: Any, user_id: Optional[str], max_attempts: int,
+               delay: float = 0) -> Dict[str, Any]:
+        now = time.time()
+        job_id = str(uuid.uuid4())
+        self.connect().execute(
+            "INSERT INTO jobs (id, kind, user_id, payload, status, progress, max_attempts, run_after, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', '{}', ?, ?, ?, ?)",
+            (job_id, kind, user_id, json.dumps(payload, default=str), max_attempts, now + delay, now, now),
+        )
+        self._notify()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._decode(self.connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def list(self, status: Optional[str] = None, kind: Optional[str] = None, user_id: Optional[str] = None,
+             limit: int = 50) -> List[Dict[str, Any]]:
+        """Newest first"""
+        where, params = [], []
+        for column, value in (('status', status), ('kind', kind), ('user_id', user_id)):
+            if value:
+                where.append(f"{column} = ?")
+                params.append(value)
+        sql = "SELECT * FROM jobs" + (" WHERE " + " AND ".join(where) if where else "")
+        rows = self.connect().execute(sql + " ORDER BY created_at DESC LIMIT ?", params + [limit]).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        rows = self.connect().execute("SELECT status, count(*) FROM jobs GROUP BY status").fetchall()
+        return dict.fromkeys(STATUSES, 0) | {status: count for status, count in rows}
+
+    def claim(self, kinds: List[str], lease: float) -> Optional[Dict[str, Any]]:
+        """Mark the longest-due queued job of one of kinds as running and return it"""
+        if not kinds:
+            return None
+        conn = self.connect()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so two processes can't claim the same row
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ? "
+                f"AND kind IN ({', '.join('?' * len(kinds))}) ORDER BY run_after LIMIT 1",
+                [now] + list(kinds),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, "
+                    "started_at = coalesce(started_at, ?), updated_at = ? WHERE id = ?",
+                    (now + lease, now, now, row['id']),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        self._notify()
+        return self.get(row['id'])
+
+    def set_progress(self, job_id: str, attempt: int, progress: Dict[str, Any], lease: float) -> bool:
+        """Save a running attempt's progress and renew its lease; False if the attempt lost the job"""
+        now = time.time()
+        updated = self.connect().execute(
+            "UPDATE jobs SET progress = ?, lease_until = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'running' AND attempts = ?",
+            (json.dumps(progress, default=str), now + lease, now, job_id, attempt),
+        ).rowcount
+        if updated:
+            self._notify()
+        return bool(updated)
+
+    def cancel_requested(self, job_id: str) -> bool:
+        row = self.connect().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def finish(self, job_id: str, attempt: int, status: str, result: Any = None,
+               error: Optional[str] = None) -> bool:
+        """End a running attempt; False (and nothing written) if the attempt lost the job"""
+        now = time.time()
+        updated = self.connect().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = NULL, finished_at = ?, "
+            "updated_at = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+            (status, json.dumps(result, default=str) if result is not None else None, error, now, now,
+             job_id, attempt),
+        ).rowcount
+        if updated:
+            self._notify()
+        return bool(updated)
+
+    def retry(self, job_id: str, attempt: int, delay: float, error: str) -> bool:
+        """Queue a running attempt's job again; False (and nothing written) if the attempt lost the job"""
+        now = time.time()
+        updated = self.connect().execute(
+            "UPDATE jobs SET status = 'queued', error = ?, lease_until = NULL, run_after = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'running' AND attempts = ?",
+            (error, now + delay, now, job_id, attempt),
+        ).rowcount
+        if updated:
+            self._notify()
+        return bool(updated)
+
+    def request_cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancel a queued job now, or flag a running one for its handler to stop"""
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'queued'", (now, now, job_id))
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ? AND status = 'running'",
+                (now, job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify()
+        return self.get(job_id)
+
+    def renew(self, job_ids: List[str], lease: float):
+        if not job_ids:
+            return
+        self.connect().execute(
+            f"UPDATE jobs SET lease_until = ? WHERE status = 'running' AND id IN ({', '.join('?' * len(job_ids))})",
+            [time.time() + lease] + list(job_ids),
+        )
+
+    def expire(self) -> int:
+        """Queue again the running jobs whose process stopped renewing them; fail those out of attempts"""
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            failed = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Worker lost', finished_at = ?, updated_at = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts", (now, now, now)
+            ).rowcount
+            requeued = conn.execute(
+                "UPDATE jobs SET status = 'queued', error = 'Worker lost', run_after = ?, updated_at = ? "
+                "WHERE status = 'running' AND lease_until < ?", (now, now, now)
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if failed or requeued:
+            self._notify()
+        return failed + requeued
+
+    def purge(self, older_than: float) -> int:
+        cutoff = time.time() - older_than
+        return self.connect().execute(
+            f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(TERMINAL))}) AND finished_at < ?",
+            list(TERMINAL) + [cutoff],
+        ).rowcount
+
+
+class JobContext:
+    """What a handler gets: its payload, and progress reporting that doubles as a cancellation check"""
+
+    def __init__(self, store: JobStore, job: Dict[str, Any]):
+        self.store = store
+        self.id = job['id']
+        self.kind = job['kind']
+        self.user_id = job['user_id']
+        self.payload = job['payload']
+        self.attempt = job['attempts']
+        self.state = dict(job.get('progress') or {})
+
+    def progress(self, **fields):
+        """Merge fields into the job's progress; raises JobCancelled if the job was cancelled
+
+        Raises JobLost instead if another worker has claimed the job since.
+        """
+        self.state.update(fields)
+        if not self.store.set_progress(self.id, self.attempt, self.state, JOBS_LEASE):
+            raise JobLost(self.id)
+        if self.store.cancel_requested(self.id):
+            raise JobCancelled(self.id)
+
+    def check(self):
+        if self.store.cancel_requested(self.id):
+            raise JobCancelled(self.id)
+
+
+# path -> store, in a pool process
+_process_stores: Dict[str, 'JobStore'] = {}
+
+
+def run_in_process(fn: Callable[[JobContext], Any], path: str, job: Dict[str, Any]):
+    """Entry point in a pool process, which opens the job database once and keeps it"""
+    store = _process_stores.get(path)
+    if store is None:
+        store = _process_stores[path] = JobStore(path)
+    return fn(JobContext(store, job))
+
+
+class Handler:
+    def __init__(self, fn: Callable[[JobContext], Any], max_attempts: int, threads_only: bool):
+        self.fn = fn
+        self.max_attempts = max_attempts
+        self.threads_only = threads_only
+
+
+class JobQueue:
+    """Worker threads claiming jobs from the store and running their handlers
+
+    Handlers take a JobContext and return a JSON-serializable result. Raising
+    retries the job after a jittered exponential backoff, up to its attempts;
+    JobFailed fails it at once. Handlers sent to the process pool must be
+    module-level functions, since they are pickled by name.
+    """
+
+    def __init__(self, store: Optional[JobStore] = None, workers: int = JOBS_WORKERS, pool: str = JOBS_POOL):
+        self.store = store or JobStore()
+        self.workers = workers
+        self.pool = pool
+        self.handlers: Dict[str, Handler] = {}
+        self.running: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        self.stopping = threading.Event()
+        self.threads: List[threading.Thread] = []
+        self.processes: Optional[ProcessPoolExecutor] = None
+
+    def register(self, kind: str, fn: Callable[[JobContext], Any], max_attempts: int = JOBS_MAX_ATTEMPTS,
+                 threads_only: bool = False):
+        """Run jobs of kind with fn; threads_only keeps handlers that use the serving process's state off the pool"""
+        self.handlers[kind] = Handler(fn, max_attempts, threads_only)
+
+    def enqueue(self, kind: str, payload: Any = None, user_id: Optional[str] = None,
+                delay: float = 0) -> Dict[str, Any]:
+        """Store a job and wake a worker, starting this process's workers if nothing has yet"""
+        self.start()
+        handler = self.handlers.get(kind)
+        job = self.store.insert(kind, payload, user_id, handler.max_attempts if handler else JOBS_MAX_ATTEMPTS,
+                                delay)
+        with self.wakeup:
+            self.wakeup.notify()
+        return job
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.request_cancel(job_id)
+
+    def start(self):
+        """Start the worker and maintenance threads; later calls do nothing"""
+        if self.workers <= 0 or self.threads:
+            return
+        with self.lock:
+            if self.threads:
+                return
+            if self.pool == 'process':
+                self.processes = self._process_pool()
+            self.store.expire()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            thread = threading.Thread(target=self._maintain, name='job-maintenance', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        atexit.register(self.stop)
+
+    def stop(self, timeout: float = 5):
+        """Stop claiming jobs and wait briefly for running ones; the rest resume after their lease"""
+        self.stopping.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        if self.processes is not None:
+            self.processes.shutdown(wait=False, cancel_futures=True)
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked: forking a process with running threads can copy held locks
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.store.claim(list(self.handlers), JOBS_LEASE)
+            except sqlite3.Error as e:
+                print(f"Error claiming a job: {e}")
+                job = None
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(JOBS_POLL_INTERVAL)
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict[str, Any]):
+        kind = job['kind']
+        handler = self.handlers[kind]
+        # updated_at is the claim time
+        job_wait_seconds.observe(max(0.0, job['updated_at'] - job['run_after']), kind)
+        with self.lock:
+            self.running[job['id']] = time.time()
+        started = time.perf_counter()
+        try:
+            if self.processes is not None and not handler.threads_only:
+                result = self.processes.submit(run_in_process, handler.fn, self.store.path, job).result()
+            else:
+                result = handler.fn(JobContext(self.store, job))
+        except JobLost:
+            outcome = self._lost(job)
+        except JobCancelled:
+            outcome = 'cancelled' if self.store.finish(job['id'], job['attempts'], 'cancelled') else self._lost(job)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # A pool process died mid-job; later jobs need a working pool
+                self.processes = self._process_pool()
+            outcome = self._failed(job, handler, e)
+        else:
+            try:
+                if self.store.finish(job['id'], job['attempts'], 'succeeded', result=result):
+                    outcome = 'succeeded'
+                else:
+                    outcome = self._lost(job)
+            except (TypeError, ValueError) as e:
+                outcome = self._failed(job, handler, JobFailed(f"Result is not JSON-serializable: {e}"))
+        finally:
+            with self.lock:
+                self.running.pop(job['id'], None)
+        job_run_seconds.observe(time.perf_counter() - started, kind)
+        jobs_total.inc(kind, outcome)
+
+    def _failed(self, job: Dict[str, Any], handler: Handler, error: Exception) -> str:
+        message = f"{type(error).__name__}: {error}"
+        attempt = job['attempts']
+        if self.store.cancel_requested(job['id']):
+            status = 'cancelled'
+        elif isinstance(error, JobFailed) or attempt >= handler.max_attempts:
+            status = 'failed'
+        else:
+            delay = backoff_delay(attempt - 1, JOBS_BACKOFF_BASE, JOBS_BACKOFF_MAX)
+            return 'retried' if self.store.retry(job['id'], attempt, delay, message) else self._lost(job)
+        if not self.store.finish(job['id'], attempt, status, error=message):
+            return self._lost(job)
+        if status == 'failed':
+            print(f"Job {job['id']} ({job['kind']}) failed after {attempt} attempts: {message}")
+        return status
+
+    def _lost(self, job: Dict[str, Any]) -> str:
+        print(f"Dropping attempt {job['attempts']} of job {job['id']} ({job['kind']}): it no longer owns the job")
+        return 'lost'
+
+    def _maintain(self):
+        """Renew this process's leases, recover jobs from dead processes and purge old ones"""
+        next_purge = 0.0
+        while not self.stopping.wait(JOBS_LEASE / 3):
+            try:
+                with self.lock:
+                    running = list(self.running)
+                self.store.renew(running, JOBS_LEASE)
+                self.store.expire()
+                if time.monotonic() >= next_purge:
+                    self.store.purge(JOBS_RETENTION)
+                    next_purge = time.monotonic() + 3600
+            except sqlite3.Error as e:
+                print(f"Error maintaining jobs: {e}")
+
+
+def public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in job.items() if key not in PRIVATE_COLUMNS}
+
+
+def init_app(app, queue: JobQueue):
+    """Register the job status, events and cancel routes; the workers start separately"""
+    Gauge('jobs', 'Jobs by status in the job database', ('status',),
+          collect=lambda: {(status,): count for status, count in queue.store.counts().items()})
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = queue.store.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(public_job(job))
+
+    @app.route('/api/jobs/<job_id>/events', methods=['GET'])
+    def job_events(job_id):
+        if queue.store.get(job_id) is None:
+            return jsonify({'error': 'Job not found'}), 404
+
+        def events():
+            last_update, last_sent = None, time.monotonic()
+            while True:
+                job = queue.store.get(job_id)
+                if job is None:
+                    return
+                if job['updated_at'] != last_update:
+                    last_update, last_sent = job['updated_at'], time.monotonic()
+                    yield f"event: {job['status']}\ndata: {json.dumps(public_job(job), default=str)}\n\n"
+                    if job['status'] in TERMINAL:
+                        return
+                elif time.monotonic() - last_sent >= JOBS_SSE_KEEPALIVE:
+                    last_sent = time.monotonic()
+                    yield ": keepalive\n\n"
+                # Writes from this process wake the stream early; other processes' show up on the next poll
+                with queue.store.changed:
+                    queue.store.changed.wait(JOBS_SSE_INTERVAL)
+
+        response = Response(stream_with_context(events()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    @app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+    def cancel_job(job_id):
+        job = queue.cancel(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        if job['status'] in ('succeeded', 'failed'):
+            return jsonify({'error': f"Job already {job['status']}", 'job': public_job(job)}), 409
+        return jsonify(public_job(job))
+
+    @app.route('/api/admin/jobs', methods=['GET'])
+    @require_admin
+    def list_jobs():
+        status = request.args.get('status')
+        if status and status not in STATUSES:
+            return jsonify({'error': f"status must be one of {', '.join(STATUSES)}"}), 400
+        try:
+            limit = max(1, min(int(request.args.get('limit', 50)), JOBS_LIST_MAX))
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        return jsonify({
+            'jobs': [public_job(job) for job in queue.store.list(
+                status, request.args.get('kind'), request.args.get('user_id'), limit)],
+            'counts': queue.store.counts()
+        })
@@ -0,0 +1,322 @@
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from flask import jsonify, request
+
+from admin import require_admin
+from metrics import Gauge
+
+# Nothing here runs per request. tracemalloc stays off until an admin starts it
+# (or MEMDIAG_TRACE_AT_START is set), and RSS is read when /metrics is scraped.
+MEMDIAG_TRACE_AT_START = os.getenv('MEMDIAG_TRACE_AT_START', '0') == '1'
+MEMDIAG_FRAMES = int(os.getenv('MEMDIAG_FRAMES', 10))
+MEMDIAG_KEEP_SNAPSHOTS = int(os.getenv('MEMDIAG_KEEP_SNAPSHOTS', 4))
+MEMDIAG_TOP = int(os.getenv('MEMDIAG_TOP', 25))
+# Seconds between RSS samples kept for the admin timeline; 0 disables the sampler
+MEMDIAG_RSS_INTERVAL = float(os.getenv('MEMDIAG_RSS_INTERVAL', 0))
+MEMDIAG_RSS_SAMPLES = int(os.getenv('MEMDIAG_RSS_SAMPLES', 720))
+
+# Powers of two from 1KB to 16MB, for the per-session size histogram
+SIZE_BUCKETS = tuple(1024 * 2 ** i for i in range(15))
+GROUP_BY = ('lineno', 'filename', 'traceback')
+# Frames from the tracer itself and the import machinery are noise in every diff
+TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss_bytes() -> int:
+    """Current resident set size, or the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _traced_memory():
+    if not tracemalloc.is_tracing():
+        return {}
+    current, peak = tracemalloc.get_traced_memory()
+    return {('current',): current, ('peak',): peak}
+
+
+process_rss = Gauge('process_resident_memory_bytes', 'Resident memory of this worker',
+                    collect=lambda: {(): rss_bytes()})
+process_peak_rss = Gauge('process_peak_resident_memory_bytes', 'Peak resident memory of this worker',
+                         collect=lambda: {(): peak_rss_bytes()})
+traced_memory = Gauge('tracemalloc_traced_bytes', 'Memory allocated since tracemalloc was started',
+                      ('kind',), collect=_traced_memory)
+
+rss_timeline = deque(maxlen=MEMDIAG_RSS_SAMPLES)
+
+
+def deep_size(obj: Any, seen: set) -> int:
+    """sys.getsizeof of obj and everything reachable through containers, counting each object once"""
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+    return total
+
+
+def builder_size(builder) -> Dict[str, int]:
+    """Bytes held by one cached AgentBuilder, split by what holds them"""
+    # Strings interned or shared across sessions (e.g. 'default') are counted per
+    # session, which overstates the total a little but keeps sessions comparable
+    seen = set()
+    context = dict(builder.context)
+    history = deep_size(list(context.pop('conversation_history', None) or []), seen)
+    products = (deep_size(list(context.pop('products', None) or []), seen)
+                + deep_size(list(context.pop('product_pills', None) or []), seen))
+    snapshots = deep_size(list(builder.snapshots.values()), seen)
+    other = deep_size(context, seen) + sys.getsizeof(builder) + sys.getsizeof(builder.__dict__)
+    return {
+        'history': history,
+        'products': products,
+        'snapshots': snapshots,
+        'other': other,
+        'total': history + products + snapshots + other,
+    }
+
+
+def size_histogram(sizes: Iterable[int]) -> Dict[str, int]:
+    counts = OrderedDict((f"le_{bucket // 1024}kb", 0) for bucket in SIZE_BUCKETS)
+    counts['gt_max'] = 0
+    for size in sizes:
+        for bucket in SIZE_BUCKETS:
+            if size <= bucket:
+                counts[f"le_{bucket // 1024}kb"] += 1
+                break
+        else:
+            counts['gt_max'] += 1
+    return counts
+
+
+def session_report(builders: Dict[str, Any], sample: Optional[int] = None, top: int = MEMDIAG_TOP) -> Dict[str, Any]:
+    """Deep size of cached builders, measured on a random sample when there are many"""
+    started = time.perf_counter()
+    items = list(builders.items())
+    measured = random.sample(items, sample) if sample and sample < len(items) else items
+    sizes = []
+    totals = {'history': 0, 'products': 0, 'snapshots': 0, 'other': 0, 'total': 0}
+    for user_id, builder in measured:
+        try:
+            size = builder_size(builder)
+        except RuntimeError:
+            # The session changed under us mid-walk; it will be measured next time
+            continue
+        for key in totals:
+            totals[key] += size[key]
+        sizes.append((size['total'], user_id, size, len(builder.context.get('conversation_history') or []),
+                      len(builder.context.get('products') or [])))
+    sizes.sort(key=lambda s: s[0], reverse=True)
+    scale = len(items) / len(sizes) if sizes else 0
+    return {
+        'sessions': len(items),
+        'measured': len(sizes),
+        'bytes': totals,
+        'estimated_total_bytes': int(totals['total'] * scale),
+        'histogram': size_histogram(s[0] for s in sizes),
+        'largest': [
+            {'user_id': user_id, 'bytes': size, 'turns': turns, 'products': products}
+            for _, user_id, size, turns, products in sizes[:top]
+        ],
+        'ms': round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+class SnapshotStore:
+    """The last few tracemalloc snapshots, by id, for diffing against each other"""
+
+    def __init__(self, keep: int = MEMDIAG_KEEP_SNAPSHOTS):
+        self.keep = keep
+        self.snapshots: 'OrderedDict[int, Any]' = OrderedDict()
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def take(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+        with self.lock:
+            snapshot_id = self.next_id
+            self.next_id += 1
+            self.snapshots[snapshot_id] = (time.time(), snapshot)
+            while len(self.snapshots) > self.keep:
+                self.snapshots.popitem(last=False)
+        return snapshot_id, snapshot
+
+    def get(self, snapshot_id: int):
+        with self.lock:
+            entry = self.snapshots.get(snapshot_id)
+        return entry[1] if entry else None
+
+    def previous(self, snapshot_id: int) -> Optional[int]:
+        with self.lock:
+            earlier = [i for i in self.snapshots if i < snapshot_id]
+        return earlier[-1] if earlier else None
+
+    def listing(self):
+        with self.lock:
+            return [{'id': i, 'taken_at': taken_at} for i, (taken_at, _) in self.snapshots.items()]
+
+    def clear(self):
+        with self.lock:
+            self.snapshots.clear()
+
+
+snapshots = SnapshotStore()
+
+
+def _site(traceback) -> Dict[str, Any]:
+    return {'frames': [f"{frame.filename}:{frame.lineno}" for frame in traceback]}
+
+
+def top_stats(snapshot, group_by: str, limit: int):
+    stats = snapshot.statistics(group_by)
+    return [dict(_site(stat.traceback), size=stat.size, count=stat.count) for stat in stats[:limit]]
+
+
+def diff_stats(snapshot, base, group_by: str, limit: int):
+    stats = snapshot.compare_to(base, group_by)
+    return [dict(_site(stat.traceback), size=stat.size, size_diff=stat.size_diff,
+                 count=stat.count, count_diff=stat.count_diff)
+            for stat in stats[:limit]]
+
+
+def start_tracing(frames: int = MEMDIAG_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def stop_tracing():
+    tracemalloc.stop()
+    snapshots.clear()
+
+
+def start_rss_sampler(interval: float = MEMDIAG_RSS_INTERVAL):
+    def run():
+        while True:
+            rss_timeline.append((round(time.time(), 3), rss_bytes()))
+            time.sleep(interval)
+
+    threading.Thread(target=run, name='rss-sampler', daemon=True).start()
+
+
+def _query_options():
+    group_by = request.args.get('group_by', 'lineno')
+    if group_by not in GROUP_BY:
+        raise ValueError(f"group_by must be one of {', '.join(GROUP_BY)}")
+    return group_by, max(1, min(int(request.args.get('limit', MEMDIAG_TOP)), 500))
+
+
+def init_app(app, sessions: Callable[[], Dict[str, Any]]):
+    """Register the admin memory routes; sessions returns the cached builders by user"""
+    if MEMDIAG_TRACE_AT_START:
+        start_tracing()
+    if MEMDIAG_RSS_INTERVAL > 0:
+        start_rss_sampler()
+
+    @app.route('/api/admin/memory', methods=['GET'])
+    @require_admin
+    def memory_overview():
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return jsonify({
+            'rss_bytes': rss_bytes(),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'cached_sessions': len(sessions()),
+            'tracing': tracemalloc.is_tracing(),
+            'traced_bytes': current,
+            'traced_peak_bytes': peak,
+            'tracemalloc_overhead_bytes': tracemalloc.get_tracemalloc_memory(),
+            'snapshots': snapshots.listing(),
+            'rss_timeline': list(rss_timeline),
+        })
+
+    @app.route('/api/admin/memory/tracing', methods=['POST'])
+    @require_admin
+    def memory_tracing():
+        data = request.get_json(silent=True) or {}
+        action = data.get('action')
+        if action == 'start':
+            try:
+                frames = max(1, min(int(data.get('frames', MEMDIAG_FRAMES)), 100))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'frames must be an integer'}), 400
+            start_tracing(frames)
+        elif action == 'stop':
+            stop_tracing()
+        else:
+            return jsonify({'error': "action must be 'start' or 'stop'"}), 400
+        return jsonify({'tracing': tracemalloc.is_tracing(), 'frames': tracemalloc.get_traceback_limit()})
+
+    @app.route('/api/admin/memory/snapshots', methods=['POST'])
+    @require_admin
+    def take_memory_snapshot():
+        if not tracemalloc.is_tracing():
+            return jsonify({'error': 'Start tracing first'}), 409
+        try:
+            group_by, limit = _query_options()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        started = time.perf_counter()
+        snapshot_id, snapshot = snapshots.take()
+        return jsonify({
+            'id': snapshot_id,
+            'previous': snapshots.previous(snapshot_id),
+            'top': top_stats(snapshot, group_by, limit),
+            'ms': round((time.perf_counter() - started) * 1000, 2),
+        })
+
+    @app.route('/api/admin/memory/snapshots/<int:snapshot_id>/diff', methods=['GET'])
+    @require_admin
+    def diff_memory_snapshot(snapshot_id):
+        try:
+            group_by, limit = _query_options()
+            base_id = int(request.args.get('base') or snapshots.previous(snapshot_id) or 0)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        snapshot, base = snapshots.get(snapshot_id), snapshots.get(base_id)
+        if snapshot is None or base is None:
+            return jsonify({'error': 'Snapshot not found', 'snapshots': snapshots.listing()}), 404
+        return jsonify({
+            'id': snapshot_id,
+            'base': base_id,
+            'top': diff_stats(snapshot, base, group_by, limit),
+        })
+
+    @app.route('/api/admin/memory/sessions', methods=['GET'])
+    @require_admin
+    def memory_sessions():
+        try:
+            sample = max(1, int(request.args['sample'])) if request.args.get('sample') else None
+            top = max(1, min(int(request.args.get('top', MEMDIAG_TOP)), 500))
+        except ValueError:
+            return jsonify({'error': 'sample and top must be integers'}), 400
+        return jsonify(session_report(sessions(), sample, top))
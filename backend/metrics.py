@@ -0,0 +1,193 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from flask import Response, g, has_request_context, request
+
+timing_log = logging.getLogger('timing')
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY = []
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    """Monotonic counter keyed by label values"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            items = list(self.series.items())
+        for values, total in items:
+            yield f"{self.name}{_format_labels(self.labels, values)} {total}"
+
+
+class Gauge:
+    """Point-in-time value keyed by label values, optionally read from a callback at scrape time"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.collect = collect
+        self.series: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value: float, *label_values):
+        with self.lock:
+            self.series[label_values] = value
+
+    def render(self):
+        if self.collect is not None:
+            try:
+                for label_values, value in self.collect().items():
+                    self.set(value, *label_values)
+            except Exception as e:
+                timing_log.warning(f"Could not collect {self.name}: {e}")
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        with self.lock:
+            items = list(self.series.items())
+        for values, value in items:
+            yield f"{self.name}{_format_labels(self.labels, values)} {value}"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram keyed by label values"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.series.get(label_values)
+            if entry is None:
+                # per-bucket counts (last slot is +Inf), sum, count
+                entry = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            items = [(values, (list(e[0]), e[1], e[2])) for values, e in self.series.items()]
+        for values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, values)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, values)} {count}"
+
+
+request_seconds = Histogram('http_request_duration_seconds', 'Request latency by endpoint',
+                            ('endpoint', 'method', 'status'))
+stage_seconds = Histogram('stage_duration_seconds', 'Time spent in each request stage',
+                          ('endpoint', 'stage', 'model'))
+errors_total = Counter('errors_total', 'Errors by endpoint and stage', ('endpoint', 'stage'))
+cache_total = Counter('cache_lookups_total', 'Cache lookups by cache and result', ('cache', 'result'))
+
+
+def current_endpoint() -> str:
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'none'
+
+
+@contextmanager
+def timed(stage: str, model: str = ''):
+    """Time a block as one stage of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors_total.inc(current_endpoint(), stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, current_endpoint(), stage, model)
+        if has_request_context() and 'stage_timings' in g:
+            g.stage_timings[stage] = g.stage_timings.get(stage, 0) + elapsed
+
+
+def record_error(stage: str):
+    errors_total.inc(current_endpoint(), stage)
+
+
+def record_cache(cache: str, hit: bool):
+    cache_total.inc(cache, 'hit' if hit else 'miss')
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """Attach request ids, per-request timing logs and the /metrics route"""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g.stage_timings = {}
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def finish_request_timer(response):
+        if 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unknown'
+        request_seconds.observe(elapsed, endpoint, request.method, str(response.status_code))
+        response.headers['X-Request-ID'] = g.request_id
+        if endpoint != 'metrics':
+            timing_log.info(json.dumps({
+                'request_id': g.request_id,
+                'endpoint': endpoint,
+                'status': response.status_code,
+                'total_ms': round(elapsed * 1000, 2),
+                'stages_ms': {k: round(v * 1000, 2) for k, v in g.stage_timings.items()},
+            }))
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
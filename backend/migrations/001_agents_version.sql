@@ -0,0 +1,2 @@
+-- Monotonic context version used for ETags, deltas and conditional writes
+alter table agents add column if not exists version integer not null default 0;
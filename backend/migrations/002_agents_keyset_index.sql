@@ -0,0 +1,2 @@
+-- Keyset pagination for the admin listing and export: order by (updated_at desc, id desc)
+create index if not exists agents_updated_at_id_idx on agents (updated_at desc, id desc);
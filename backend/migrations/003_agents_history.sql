@@ -0,0 +1,62 @@
+-- Cold loads: the newest agent for a user in one index probe
+create index if not exists agents_user_id_updated_at_idx on agents (user_id, updated_at desc);
+
+-- Every agents column but conversation_history, plus its length and last 10 turns,
+-- so loading a session doesn't transfer the whole history
+create or replace view agent_heads as
+select
+    id, user_id, state, brand_name, hero_header, hero_subheader, hero_color, hero_text_size,
+    subheader_color, subheader_text_size, products, product_pills, background_image, sales_tone,
+    agent_type, version, updated_at,
+    coalesce(jsonb_array_length(conversation_history), 0) as history_len,
+    coalesce((
+        select jsonb_agg(turn order by idx)
+        from jsonb_array_elements(conversation_history) with ordinality as h(turn, idx)
+        where idx > jsonb_array_length(conversation_history) - 10
+    ), '[]'::jsonb) as history_tail
+from agents;
+
+-- Turns [p_before - p_limit, p_before) of an agent's history, oldest first.
+-- Ids are matched as uuid, not id::text, so both functions probe the primary key.
+create or replace function agent_history_page(p_agent_id text, p_before integer, p_limit integer)
+returns jsonb
+language sql stable
+as $$
+    select coalesce(jsonb_agg(turn order by idx), '[]'::jsonb)
+    from agents, jsonb_array_elements(agents.conversation_history) with ordinality as h(turn, idx)
+    where agents.id = p_agent_id::uuid
+      and idx > greatest(p_before - p_limit, 0)
+      and idx <= p_before
+$$;
+
+-- Conditional write from a session holding only the history from p_history_from on:
+-- the stored turns before that index are kept and the row's turns replace the rest.
+-- Returns the new version, or null if the row is no longer at p_base_version.
+create or replace function save_agent_tail(p_row jsonb, p_base_version integer, p_history_from integer)
+returns integer
+language sql
+as $$
+    update agents set
+        state = p_row->>'state',
+        brand_name = p_row->>'brand_name',
+        hero_header = p_row->>'hero_header',
+        hero_subheader = p_row->>'hero_subheader',
+        hero_color = p_row->>'hero_color',
+        hero_text_size = p_row->>'hero_text_size',
+        subheader_color = p_row->>'subheader_color',
+        subheader_text_size = p_row->>'subheader_text_size',
+        products = p_row->'products',
+        product_pills = p_row->'product_pills',
+        background_image = p_row->>'background_image',
+        sales_tone = p_row->>'sales_tone',
+        agent_type = p_row->>'agent_type',
+        conversation_history = coalesce((
+            select jsonb_agg(turn order by idx)
+            from jsonb_array_elements(agents.conversation_history) with ordinality as h(turn, idx)
+            where idx <= p_history_from
+        ), '[]'::jsonb) || coalesce(p_row->'conversation_history', '[]'::jsonb),
+        version = (p_row->>'version')::integer,
+        updated_at = (p_row->>'updated_at')::timestamptz
+    where id = (p_row->>'id')::uuid and version = p_base_version
+    returning version
+$$;
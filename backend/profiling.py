@@ -0,0 +1,146 @@
+import cProfile
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from flask import g, request
+
+# Profiling is off unless one of these is set. With neither, init_app registers
+# no hooks at all, so disabled profiling costs nothing per request.
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'sampling')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(__file__), 'profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 50))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', 1)) / 1000
+
+# The request id comes from the client's X-Request-ID, so only this much of it reaches a filename
+UNSAFE_NAME = re.compile(r'[^A-Za-z0-9_-]')
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer and counts collapsed stacks"""
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self) -> Counter:
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+
+
+def requested_mode() -> Optional[str]:
+    """Decide whether this request is profiled, and how"""
+    header = request.headers.get('X-Profile')
+    if header and PROFILE_TOKEN:
+        token, _, mode = header.partition(':')
+        if hmac.compare_digest(token, PROFILE_TOKEN):
+            return mode or PROFILE_MODE
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return PROFILE_MODE
+    return None
+
+
+def rotate(directory: str, keep: int):
+    """Delete the oldest profiles beyond the retention limit"""
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            # Rotated away by a concurrent request
+            continue
+    entries = [path for _, path in sorted(entries)]
+    for path in entries[:-keep] if keep > 0 else entries:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def write_profile(profiler, mode: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    request_id = UNSAFE_NAME.sub('', g.get('request_id') or '')[:64] or f"{threading.get_ident()}"
+    stem = f"{time.strftime('%Y%m%dT%H%M%S')}-{request.endpoint or 'unknown'}-{request_id}"
+    if mode == 'cprofile':
+        path = os.path.join(PROFILE_DIR, stem + '.prof')
+        profiler.dump_stats(path)
+    else:
+        # Collapsed-stack format, readable by flamegraph.pl and speedscope
+        path = os.path.join(PROFILE_DIR, stem + '.collapsed')
+        with open(path, 'w') as f:
+            for stack, count in profiler.items():
+                f.write(f"{stack} {count}\n")
+    rotate(PROFILE_DIR, PROFILE_KEEP)
+    return path
+
+
+def init_app(app):
+    """Register the profiling hooks if profiling is configured"""
+    if not PROFILE_TOKEN and not PROFILE_SAMPLE_RATE:
+        return
+
+    @app.before_request
+    def start_profiler():
+        mode = requested_mode()
+        if mode is None:
+            return
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            mode = 'sampling'
+            profiler = StackSampler(threading.get_ident())
+            profiler.start()
+        g.profiler = (mode, profiler)
+
+    @app.after_request
+    def stop_profiler(response):
+        mode, profiler = g.pop('profiler', (None, None))
+        if profiler is None:
+            return response
+        try:
+            if mode == 'cprofile':
+                profiler.disable()
+                path = write_profile(profiler, mode)
+            else:
+                path = write_profile(profiler.stop(), mode)
+            response.headers['X-Profile-File'] = os.path.basename(path)
+        except Exception as e:
+            print(f"Error writing profile: {e}")
+        return response
+
+    @app.teardown_request
+    def discard_profiler(error=None):
+        # Only reached with a live profiler if after_request never ran
+        mode, profiler = g.pop('profiler', (None, None))
+        if mode == 'cprofile':
+            profiler.disable()
+        elif profiler is not None:
+            profiler.stop()
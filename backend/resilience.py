@@ -0,0 +1,255 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Optional
+
+from scheduler import QueueTimeout, scheduler
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when the circuit breaker is open or the call deadline is spent"""
+
+
+# Per-endpoint call policy. Every value can be overridden from the environment,
+# e.g. CLAUDE_BUILDER_DEADLINE=20 or CLAUDE_CHAT_HEDGE=0. traffic_class picks
+# the scheduler queue the endpoint's calls wait in (see scheduler.py).
+DEFAULT_POLICIES = {
+    'builder': {'deadline': 30.0, 'attempt_timeout': 15.0, 'max_attempts': 3, 'hedge': False,
+                'traffic_class': 'builder'},
+    'chat': {'deadline': 12.0, 'attempt_timeout': 8.0, 'max_attempts': 3, 'hedge': True,
+             'traffic_class': 'storefront'},
+    'catalog': {'deadline': 45.0, 'attempt_timeout': 30.0, 'max_attempts': 2, 'hedge': False,
+                'traffic_class': 'builder'},
+}
+
+def load_policy(endpoint: str) -> Dict[str, Any]:
+    """Build the call policy for an endpoint from defaults and env overrides"""
+    policy = dict(DEFAULT_POLICIES.get(endpoint, DEFAULT_POLICIES['chat']))
+    prefix = f"CLAUDE_{endpoint.upper()}_"
+    for key, default in policy.items():
+        raw = os.getenv(prefix + key.upper())
+        if raw is None:
+            continue
+        if isinstance(default, bool):
+            policy[key] = raw.lower() in ('1', 'true', 'yes', 'on')
+        else:
+            policy[key] = type(default)(raw)
+    return policy
+
+
+def is_retryable(error: Exception) -> bool:
+    """Only transient upstream failures are worth another attempt"""
+    # Imported here so this module doesn't pull in the SDK at startup
+    import anthropic
+
+    if isinstance(error, (anthropic.APITimeoutError, anthropic.APIConnectionError,
+                          anthropic.RateLimitError, anthropic.InternalServerError)):
+        return True
+    # Request timeout and 529 overloaded are transient too
+    return isinstance(error, anthropic.APIStatusError) and error.status_code in (408, 529)
+
+
+def backoff_delay(attempt: int, base: float = 0.25, cap: float = 4.0) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class LatencyWindow:
+    """Rolling window of recent successful call latencies"""
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self.lock:
+            if len(self.samples) < 20:
+                return None
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures, probing again after a cooldown"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half_open'
+            return 'open'
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # Half open: let a single probe through
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release_probe(self):
+        """End a call that says nothing about upstream health, counting neither way"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class ResilientClaude:
+    """Wraps messages.create with deadlines, jittered retries, hedging and a breaker
+
+    Every attempt first waits for a slot from the priority scheduler, and that
+    wait counts against the call's deadline. client may be an Anthropic client or a zero-argument function returning one,
+    so the SDK can stay unimported until the first call.
+    """
+
+    def __init__(self, client, policies: Optional[Dict[str, Dict[str, Any]]] = None, slots=scheduler):
+        self.slots = slots
+        self.get_client = client if callable(client) else (lambda: client)
+        self.policies = policies or {name: load_policy(name) for name in DEFAULT_POLICIES}
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv('CLAUDE_BREAKER_THRESHOLD', 5)),
+            reset_timeout=float(os.getenv('CLAUDE_BREAKER_RESET', 30)),
+        )
+        self.latencies = {name: LatencyWindow() for name in self.policies}
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv('CLAUDE_HEDGE_WORKERS', 16)))
+
+    def create(self, endpoint: str, on_discarded: Optional[Callable[[Any], None]] = None, **kwargs):
+        """Call messages.create under the named endpoint's policy
+
+        on_discarded gets the response of a hedged copy that also succeeded but
+        lost the race, so its tokens can still be accounted for.
+        """
+        policy = self.policies.get(endpoint) or load_policy(endpoint)
+        latencies = self.latencies.setdefault(endpoint, LatencyWindow())
+        deadline = time.monotonic() + policy['deadline']
+        last_error = None
+
+        for attempt in range(policy['max_attempts']):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            traffic_class = policy.get('traffic_class', endpoint)
+            try:
+                slot = self.slots.acquire(traffic_class, deadline)
+            except QueueTimeout as e:
+                raise UpstreamUnavailable(str(e))
+            # Checked only once a slot is held: a half-open probe claimed here
+            # always ends in record_success or record_failure
+            if not self.breaker.allow():
+                slot.release()
+                raise UpstreamUnavailable('Anthropic circuit breaker is open')
+
+            timeout = min(policy['attempt_timeout'], deadline - time.monotonic())
+            started = time.monotonic()
+            try:
+                if policy['hedge']:
+                    # Takes the slot over and releases it once its first copy finishes
+                    response = self._hedged(slot, latencies, traffic_class, timeout, kwargs, on_discarded)
+                else:
+                    response = self._attempt(timeout, kwargs)
+            except Exception as e:
+                # Hand the slot back before backing off
+                if not policy['hedge']:
+                    slot.release()
+                last_error = e
+                if not is_retryable(e):
+                    # Client errors say nothing about upstream health
+                    self.breaker.release_probe()
+                    raise
+                self.breaker.record_failure()
+                delay = backoff_delay(attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+                continue
+
+            if not policy['hedge']:
+                slot.release()
+            self.breaker.record_success()
+            latencies.add(time.monotonic() - started)
+            return response
+
+        if last_error is not None:
+            raise last_error
+        raise UpstreamUnavailable(f"Deadline exceeded for {endpoint}")
+
+    def _attempt(self, timeout: float, kwargs: Dict[str, Any]):
+        return self.get_client().with_options(timeout=timeout, max_retries=0).messages.create(**kwargs)
+
+    def _hedged(self, slot, latencies: LatencyWindow, traffic_class: str, timeout: float, kwargs: Dict[str, Any],
+                on_discarded: Optional[Callable[[Any], None]] = None):
+        """Send a second copy if the first is slower than the recent p95 and a slot is free
+
+        slot is held by the first copy until it finishes, even when the second
+        one wins, so the scheduler never counts fewer calls than are running.
+        """
+        hedge_after = latencies.percentile(95)
+        try:
+            first = self.executor.submit(self._attempt, timeout, kwargs)
+        except Exception:
+            slot.release()
+            raise
+        first.add_done_callback(lambda _: slot.release())
+        if hedge_after is None or hedge_after >= timeout:
+            return first.result()
+
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+
+        # The copy needs its own slot, but only one that is free right now:
+        # waiting for it would defeat the point of hedging
+        try:
+            hedge_slot = self.slots.acquire(traffic_class, time.monotonic())
+        except QueueTimeout:
+            return first.result()
+        second = self.executor.submit(self._attempt, timeout - hedge_after, kwargs)
+        # Held until the copy finishes, even if the first answer wins
+        second.add_done_callback(lambda _: hedge_slot.release())
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if on_discarded is not None:
+                        loser = second if future is first else first
+                        loser.add_done_callback(lambda f: f.exception() is None and on_discarded(f.result()))
+                    return future.result()
+                error = future.exception()
+        raise error
+
@@ -0,0 +1,216 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from flask import g, has_request_context
+
+from metrics import Counter, Gauge, Histogram
+
+# Upstream calls allowed in flight at once across all traffic classes; 0 turns
+# scheduling off and every call goes straight through.
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 32))
+
+# Per-class share of the slots. weight splits contended slots between classes
+# and reserved slots can only ever be used by their own class. Every value can
+# be overridden from the environment, e.g. LLM_CLASS_STOREFRONT_RESERVED=12,
+# and new classes are picked up from CLAUDE_<ENDPOINT>_TRAFFIC_CLASS.
+DEFAULT_CLASSES = {
+    'storefront': {'weight': 4, 'reserved': 8},
+    'builder': {'weight': 1, 'reserved': 0},
+}
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+queue_wait_seconds = Histogram('llm_queue_wait_seconds', 'Time an upstream call waited for a slot',
+                               ('traffic_class',), buckets=WAIT_BUCKETS)
+call_seconds = Histogram('llm_call_seconds', 'Time an upstream call held its slot',
+                         ('traffic_class',))
+rejected_total = Counter('llm_queue_expired_total', 'Calls whose deadline passed while queued',
+                         ('traffic_class',))
+
+
+def load_class(name: str) -> Dict[str, int]:
+    """Weight and reservation for a traffic class from defaults and env overrides"""
+    config = dict(DEFAULT_CLASSES.get(name, {'weight': 1, 'reserved': 0}))
+    for key in config:
+        raw = os.getenv(f"LLM_CLASS_{name.upper()}_{key.upper()}")
+        if raw is not None:
+            config[key] = int(raw)
+    config['weight'] = max(1, config['weight'])
+    return config
+
+
+class QueueTimeout(Exception):
+    """The call's deadline passed before a slot was free"""
+
+
+class _Waiter:
+    __slots__ = ('event', 'granted', 'cancelled')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+
+class _TrafficClass:
+    def __init__(self, name: str, weight: int, reserved: int):
+        self.name = name
+        self.weight = weight
+        self.reserved = reserved
+        self.in_use = 0
+        # (deadline, seq, waiter): the most urgent call in the class goes first
+        self.queue: List[Any] = []
+        # Stride scheduling: the class with the lowest pass is served next and
+        # each grant advances it by 1/weight
+        self.pass_value = 0.0
+
+    def waiting(self) -> int:
+        return sum(1 for _, _, waiter in self.queue if not waiter.cancelled)
+
+
+class Slot:
+    """One granted upstream slot; release() is safe to call more than once"""
+
+    def __init__(self, scheduler: Optional['PriorityScheduler'], traffic_class: str):
+        self.scheduler = scheduler
+        self.traffic_class = traffic_class
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        call_seconds.observe(time.monotonic() - self.started, self.traffic_class)
+        if self.scheduler is not None:
+            self.scheduler._release(self.traffic_class)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class PriorityScheduler:
+    """Admits upstream calls by traffic class, weight, reservation and deadline
+
+    A class may use any free slot except those reserved for other classes that
+    are not using them. When calls are queued, freed slots go to the eligible
+    class that is furthest behind its weighted share, and within a class to the
+    call with the nearest deadline.
+    """
+
+    def __init__(self, capacity: int = LLM_CONCURRENCY, classes: Optional[Dict[str, Dict[str, int]]] = None):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.classes: Dict[str, _TrafficClass] = {}
+        for name, config in (classes or {name: load_class(name) for name in DEFAULT_CLASSES}).items():
+            self.classes[name] = _TrafficClass(name, config['weight'], config['reserved'])
+        if capacity and sum(c.reserved for c in self.classes.values()) >= capacity:
+            print(f"LLM class reservations fill all {capacity} slots; unreserved classes will starve")
+
+    def _class(self, name: str) -> _TrafficClass:
+        traffic_class = self.classes.get(name)
+        if traffic_class is None:
+            config = load_class(name)
+            traffic_class = self.classes[name] = _TrafficClass(name, config['weight'], config['reserved'])
+        return traffic_class
+
+    def _in_use(self) -> int:
+        return sum(c.in_use for c in self.classes.values())
+
+    def _can_run(self, traffic_class: _TrafficClass) -> bool:
+        held_back = sum(max(0, c.reserved - c.in_use) for c in self.classes.values() if c is not traffic_class)
+        return self._in_use() < self.capacity - held_back
+
+    def _grant(self, traffic_class: _TrafficClass):
+        traffic_class.in_use += 1
+        traffic_class.pass_value += 1.0 / traffic_class.weight
+
+    def _dispatch(self):
+        """Hand free slots to queued calls; called with the lock held"""
+        while True:
+            candidates = []
+            for traffic_class in self.classes.values():
+                while traffic_class.queue and traffic_class.queue[0][2].cancelled:
+                    heapq.heappop(traffic_class.queue)
+                if traffic_class.queue and self._can_run(traffic_class):
+                    candidates.append(traffic_class)
+            if not candidates:
+                return
+            chosen = min(candidates, key=lambda c: c.pass_value)
+            _, _, waiter = heapq.heappop(chosen.queue)
+            self._grant(chosen)
+            waiter.granted = True
+            waiter.event.set()
+
+    def acquire(self, name: str, deadline: float) -> Slot:
+        """Wait for a slot for the named class until deadline (a time.monotonic() value)"""
+        if not self.capacity:
+            return Slot(None, name)
+        started = time.monotonic()
+        with self.lock:
+            traffic_class = self._class(name)
+            if not traffic_class.queue and self._can_run(traffic_class):
+                self._catch_up(traffic_class)
+                self._grant(traffic_class)
+                return self._granted(name, started)
+            if not traffic_class.queue:
+                self._catch_up(traffic_class)
+            waiter = _Waiter()
+            heapq.heappush(traffic_class.queue, (deadline, next(self.seq), waiter))
+            # Cancelled waiters at the head may have been hiding a free slot
+            self._dispatch()
+
+        waiter.event.wait(max(0.0, deadline - time.monotonic()))
+        with self.lock:
+            if not waiter.granted:
+                waiter.cancelled = True
+                rejected_total.inc(name)
+                raise QueueTimeout(f"No upstream slot for {name} before the deadline")
+        return self._granted(name, started)
+
+    def _catch_up(self, traffic_class: _TrafficClass):
+        # A class coming back from idle starts level with the busy ones rather
+        # than cashing in the share it did not use
+        busy = [c.pass_value for c in self.classes.values() if c is not traffic_class and (c.queue or c.in_use)]
+        if busy:
+            traffic_class.pass_value = max(traffic_class.pass_value, min(busy))
+
+    def _granted(self, name: str, started: float) -> Slot:
+        waited = time.monotonic() - started
+        queue_wait_seconds.observe(waited, name)
+        if has_request_context() and 'stage_timings' in g:
+            g.stage_timings['llm_queue'] = g.stage_timings.get('llm_queue', 0) + waited
+        return Slot(self, name)
+
+    def _release(self, name: str):
+        with self.lock:
+            self.classes[name].in_use -= 1
+            self._dispatch()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            return {
+                name: {'in_use': c.in_use, 'queued': c.waiting(), 'weight': c.weight, 'reserved': c.reserved}
+                for name, c in self.classes.items()
+            }
+
+
+scheduler = PriorityScheduler()
+
+
+def _stat(key: str):
+    return lambda: {(name,): stats[key] for name, stats in scheduler.stats().items()}
+
+
+queue_depth = Gauge('llm_queue_depth', 'Upstream calls waiting for a slot', ('traffic_class',),
+                    collect=_stat('queued'))
+slots_in_use = Gauge('llm_slots_in_use', 'Upstream slots held', ('traffic_class',),
+                     collect=_stat('in_use'))
@@ -0,0 +1,202 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import Counter
+
+# The WAL and snapshots are off unless SESSION_STATE_DIR names a directory
+# (e.g. backend/session_state). The directory is locked by one process; other
+# workers sharing it run without either.
+#
+# A replayed write whose base version was superseded in the meantime (another
+# worker saved the agent while this one was down) is dropped: that turn was
+# acknowledged to the user but does not reach Supabase. Each one is counted in
+# session_wal_dropped_total.
+SESSION_STATE_DIR = os.getenv('SESSION_STATE_DIR', '')
+WAL_FSYNC = os.getenv('WAL_FSYNC', '1') == '1'
+WAL_RETRY_INTERVAL = float(os.getenv('WAL_RETRY_INTERVAL', 5))
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', 60))
+SNAPSHOT_MAX_SESSIONS = int(os.getenv('SNAPSHOT_MAX_SESSIONS', 10000))
+
+wal_dropped_total = Counter('session_wal_dropped_total',
+                            'Acknowledged writes dropped on replay because a newer version was saved')
+
+
+class WriteAheadLog:
+    """Append-only log of context writes that Supabase has not acknowledged yet
+
+    Each save appends a 'put' line before it goes to Supabase and an 'ack' line
+    once it lands. Only the newest unacknowledged put per agent is kept, since
+    it carries the whole row.
+    """
+
+    def __init__(self, path: str, fsync: bool = WAL_FSYNC):
+        self.path = path
+        self.fsync = fsync
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+        self._load()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-append
+                    continue
+                self.seq = max(self.seq, entry['seq'])
+                self._apply(entry)
+
+    def _apply(self, entry: Dict[str, Any]):
+        agent_id = entry['agent_id']
+        if entry['op'] == 'put':
+            self.pending[agent_id] = entry
+        elif agent_id in self.pending and self.pending[agent_id]['seq'] <= entry['upto']:
+            del self.pending[agent_id]
+
+    def _write(self, entry: Dict[str, Any], sync: bool):
+        self.file.write(json.dumps(entry, default=str, separators=(',', ':')) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def append(self, agent_id: str, user_id: str, base_version: Optional[int], data: Dict[str, Any]) -> int:
+        """Log a row about to be written; returns its sequence number"""
+        with self.lock:
+            self.seq += 1
+            entry = {'seq': self.seq, 'op': 'put', 'agent_id': agent_id, 'user_id': user_id,
+                     'base_version': base_version, 'data': data}
+            self._write(entry, self.fsync)
+            self._apply(entry)
+            return self.seq
+
+    def ack(self, agent_id: str, seq: int):
+        """Mark every put for an agent up to seq as applied (or superseded)"""
+        with self.lock:
+            if agent_id not in self.pending:
+                return
+            self.seq += 1
+            entry = {'seq': self.seq, 'op': 'ack', 'agent_id': agent_id, 'upto': seq}
+            # Losing an ack only means a harmless conditional re-write, so no fsync
+            self._write(entry, False)
+            self._apply(entry)
+
+    def pending_records(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return sorted(self.pending.values(), key=lambda entry: entry['seq'])
+
+    def compact(self):
+        """Rewrite the log with only the pending puts"""
+        with self.lock:
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for entry in sorted(self.pending.values(), key=lambda e: e['seq']):
+                    f.write(json.dumps(entry, default=str, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.file.close()
+            os.replace(tmp, self.path)
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+
+class SessionStore:
+    """WAL plus periodic snapshots of warm builder sessions in one locked directory"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.snapshot_path = os.path.join(root, 'sessions.snapshot')
+        self.wal = WriteAheadLog(os.path.join(root, 'context.wal'))
+        self.stop = threading.Event()
+        self.thread = None
+
+    def save_snapshot(self, sessions: Iterable[Tuple[str, Any]]) -> int:
+        """Atomically replace the snapshot with one 'key<TAB>json' line per session
+
+        A session may be given as a dict or as JSON text that is still encoded.
+        """
+        tmp = f"{self.snapshot_path}.tmp"
+        count = 0
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for key, session in sessions:
+                if not isinstance(session, str):
+                    session = json.dumps(session, default=str, separators=(',', ':'))
+                f.write(f"{key}\t{session}\n")
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        return count
+
+    def load_snapshot(self) -> Dict[str, str]:
+        """key -> session JSON, left encoded so startup does not pay to parse every session"""
+        if not os.path.exists(self.snapshot_path):
+            return {}
+        sessions = {}
+        with open(self.snapshot_path, encoding='utf-8') as f:
+            for line in f:
+                key, tab, session = line.rstrip('\n').partition('\t')
+                if tab and session.endswith('}'):
+                    sessions[key] = session
+        return sessions
+
+    def start(self, snapshot: Callable[[], Iterable[Tuple[str, Any]]],
+              replay: Callable[[Dict[str, Any]], bool]):
+        """Replay pending writes every WAL_RETRY_INTERVAL and snapshot every SNAPSHOT_INTERVAL"""
+
+        def flush_snapshot():
+            try:
+                self.save_snapshot(snapshot())
+                self.wal.compact()
+            except Exception as e:
+                print(f"Error writing session snapshot: {e}")
+
+        def run():
+            next_snapshot = time.monotonic() + SNAPSHOT_INTERVAL
+            while not self.stop.wait(WAL_RETRY_INTERVAL):
+                self.replay_pending(replay)
+                if time.monotonic() >= next_snapshot:
+                    flush_snapshot()
+                    next_snapshot = time.monotonic() + SNAPSHOT_INTERVAL
+
+        self.thread = threading.Thread(target=run, name='session-store', daemon=True)
+        self.thread.start()
+        atexit.register(lambda: (self.stop.set(), flush_snapshot()))
+
+    def replay_pending(self, replay: Callable[[Dict[str, Any]], bool]) -> int:
+        """Send pending writes to Supabase, oldest first; stops at the first failure"""
+        replayed = 0
+        for record in self.wal.pending_records():
+            try:
+                if not replay(record):
+                    break
+            except Exception as e:
+                print(f"Error replaying context write for agent {record['agent_id']}: {e}")
+                break
+            replayed += 1
+        return replayed
+
+
+def open_store(root: str = SESSION_STATE_DIR) -> Optional[SessionStore]:
+    """The session store for this process, or None if disabled or held by another process"""
+    if not root:
+        return None
+    os.makedirs(root, exist_ok=True)
+    lock_file = open(os.path.join(root, 'lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print(f"Session state in {root} is held by another process; running without WAL and snapshots")
+        lock_file.close()
+        return None
+    store = SessionStore(root)
+    store.lock_file = lock_file
+    return store
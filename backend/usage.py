@@ -0,0 +1,339 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import jsonify, request
+
+from admin import require_admin
+
+# USD per million tokens: (input, output, cache read, cache write)
+MODEL_PRICES = {
+    'claude-3-haiku-20240307': (0.25, 1.25, 0.03, 0.30),
+    'claude-3-5-haiku-20241022': (0.80, 4.00, 0.08, 1.00),
+    'claude-sonnet-4-20250514': (3.00, 15.00, 0.30, 3.75),
+}
+
+GROUP_FIELDS = ('user_id', 'agent_id', 'endpoint', 'state', 'model')
+SUM_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_creation_tokens', 'latency_ms', 'cost_usd')
+
+USAGE_SINK = os.getenv('USAGE_SINK', 'sqlite')
+USAGE_DB = os.getenv('USAGE_DB', os.path.join(os.path.dirname(__file__), 'usage.db'))
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', 10))
+USAGE_FLUSH_BATCH = int(os.getenv('USAGE_FLUSH_BATCH', 200))
+
+# Budgets are daily (UTC) USD per tenant (user_id). USAGE_BUDGETS='{"user-1": 2.5}'
+# overrides the default for specific tenants. Past USAGE_DOWNGRADE_AT of the
+# budget calls move to USAGE_CHEAP_MODEL; past the budget they are throttled.
+# With the sqlite sink, spend is re-read from USAGE_DB on every flush, so it
+# survives restarts and is shared, a flush interval behind, by every worker on
+# the host. With any other sink budgets are per process: N workers allow up to
+# N times a tenant's budget, and a restart starts the day's count again.
+USAGE_DAILY_BUDGET = float(os.getenv('USAGE_DAILY_BUDGET', 0))
+USAGE_BUDGETS = json.loads(os.getenv('USAGE_BUDGETS', '{}'))
+USAGE_DOWNGRADE_AT = float(os.getenv('USAGE_DOWNGRADE_AT', 0.8))
+# Unset, or the same model as the default, means tenants aren't downgraded, only throttled
+USAGE_CHEAP_MODEL = os.getenv('USAGE_CHEAP_MODEL', '')
+USAGE_SUMMARY_PAGE = int(os.getenv('USAGE_SUMMARY_PAGE', 1000))
+
+
+def cost_of(model: str, input_tokens: int, output_tokens: int, cache_read: int, cache_write: int) -> float:
+    prices = MODEL_PRICES.get(model)
+    if not prices:
+        return 0.0
+    return (input_tokens * prices[0] + output_tokens * prices[1]
+            + cache_read * prices[2] + cache_write * prices[3]) / 1_000_000
+
+
+def day_bounds(since: str, until: str):
+    """ts range covering the UTC days since..until inclusive, as ISO strings"""
+    return date.fromisoformat(since).isoformat(), (date.fromisoformat(until) + timedelta(days=1)).isoformat()
+
+
+def rollup(items, group_by: List[str]) -> List[Dict[str, Any]]:
+    """Sum (key, totals) pairs, key ordered as GROUP_FIELDS, over the requested dimensions"""
+    indexes = [GROUP_FIELDS.index(f) for f in group_by]
+    rolled: Dict[tuple, Dict[str, float]] = {}
+    for key, totals in items:
+        group = tuple(key[i] for i in indexes)
+        target = rolled.setdefault(group, dict.fromkeys(('calls',) + SUM_FIELDS, 0))
+        for field in target:
+            target[field] += totals.get(field) or 0
+    return [summary_row(dict(zip(group_by, group)), totals) for group, totals in rolled.items()]
+
+
+def summary_row(row: Dict[str, Any], totals: Dict[str, float]) -> Dict[str, Any]:
+    row.update(totals)
+    row['cost_usd'] = round(row['cost_usd'] or 0, 6)
+    row['avg_latency_ms'] = round(row['latency_ms'] / row['calls'], 2) if row['calls'] else 0
+    del row['latency_ms']
+    return row
+
+
+class SQLiteSink:
+    """Appends usage events to a local SQLite table"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_usage ("
+                "ts TEXT, user_id TEXT, agent_id TEXT, endpoint TEXT, state TEXT, model TEXT, "
+                "input_tokens INTEGER, output_tokens INTEGER, cache_read_tokens INTEGER, "
+                "cache_creation_tokens INTEGER, latency_ms REAL, cost_usd REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_usage_ts_idx ON llm_usage (ts)")
+
+    def write(self, events: List[Dict[str, Any]]):
+        columns = ('ts', 'user_id', 'agent_id', 'endpoint', 'state', 'model', 'input_tokens',
+                   'output_tokens', 'cache_read_tokens', 'cache_creation_tokens', 'latency_ms', 'cost_usd')
+        with sqlite3.connect(self.path) as conn:
+            conn.executemany(
+                f"INSERT INTO llm_usage ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [tuple(e.get(c) for c in columns) for e in events],
+            )
+
+    def spend_on(self, day: str) -> Dict[str, float]:
+        """USD per user_id over the events written for a UTC day, by every process"""
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute(
+                "SELECT user_id, sum(cost_usd) FROM llm_usage WHERE ts >= ? AND ts < ? "
+                "AND user_id IS NOT NULL GROUP BY user_id",
+                (day, (date.fromisoformat(day) + timedelta(days=1)).isoformat())
+            ).fetchall()
+        return {user_id: cost or 0.0 for user_id, cost in rows}
+
+    def summary(self, group_by: List[str], since: str, until: str) -> List[Dict[str, Any]]:
+        """Written events for the UTC days since..until, rolled up in SQL"""
+        # group_by is checked against GROUP_FIELDS, so it is safe to interpolate
+        columns = ', '.join(group_by)
+        sums = ', '.join(f"coalesce(sum({f}), 0) AS {f}" for f in SUM_FIELDS)
+        sql = (f"SELECT {columns + ', ' if columns else ''}count(*) AS calls, {sums} FROM llm_usage "
+               f"WHERE ts >= ? AND ts < ?" + (f" GROUP BY {columns}" if columns else ""))
+        with sqlite3.connect(self.path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(sql, day_bounds(since, until)).fetchall()
+        return [summary_row({f: row[f] for f in group_by}, {k: row[k] for k in ('calls',) + SUM_FIELDS})
+                for row in rows if row['calls']]
+
+
+class SupabaseSink:
+    """Inserts usage events into a Supabase table in one request per batch"""
+
+    def __init__(self, get_client, table: str = 'llm_usage'):
+        self.get_client = get_client
+        self.table = table
+
+    def write(self, events: List[Dict[str, Any]]):
+        self.get_client().table(self.table).insert(events).execute()
+
+    def summary(self, group_by: List[str], since: str, until: str) -> List[Dict[str, Any]]:
+        """Written events for the UTC days since..until, fetched in pages and rolled up here"""
+        start, end = day_bounds(since, until)
+        items, offset = [], 0
+        while True:
+            page = self.get_client().table(self.table).select(','.join(GROUP_FIELDS + SUM_FIELDS)).gte(
+                'ts', start).lt('ts', end).order('ts').range(offset, offset + USAGE_SUMMARY_PAGE - 1).execute().data or []
+            items.extend((tuple(e.get(f) for f in GROUP_FIELDS), dict(e, calls=1)) for e in page)
+            if len(page) < USAGE_SUMMARY_PAGE:
+                break
+            offset += USAGE_SUMMARY_PAGE
+        return rollup(items, group_by)
+
+
+class UsageTracker:
+    """Aggregates the UTC day's token usage in memory and flushes raw events in batches
+
+    Totals and spend start over each day; earlier days are only in the sink.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.day = datetime.utcnow().date().isoformat()
+        self.totals: Dict[tuple, Dict[str, float]] = {}
+        # user_id -> USD spent today
+        self.daily_spend: Dict[str, float] = {}
+        self.pending: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def start(self):
+        if self.sink is None or self.flusher is not None:
+            return
+        self.refresh_spend()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def record(self, response, model: str, latency: float, endpoint: str, user_id: Optional[str] = None,
+               agent_id: Optional[str] = None, state: Optional[str] = None):
+        """Account for one messages.create response"""
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        input_tokens = usage.input_tokens or 0
+        output_tokens = usage.output_tokens or 0
+        cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_write = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        cost = cost_of(model, input_tokens, output_tokens, cache_read, cache_write)
+        now = datetime.utcnow()
+        event = {
+            'ts': now.isoformat(), 'user_id': user_id, 'agent_id': agent_id, 'endpoint': endpoint,
+            'state': state, 'model': model, 'input_tokens': input_tokens, 'output_tokens': output_tokens,
+            'cache_read_tokens': cache_read, 'cache_creation_tokens': cache_write,
+            'latency_ms': round(latency * 1000, 2), 'cost_usd': cost,
+        }
+        key = tuple(event[f] for f in GROUP_FIELDS)
+        with self.lock:
+            self._roll_over(now.date().isoformat())
+            totals = self.totals.get(key)
+            if totals is None:
+                totals = self.totals[key] = dict.fromkeys(('calls',) + SUM_FIELDS, 0)
+            totals['calls'] += 1
+            for field in SUM_FIELDS:
+                totals[field] += event[field]
+            if user_id:
+                self.daily_spend[user_id] = self.daily_spend.get(user_id, 0) + cost
+            if self.sink is not None:
+                self.pending.append(event)
+                should_flush = len(self.pending) >= USAGE_FLUSH_BATCH
+            else:
+                should_flush = False
+        if should_flush:
+            threading.Thread(target=self.flush, daemon=True).start()
+
+    def _roll_over(self, day: str):
+        """Start a new day's totals and spend; called with the lock held"""
+        if day != self.day:
+            self.day = day
+            self.totals = {}
+            self.daily_spend = {}
+
+    def flush(self):
+        if self.sink is None:
+            return
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if batch:
+                try:
+                    self.sink.write(batch)
+                except Exception as e:
+                    print(f"Error flushing usage: {e}")
+                    with self.lock:
+                        # Keep the batch for the next attempt, bounded so a dead sink can't grow memory
+                        self.pending = (batch + self.pending)[-USAGE_FLUSH_BATCH * 50:]
+                    return
+            self.refresh_spend()
+
+    def refresh_spend(self):
+        """Take today's spend from the sink, if it can total it, plus the events not written yet"""
+        spend_on = getattr(self.sink, 'spend_on', None)
+        if spend_on is None:
+            return
+        day = datetime.utcnow().date().isoformat()
+        try:
+            stored = spend_on(day)
+        except Exception as e:
+            print(f"Error reading usage spend: {e}")
+            return
+        with self.lock:
+            self._roll_over(day)
+            for event in self.pending:
+                if event['user_id'] and event['ts'].startswith(day):
+                    stored[event['user_id']] = stored.get(event['user_id'], 0) + event['cost_usd']
+            self.daily_spend = stored
+
+    def _flush_loop(self):
+        while not self.stopped.wait(USAGE_FLUSH_INTERVAL):
+            self.flush()
+
+    def summary(self, group_by: List[str], since: Optional[str] = None,
+                until: Optional[str] = None) -> Tuple[List[Dict[str, Any]], str]:
+        """Usage for the UTC days since..until (default today) rolled up over the requested dimensions
+
+        Read from the sink, so it covers every process writing to it, after
+        flushing this one; other processes' last few seconds may be missing.
+        Without a sink that can summarize, only today's calls in this process
+        are known. Returns the rows and where they came from.
+        """
+        today = datetime.utcnow().date().isoformat()
+        since = since or today
+        until = until or since
+        if hasattr(self.sink, 'summary'):
+            self.flush()
+            rows, source = self.sink.summary(group_by, since, until), 'sink'
+        elif since == until == today:
+            with self.lock:
+                self._roll_over(today)
+                items = [(key, dict(totals)) for key, totals in self.totals.items()]
+            rows, source = rollup(items, group_by), 'memory'
+        else:
+            raise ValueError('Only today is available without a usage sink')
+        return sorted(rows, key=lambda r: r['cost_usd'], reverse=True), source
+
+    def spent_today(self, user_id: str) -> float:
+        with self.lock:
+            self._roll_over(datetime.utcnow().date().isoformat())
+            return self.daily_spend.get(user_id, 0.0)
+
+    def budget_for(self, user_id: Optional[str]) -> float:
+        if not user_id:
+            return 0.0
+        return float(USAGE_BUDGETS.get(user_id, USAGE_DAILY_BUDGET))
+
+    def over_budget(self, user_id: Optional[str]) -> bool:
+        budget = self.budget_for(user_id)
+        return bool(budget) and self.spent_today(user_id) >= budget
+
+    def model_for(self, user_id: Optional[str], default_model: str) -> str:
+        """Route tenants close to their budget to the cheaper model"""
+        if not USAGE_CHEAP_MODEL or USAGE_CHEAP_MODEL == default_model:
+            return default_model
+        budget = self.budget_for(user_id)
+        if budget and self.spent_today(user_id) >= budget * USAGE_DOWNGRADE_AT:
+            return USAGE_CHEAP_MODEL
+        return default_model
+
+
+def make_sink(get_supabase=None):
+    if USAGE_SINK == 'supabase' and get_supabase is not None:
+        return SupabaseSink(get_supabase)
+    if USAGE_SINK == 'sqlite':
+        return SQLiteSink(USAGE_DB)
+    return None
+
+
+def init_app(app, tracker: UsageTracker):
+    """Start background flushing and expose /api/admin/usage"""
+    tracker.start()
+
+    @app.route('/api/admin/usage', methods=['GET'])
+    @require_admin
+    def usage_summary():
+        group_by = [f for f in request.args.get('group_by', 'endpoint').split(',') if f]
+        unknown = [f for f in group_by if f not in GROUP_FIELDS]
+        if unknown:
+            return jsonify({'error': f"Unknown group_by fields: {', '.join(unknown)}"}), 400
+        since, until = request.args.get('since'), request.args.get('until')
+        try:
+            for day in (since, until):
+                if day:
+                    date.fromisoformat(day)
+        except ValueError:
+            return jsonify({'error': 'since and until must be YYYY-MM-DD days'}), 400
+        try:
+            rows, source = tracker.summary(group_by, since, until)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            print(f"Error summarizing usage: {e}")
+            return jsonify({'error': 'Could not read usage'}), 502
+        today = datetime.utcnow().date().isoformat()
+        return jsonify({'group_by': group_by, 'since': since or today, 'until': until or since or today,
+                        'source': source, 'rows': rows})
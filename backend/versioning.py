@@ -0,0 +1,44 @@
+from typing import Any, Dict, List
+
+
+def context_etag(agent_id: str, version: int) -> str:
+    return f"{agent_id}:{version}"
+
+
+def _pointer(path: str, key) -> str:
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def json_patch(old: Any, new: Any, path: str = '') -> List[Dict[str, Any]]:
+    """RFC 6902 operations that turn old into new
+
+    Dicts and lists are diffed member by member so appending one product
+    yields a single 'add' instead of resending the whole list.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'remove', 'path': _pointer(path, key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({'op': 'add', 'path': _pointer(path, key), 'value': value})
+            else:
+                ops.extend(json_patch(old[key], value, _pointer(path, key)))
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        shared = min(len(old), len(new))
+        for index in range(shared):
+            ops.extend(json_patch(old[index], new[index], _pointer(path, index)))
+        for index in range(shared, len(new)):
+            ops.append({'op': 'add', 'path': _pointer(path, index), 'value': new[index]})
+        # Remove from the end so earlier indexes stay valid
+        for index in range(len(old) - 1, shared - 1, -1):
+            ops.append({'op': 'remove', 'path': _pointer(path, index)})
+        return ops
+
+    if old == new and type(old) is type(new):
+        return []
+    return [{'op': 'replace', 'path': path, 'value': new}]
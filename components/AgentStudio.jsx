@@ -111,6 +111,11 @@ export function AgentStudio({
 if (data.updates) onUpdateAgent(data.updates);
 if (data.context || data.updated_fields) {
 
+  // context.products are new products to append; updatedProducts replace ours with the same name
+  const productKey = (p) => String(p?.name || '').toLowerCase().split(/\s+/).filter(Boolean).join(' ');
+  const edited = new Map((data.context.updatedProducts || []).map((p) => [productKey(p), p]));
+  const products = (agentData.products || []).map((p) => edited.get(productKey(p)) || p);
+
   // Build complete updates from backend + existing data
   const updates = {
     brandName: data.context.brandName || data.context.brand_name || agentData.brandName,
@@ -122,7 +127,7 @@ if (data.context || data.updated_fields) {
     subheaderColor: data.context.subheaderColor || data.context.subheader_color || agentData.subheaderColor,
     subheaderTextSize: data.context.subheaderTextSize || data.context.subheader_text_size || agentData.subheaderTextSize,
     subheaderWeight: data.context.subheaderWeight || data.context.subheader_weight || agentData.subheaderWeight,
-    products: data.context.products ? [...(agentData.products || []), ...data.context.products] : agentData.products,
+    products: data.context.products ? [...products, ...data.context.products] : agentData.products,
     productPills: data.context.productPills || data.context.product_pills || agentData.productPills,
     backgroundImage: data.context.backgroundImage || data.context.background_image || agentData.backgroundImage,
     salesTone: data.context.salesTone || data.context.sales_tone || agentData.salesTone,
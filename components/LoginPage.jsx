@@ -30,8 +30,14 @@ export function LoginPage({ onBack }) {
         if (error) throw error;
         router.push('/dashboard');
       } else {
-        const { error } = await supabase.auth.signInWithPassword({ email, password });
+        const { data, error } = await supabase.auth.signInWithPassword({ email, password });
         if (error) throw error;
+        // Warm the builder session while the dashboard loads
+        fetch(`${process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:5000'}/api/builder/prefetch`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ user_id: data.user.id }),
+        }).catch(() => {});
         router.push('/dashboard');
       }
     } catch (err) {